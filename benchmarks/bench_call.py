@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+""" Compares the time and memory used to create ``Call`` objects with the
+    previous (``__dict__``-based, with an eagerly created ``meta`` dict)
+    implementation.
+
+    Usage: python benchmarks/bench_call.py """
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from dirt.rpc.common import Call
+from dirt.misc.strutil import to_str
+
+class DictCall(object):
+    """ ``Call``, as it was before it used ``__slots__``. """
+
+    default_flags = Call.default_flags
+
+    def __init__(self, name, args=None, kwargs=None, flags=None, peer=None,
+                 headers=None):
+        args = args or ()
+        kwargs = kwargs or {}
+        flags = flags or {}
+        for flag in flags:
+            if flag not in self.default_flags:
+                raise ValueError("invalid flag: %r" %(flag, ))
+        self.__dict__.update(self.default_flags)
+        self.__dict__.update(flags)
+        kwargs = dict((to_str(key), val) for (key, val) in kwargs.items())
+        self.name = name
+        self.args = args
+        self.kwargs = kwargs
+        self.flags = flags
+        self.peer = peer
+        self.headers = headers or {}
+        self.result_headers = {}
+        self.meta = {
+            "time_received": time.time(),
+            "time_in_queue": None,
+            "yielded_items": None,
+        }
+
+def size_of(call):
+    """ The bytes allocated for ``call``, its ``__dict__`` (if any) and the
+        dicts it creates (not counting the arguments themselves). """
+    size = sys.getsizeof(call)
+    attrs = getattr(call, "__dict__", None)
+    if attrs is None:
+        meta = call._meta
+    else:
+        meta = attrs["meta"]
+        size += sys.getsizeof(attrs)
+    for value in [call.kwargs, call.flags, call.headers, call.result_headers,
+                  meta]:
+        if value is not None:
+            size += sys.getsizeof(value)
+    return size
+
+def timed(cls, count, kwargs):
+    best = None
+    for _ in range(3):
+        start = time.time()
+        for _ in xrange(count):
+            cls("foo.bar", (1, 2), kwargs)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main(count=100000):
+    for desc, kwargs in [("no kwargs", None), ("str kwargs", {"a": 1})]:
+        print "%s:" %(desc, )
+        for cls in [DictCall, Call]:
+            elapsed = timed(cls, count, kwargs)
+            print ("    %-8s %6.3fs for %s calls (%4.2fus/call; %3.0f%% of a "
+                   "core at 100k calls/sec), %s bytes/call" %(
+                cls.__name__, elapsed, count, elapsed / count * 1e6,
+                elapsed / count * 1e5 * 100,
+                size_of(cls("foo.bar", (1, 2), kwargs)),
+            ))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+""" Measures the per-call overhead of looking up API methods with
+    ``APIEdge.get_call_callable`` and of ``APIEdge.execute`` for handlers
+    with each lifecycle (see ``APIEdge.handler_lifecycle``).
+
+    Usage: python benchmarks/bench_dispatch.py """
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from dirt.app import APIEdge
+from dirt.rpc.common import Call
+
+class API(object):
+    def __init__(self, edge, call):
+        pass
+
+    def ping(self):
+        return "pong"
+
+@APIEdge.handler_lifecycle("connection")
+class ConnectionAPI(API):
+    pass
+
+@APIEdge.handler_lifecycle("singleton")
+class SingletonAPI(API):
+    pass
+
+class App(object):
+    api_handlers = {
+        "call": API,
+        "connection": ConnectionAPI,
+        "singleton": SingletonAPI,
+    }
+
+class Edge(APIEdge):
+    report_load = False
+    max_concurrent_calls = None
+
+def timed(func, count):
+    best = None
+    for _ in range(3):
+        start = time.time()
+        func(count)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / count * 1e6
+
+def main(count=100000):
+    edge = Edge(App(), None)
+    edge.compile_handlers()
+    for prefix in ["call", "connection", "singleton"]:
+        call = Call(prefix + ".ping", peer=("127.0.0.1", 1234))
+        def lookup(count):
+            for _ in xrange(count):
+                edge.get_call_callable(call)
+        def execute(count):
+            for _ in xrange(count):
+                edge.execute(call)
+        print "%-10s  lookup: %6.2fus/call  execute: %6.2fus/call" %(
+            prefix, timed(lookup, count), timed(execute, count),
+        )
+
+if __name__ == "__main__":
+    main()
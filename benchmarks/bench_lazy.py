@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+""" Compares fully decoding large BSON responses with lazily decoding them
+    and reading only part of them.
+
+    Usage: python benchmarks/bench_lazy.py """
+import os
+import sys
+import time
+
+import bson
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from dirt.rpc.proto_drpc.lazybson import LazyDocument
+
+def make_response(size_mb):
+    row = {
+        "id": 0,
+        "name": u"some name",
+        "tags": [u"a", u"b", u"c"],
+        "stats": {"count": 42, "mean": 1.5},
+        "payload": "x" * 64,
+    }
+    row_size = len(bson.dumps(row))
+    num_rows = int(size_mb * 1024 * 1024 / row_size)
+    return {
+        "total": num_rows,
+        "rows": [dict(row, id=idx) for idx in xrange(num_rows)],
+    }
+
+def timed(func, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+ACCESS_PATTERNS = [
+    ("one field", lambda doc: doc["total"]),
+    ("one row", lambda doc: doc["rows"][len(doc["rows"]) // 2]["name"]),
+    ("first 10 rows", lambda doc: [r["id"] for r in doc["rows"][:10]]),
+]
+
+def main():
+    for size_mb in [1, 10, 50]:
+        data = bson.dumps(make_response(size_mb))
+        print "%s MB response (%s bytes):" %(size_mb, len(data))
+        print "    %-20s %8.4fs" %("full decode", timed(lambda: bson.loads(data),
+                                                        repeat=1))
+        for name, access in ACCESS_PATTERNS:
+            elapsed = timed(lambda: access(LazyDocument(data)))
+            print "    lazy: %-14s %8.4fs" %(name, elapsed)
+
+if __name__ == "__main__":
+    main()
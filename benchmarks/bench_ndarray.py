@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+""" Compares sending floats through a drpc connection as a list and as a
+    NumPy ``ndarray`` (which uses the out-of-band frame codec).
+
+    Usage: python benchmarks/bench_ndarray.py [num_floats (default: 1e6)] """
+import os
+import sys
+import time
+
+import gevent
+import numpy
+from gevent import socket
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from dirt.rpc.proto_drpc.frames import extract_frames, restore_frames
+from dirt.rpc.proto_drpc.connection import ClientConnection, ServerConnection
+
+def echo_server(server_socket):
+    sock, addr = server_socket.accept()
+    cxn = ServerConnection(sock, addr)
+    while True:
+        cxn.send_message(cxn.recv_message())
+
+def timed(func, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def bench(name, cxn, value):
+    def encode_decode():
+        message, frames = extract_frames(("echo", value), cxn.frame_threshold)
+        data = cxn._dumps(message)
+        restore_frames(cxn._loads(data), map(memoryview, frames))
+
+    def round_trip():
+        cxn.send_message(("echo", value))
+        cxn.recv_message()
+
+    print "%-8s encode+decode: %8.4fs" %(name, timed(encode_decode)),
+    try:
+        print "round trip: %8.4fs" %(timed(round_trip), )
+    except AssertionError as e:
+        # Most likely the 16MB message size limit
+        print "round trip: failed (%s)" %(e, )
+        cxn.disconnect()
+
+def main(num_floats):
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.bind(("127.0.0.1", 0))
+    server_socket.listen(5)
+    gevent.spawn(echo_server, server_socket)
+    cxn = ClientConnection(server_socket.getsockname())
+
+    array = numpy.random.random(num_floats)
+    print "%s floats:" %(num_floats, )
+    bench("ndarray", cxn, array)
+    bench("list", cxn, array.tolist())
+
+if __name__ == "__main__":
+    main(int(float(sys.argv[1])) if len(sys.argv) > 1 else 10 ** 6)
@@ -1,21 +1,46 @@
 import os
+import copy
 import time
+import hashlib
 import signal
 import logging
+import heapq
 import inspect
 import functools
+import itertools
+from collections import deque
 
+import gevent
 from gevent import Timeout
 from gevent.lock import BoundedSemaphore, DummySemaphore
 from gevent import GreenletExit
 
 from dirt import rpc
-from dirt.rpc.common import Call
+from dirt.rpc.common import Call, call_key
 from dirt.misc.iter import isiter
-from dirt.misc.gevent_ import AlarmInterrupt
+from dirt.misc.lru import LRUCache
+from dirt.misc.strutil import truncate, bounded_repr
+from dirt.misc.clock import monotonic
+from dirt.misc.histogram import LatencyHistogram
+from dirt.misc.delta import etag, diff
+from dirt.misc.gevent_ import AlarmInterrupt, SingleFlight
 
 log = logging.getLogger(__name__)
 
+# The stages of handling a call which are timed when ``APIEdge.record_stages``
+# is enabled, as ``(stage, start timestamp, end timestamp)``, where the
+# timestamps are keys of ``call.timestamps``. For calls which return
+# iterators, ``handler`` includes sending the items, and ``serialize`` and
+# ``send`` only the final message.
+CALL_STAGES = [
+    ("read", "received", "read"),
+    ("decode", "read", "decoded"),
+    ("queue", "decoded", "started"),
+    ("handler", "started", "finished"),
+    ("serialize", "finished", "serialized"),
+    ("send", "serialized", "sent"),
+]
+
 
 class DebugAPI(object):
     """ Service debugging API. """
@@ -34,14 +59,24 @@ class DebugAPI(object):
             if not name.startswith("_") and callable(getattr(obj, name))
         ]
 
-    def _call_to_dict(self, call):
+    def _call_to_dict(self, call_id, call):
         """ Converts an instance of ``Call`` to a dict which will be returned
             from ``active_calls``. """
-        call_dict = dict(call.__dict__)
+        call_dict = dict(
+            (attr, getattr(call, attr))
+            for attr in ["name", "args", "kwargs", "flags", "headers"]
+        )
+        call_dict["id"] = call_id
+        call_dict["peer"] = self._format_peer(call.peer)
         call_dict["meta"] = dict(call.meta)
-        call_dict["meta"]["age"] = time.time() - call.meta["time_received"]
+        call_dict["meta"]["age"] = time.time() - call.time_received
         return call_dict
 
+    def _format_peer(self, peer):
+        if isinstance(peer, tuple):
+            return "%s:%s" %peer
+        return peer
+
     def getdoc(self):
         """ Returns the docstring for ``self``. For iPython compatibility. """
         return inspect.getdoc(self)
@@ -69,29 +104,141 @@ class DebugAPI(object):
         methods = self._list_methods(handler)
         return handlers + methods
 
-    def active_calls(self): # XXX re-write this
-        """ Returns a description of all the currently active RPC calls. """
-        return [
-            ("%s:%s" %address, self._call_to_dict(call))
-            for (address, call) in self.meta.active_calls
-        ]
+    def active_calls(self, after=0, limit=100):
+        """ Returns a page of (at most ``limit``) descriptions of the RPC
+            calls which are currently in progress, oldest first, starting
+            after the call with id ``after``::
+
+                {"total": 42, "calls": [{"id": 17, ...}, ...], "next": 20}
+
+            ``next`` is the ``after`` to pass for the next page (or ``None``
+            if this is the last page). """
+        active_calls = self.edge.active_calls
+        call_ids = heapq.nsmallest(limit + 1, (
+            call_id for call_id in active_calls if call_id > after
+        ))
+        page = call_ids[:limit]
+        return {
+            "total": len(active_calls),
+            "calls": [
+                self._call_to_dict(call_id, active_calls[call_id])
+                for call_id in page
+            ],
+            "next": page[-1] if len(call_ids) > limit else None,
+        }
 
     def status(self):
         """ Returns some general status information. """
         api_calls = dict(self.edge.call_stats)
-        num_pending = len([
-            call for call in self.edge.active_calls
-            if not call.meta.get("time_in_queue")
-        ])
         api_calls.update({
-            "pending": num_pending,
-            "active": len(self.edge.active_calls) - num_pending,
+            "pending": self.edge._queued_calls,
+            "active": len(self.edge.active_calls),
         })
+        latency = dict(
+            (name, dict(
+                (kind, histogram.summary())
+                for (kind, histogram) in histograms.items()
+            ))
+            for (name, histograms) in self.edge.latency_histograms.items()
+        )
         return {
             "uptime": str(time.time() - self.TIME_STARTED),
             "api_calls": api_calls,
+            "latency": latency,
         }
 
+    def stage_timings(self, name=None):
+        """ Returns a breakdown of the time spent in each stage of handling
+            calls to method ``name`` (or to all methods, if ``name`` is
+            ``None``), if ``APIEdge.record_stages`` is enabled, as ``{name:
+            {stage: {"count": ..., "mean_ms": ..., "max_ms": ...}}}`` (see
+            ``CALL_STAGES`` for the stages). """
+        result = {}
+        for method_name, stages in self.edge.stage_timings.items():
+            if name is not None and method_name != name:
+                continue
+            result[method_name] = dict(
+                (stage, {
+                    "count": count,
+                    "mean_ms": round(total / count * 1000, 3),
+                    "max_ms": round(max_duration * 1000, 3),
+                })
+                for (stage, (count, total, max_duration)) in stages.items()
+            )
+        return result
+
+    def slow_calls(self, name=None):
+        """ Returns the most recent calls (to method ``name``, or to any
+            method if ``name`` is ``None``) which took longer than their
+            method's threshold (see ``APIEdge.slow_call_threshold``), newest
+            first. Each has the call's ``name``, ``peer``, the ``time`` it was
+            received, its total ``duration_ms``, whether it raised an
+            ``error``, a truncated ``args`` repr (note: this exposes argument
+            values; see ``APIEdge.slow_call_args_len``) and an ``args_hash``
+            of a longer (but bounded; see ``bounded_repr``) repr, so calls
+            with the same arguments can be grouped, the time spent in each of
+            its ``stages`` (if ``APIEdge.record_stages`` is enabled) and, if
+            the blocking detector fired during the call, the ``stack`` at
+            that point. """
+        result = []
+        for entry in reversed(self.edge.slow_calls):
+            if name is not None and entry["name"] != name:
+                continue
+            entry = dict(entry)
+            entry["peer"] = self._format_peer(entry["peer"])
+            timestamps = entry.pop("timestamps")
+            entry["stages"] = dict(
+                (stage, round((timestamps[end] - timestamps[start]) * 1000, 3))
+                for (stage, start, end) in CALL_STAGES
+                if timestamps and start in timestamps and end in timestamps
+            )
+            result.append(entry)
+        return result
+
+    def latency_histograms(self, name=None):
+        """ Returns the queue and execution time histograms of method
+            ``name`` (or of all methods, if ``name`` is ``None``) as
+            ``{name: {"queue": histogram, "execute": histogram}}``, where
+            each histogram can be loaded (and merged with the histograms from
+            other processes) using ``LatencyHistogram.from_dict``. """
+        return dict(
+            (method_name, dict(
+                (kind, histogram.to_dict())
+                for (kind, histogram) in histograms.items()
+            ))
+            for (method_name, histograms)
+            in self.edge.latency_histograms.items()
+            if name is None or method_name == name
+        )
+
+    def memoize_stats(self):
+        """ Returns the hit and miss counts and current size of the memoized
+            results of each method (see ``APIEdge.cached``), and, under
+            ``"coalesced"``, the number of coalesced calls which were run
+            (``leaders``) and shared (``followers``). """
+        result = {}
+        for name, stats in self.edge.memoize_stats.items():
+            result[name] = dict(stats)
+            result[name]["size"] = len(self.edge._memoized.get(name) or ())
+        result["coalesced"] = dict(self.edge._coalesced_calls.stats)
+        return result
+
+    def invalidate_cache(self, name=None):
+        """ Forgets the memoized results of method ``name`` (or of all
+            methods, if ``name`` is ``None``). """
+        self.edge.invalidate_memoized(name)
+
+    def api_stats(self):
+        """ Returns a list of the APIs this process has connected to through
+            ``settings.get_api``, with the number of calls made to each (see
+            ``DirtRunner.api_registry``). """
+        from dirt.runner import DirtRunner
+        stats = DirtRunner.api_registry.stats()
+        return [
+            dict(api_stats, api=api_name, url=url)
+            for ((api_name, url), api_stats) in sorted(stats.items())
+        ]
+
     def connection_status(self):
         """ Returns a description of all the active connection pools. """
         return rpc.status() # XXX: ``rpc`` not defined
@@ -147,17 +294,84 @@ class APIEdge(object):
     call_timeout = None
     max_concurrent_calls = 64
 
-    active_calls = []
-    call_stats = {
-        "completed": 0,
-        "errors": 0,
-    }
+    # The number of recent results of conditional methods which are kept so
+    # that deltas can be computed against them.
+    conditional_cache_size = 256
+
+    # The weight given to each call's duration in the moving average of call
+    # latency which is reported by ``get_load``.
+    latency_average_weight = 0.1
+
+    # Should ``get_load`` be sent to callers with each result?
+    report_load = True
+
+    # Should the time each call spends waiting for the call semaphore and
+    # executing be recorded in ``latency_histograms``?
+    record_latency = True
+
+    # Should the time spent in each stage of handling calls (reading,
+    # decoding, waiting, executing, serializing and sending; see
+    # ``CALL_STAGES``) be recorded in ``stage_timings``? Only supported by
+    # the drpc server.
+    record_stages = False
+
+    # Calls which take longer than this many seconds (from when they are
+    # received until they finish) are recorded in ``slow_calls`` (the
+    # threshold for individual methods can be set with ``slow_after``).
+    # ``None`` disables recording slow calls.
+    slow_call_threshold = 1.0
+
+    # The number of slow calls which are kept, and the length their
+    # arguments' repr is truncated to. Note that the arguments (which may
+    # include credentials or personal data) are then visible to anyone who
+    # can call ``debug.slow_calls``; ``None`` records only a fingerprint of
+    # them.
+    slow_calls_size = 100
+    slow_call_args_len = 200
 
     _call_semaphore = None
 
     def __init__(self, app, settings):
         self.app = app
         self.settings = settings
+        self._conditional_results = LRUCache(self.conditional_cache_size)
+        # call id -> call, for the calls which are in progress (see
+        # ``DebugAPI.active_calls``). Ids are assigned in the order calls
+        # start.
+        self.active_calls = {}
+        self._call_ids = itertools.count(1)
+        # ``memo_hits`` counts the completed calls which were answered with
+        # a memoized result (see ``cached``).
+        self.call_stats = {
+            "completed": 0,
+            "errors": 0,
+            "memo_hits": 0,
+        }
+        # method name -> {"queue": LatencyHistogram, "execute": ...} (see
+        # ``record_latency``)
+        self.latency_histograms = {}
+        # method name -> {stage: [count, total seconds, max seconds]} (see
+        # ``record_stages``)
+        self.stage_timings = {}
+        # The most recent slow calls (see ``slow_call_threshold``)
+        self.slow_calls = deque(maxlen=self.slow_calls_size)
+        # The number of calls waiting for the call semaphore
+        self._queued_calls = 0
+        self._latency_ms = 0.0
+        # method name -> LRUCache(args key -> (expires, result)) (see ``cached``)
+        self._memoized = {}
+        self.memoize_stats = {}
+        # Identical calls to ``coalesced`` (and ``cached``) methods which are
+        # in progress.
+        self._coalesced_calls = SingleFlight(
+            can_share=lambda result: not isiter(result),
+        )
+        # call name -> method, for the methods of singleton handlers (see
+        # ``handler_lifecycle`` and ``compile_handlers``)
+        self._dispatch = {}
+        # prefix -> handler, and peer -> {prefix -> handler}
+        self._singleton_handlers = {}
+        self._connection_handlers = {}
 
     def _get_call_semaphore(self, call):
         if call.name.startswith("debug."): # XXX A bit of a hack
@@ -171,8 +385,15 @@ class APIEdge(object):
         return self._call_semaphore
 
     def get_call_callable(self, call):
+        method = self._dispatch.get(call.name)
+        if method is not None:
+            return method
         handler, method_name = self.get_call_handler(call)
-        return self.get_call_handler_method(call, handler, method_name)
+        method = self.get_call_handler_method(call, handler, method_name)
+        prefix = call.name.rpartition(".")[0]
+        if self._singleton_handlers.get(prefix) is handler:
+            self._dispatch[call.name] = method
+        return method
 
     def get_call_handler(self, call):
         """ Returns a tuple of ``(handler, method_name)``, where ``handler``
@@ -180,13 +401,74 @@ class APIEdge(object):
             have a method ``method_name``. Mapping the ``method_name`` to
             a concrete method is done by ``get_call_handler_method``. """
         prefix, _, method_name = call.name.rpartition(".")
+        handler = self._singleton_handlers.get(prefix)
+        if handler is None:
+            handler = self._get_handler(prefix, call)
+        return (handler, method_name)
+
+    def get_handler_callable(self, prefix):
+        """ Returns the callable registered in ``app.api_handlers`` for
+            ``prefix``, which is called with ``(edge, call)`` to create a
+            handler. """
         handler_callable = self.app.api_handlers.get(prefix, None)
         if not handler_callable:
             raise ValueError("no handlers registered on %r for %r"
                              %(self.app, prefix))
         if isinstance(handler_callable, basestring):
             handler_callable = getattr(self.app, handler_callable)
-        return (handler_callable(self, call), method_name)
+        return handler_callable
+
+    def _get_handler(self, prefix, call):
+        """ Returns the handler for ``prefix``, creating it (or re-using an
+            existing one) according to its lifecycle (see
+            ``handler_lifecycle``). """
+        handler_callable = self.get_handler_callable(prefix)
+        lifecycle = getattr(handler_callable, "_handler_lifecycle", None)
+        if lifecycle == "singleton":
+            handler = handler_callable(self, None)
+            self._singleton_handlers[prefix] = handler
+            return handler
+        if lifecycle == "connection" and call.peer is not None:
+            handlers = self._connection_handlers.setdefault(call.peer, {})
+            if prefix not in handlers:
+                handlers[prefix] = handler_callable(self, call)
+            return handlers[prefix]
+        return handler_callable(self, call)
+
+    def compile_handlers(self):
+        """ Creates the singleton handlers (see ``handler_lifecycle``) and
+            fills the dispatch table with their methods, so calls to them are
+            looked up with a single ``dict`` access. Called when the edge
+            starts serving; any existing handlers are discarded first, so it
+            can be called again (ex, after ``app.api_handlers`` has been
+            changed) to rebuild the table. """
+        self.reset_handlers()
+        for prefix in self.app.api_handlers:
+            handler_callable = self.get_handler_callable(prefix)
+            lifecycle = getattr(handler_callable, "_handler_lifecycle", None)
+            if lifecycle != "singleton":
+                continue
+            handler = self._get_handler(prefix, None)
+            for method_name in dir(handler):
+                if method_name.startswith("_"):
+                    continue
+                name = prefix and prefix + "." + method_name or method_name
+                method = self.get_call_handler_method(Call(name), handler,
+                                                      method_name)
+                if callable(method):
+                    self._dispatch[name] = method
+
+    def reset_handlers(self):
+        """ Discards the singleton and per-connection handlers and the
+            dispatch table; they will be re-created as they are needed. """
+        self._dispatch.clear()
+        self._singleton_handlers.clear()
+        self._connection_handlers.clear()
+
+    def connection_closed(self, peer):
+        """ Called by the server when the connection from ``peer`` has been
+            closed, to discard its per-connection handlers. """
+        self._connection_handlers.pop(peer, None)
 
     def get_call_handler_method(self, call, handler, method_name):
         """ Returns the callable method of ``handler``, looked up using
@@ -202,8 +484,73 @@ class APIEdge(object):
     def execute(self, call):
         """ Calls a method for an RPC call (part of ``ConnectionHandler``'s
             ``call_handler`` interface).
+
+            If ``report_load`` is true, the current load (see ``get_load``) is
+            returned to the caller in the ``load`` header of the result.
             """
+        try:
+            return self._execute(call)
+        finally:
+            if self.report_load:
+                call.result_headers["load"] = self.get_load()
+
+    def get_load(self):
+        """ Returns a compact summary of this edge's load: ``[active, queued,
+            latency_ms]``, where ``active`` is the number of calls in
+            progress, ``queued`` the number waiting for the call semaphore and
+            ``latency_ms`` a moving average of recent call durations. """
+        active = len(self.active_calls)
+        return [active, self._queued_calls, int(self._latency_ms)]
+
+    def _execute(self, call):
         callable = self.get_call_callable(call)
+        if call.timestamps is not None:
+            # Only calls to methods which exist have their stages recorded
+            # (see ``call_finished``)
+            call.timestamps["resolved"] = monotonic()
+        memoize = getattr(callable, "_memoize", None)
+        if not isinstance(memoize, dict):
+            memoize = None
+        coalesce = (
+            getattr(callable, "_coalesce", None) is True or
+            memoize is not None
+        )
+        if coalesce:
+            args_key = call_key(call.args, call.kwargs)
+            if args_key is None:
+                # The arguments can't be compared safely, so the result
+                # can't be shared with (or remembered for) other calls.
+                memoize = None
+                coalesce = False
+        if memoize is not None:
+            time_started = time.time()
+            memoized = self.get_memoized(call.name, args_key)
+            if memoized is not None:
+                # Memoized results don't go through ``call_callable``, so
+                # count them here.
+                self.call_stats["completed"] += 1
+                self.call_stats["memo_hits"] += 1
+                if self.record_latency:
+                    self.record_call_latency(call, time_started, time.time())
+                return self.prepare_result(call, callable, memoized[0])
+
+        if coalesce:
+            result, _ = self._coalesced_calls.call(
+                (call.name, args_key), self.call_callable, call, callable,
+            )
+        else:
+            result = self.call_callable(call, callable)
+
+        if isiter(result):
+            return result
+        if memoize is not None:
+            self.set_memoized(call.name, args_key, result, **memoize)
+        return self.prepare_result(call, callable, result)
+
+    def call_callable(self, call, callable):
+        """ Calls ``callable`` with the arguments of ``call``, applying the
+            call timeout and concurrent call limit. Generator results are
+            wrapped so they are tracked until they are exhausted. """
         timeout = None
         if self.call_timeout is not None:
             timeout = Timeout(getattr(callable, "_timeout", self.call_timeout))
@@ -213,12 +560,38 @@ class APIEdge(object):
             log.warning("too many concurrent callers (%r); call %r will block",
                         self.max_concurrent_calls, call)
 
-        call_semaphore.acquire()
+        self._queued_calls += 1
+        try:
+            call_semaphore.acquire()
+        finally:
+            self._queued_calls -= 1
+        time_started = call.time_started = time.time()
+        timestamps = call.timestamps
+        if timestamps is not None:
+            timestamps["started"] = monotonic()
+        call_id = next(self._call_ids)
         def finished_callback(is_error):
-            self.active_calls.remove(call)
+            if timestamps is not None:
+                timestamps["finished"] = monotonic()
+            self.active_calls.pop(call_id, None)
             self.call_stats["completed"] += 1
             if is_error:
                 self.call_stats["errors"] += 1
+            time_finished = time.time()
+            if self.record_latency:
+                self.record_call_latency(call, time_started, time_finished)
+            threshold = getattr(callable, "_slow_call_threshold",
+                                self.slow_call_threshold)
+            if (
+                isinstance(threshold, (int, long, float)) and
+                time_finished - call.time_received > threshold
+            ):
+                self.record_slow_call(call, time_started, time_finished,
+                                      is_error)
+            duration_ms = (time_finished - time_started) * 1000
+            self._latency_ms += (
+                (duration_ms - self._latency_ms) * self.latency_average_weight
+            )
             call_semaphore.release()
             if timeout is not None:
                 timeout.cancel()
@@ -228,9 +601,7 @@ class APIEdge(object):
         try:
             if timeout is not None:
                 timeout.start()
-            time_in_queue = time.time() - call.meta.get("time_received", 0)
-            call.meta["time_in_queue"] = time_in_queue
-            self.active_calls.append(call)
+            self.active_calls[call_id] = call
             result = callable(*call.args, **call.kwargs)
             if isiter(result):
                 result = self.wrap_generator_result(call, result,
@@ -240,7 +611,140 @@ class APIEdge(object):
         finally:
             if not result_is_generator:
                 finished_callback(is_error=got_err)
+        return result
+
+    def record_call_latency(self, call, time_started, time_finished):
+        """ Records the time ``call`` spent waiting to start and executing in
+            the histograms for its method. """
+        histograms = self.latency_histograms.get(call.name)
+        if histograms is None:
+            histograms = {
+                "queue": LatencyHistogram(),
+                "execute": LatencyHistogram(),
+            }
+            self.latency_histograms[call.name] = histograms
+        histograms["queue"].record(time_started - call.time_received)
+        histograms["execute"].record(time_finished - time_started)
+
+    def record_slow_call(self, call, time_started, time_finished, is_error):
+        """ Adds ``call`` to ``slow_calls``. Called from the greenlet which
+            ran the call, so the stack recorded by the blocking detector (if
+            it fired during the call) can be included. """
+        # Note: the arguments may be arbitrarily large, so only a bounded
+        # repr of them is built (and fingerprinted).
+        args_repr = bounded_repr((call.args, sorted(call.kwargs.items())))
+        args_len = self.slow_call_args_len
+        blocking_detected = getattr(gevent.getcurrent(), "blocking_detected",
+                                    None)
+        stack = None
+        if blocking_detected is not None and \
+                blocking_detected[0] >= time_started:
+            stack = blocking_detected[1]
+        self.slow_calls.append({
+            "name": call.name,
+            "peer": call.peer,
+            "time": call.time_received,
+            "duration_ms": round((time_finished - call.time_received) * 1000,
+                                 3),
+            "error": is_error,
+            "args": (
+                None if args_len is None else
+                truncate(args_repr, max_len=args_len)
+            ),
+            "args_hash": hashlib.md5(args_repr).hexdigest()[:12],
+            # Note: a reference is kept so that the stages which finish
+            # after this (ex, sending the result) are included.
+            "timestamps": call.timestamps,
+            "stack": stack,
+        })
+
+    def call_finished(self, call):
+        """ Called by the server once the result of ``call`` has been sent
+            (if ``record_stages`` is enabled) to record the time spent in
+            each stage of handling it. Calls which didn't resolve to a method
+            aren't recorded, so calls to arbitrary names can't grow
+            ``stage_timings`` without bound. """
+        timestamps = call.timestamps
+        if not timestamps or "resolved" not in timestamps:
+            return
+        stages = self.stage_timings.get(call.name)
+        if stages is None:
+            stages = self.stage_timings[call.name] = {}
+        for stage, start, end in CALL_STAGES:
+            if start not in timestamps or end not in timestamps:
+                continue
+            duration = timestamps[end] - timestamps[start]
+            stats = stages.get(stage)
+            if stats is None:
+                stats = stages[stage] = [0, 0.0, 0.0]
+            stats[0] += 1
+            stats[1] += duration
+            if duration > stats[2]:
+                stats[2] = duration
+
+    def prepare_result(self, call, callable, result):
+        """ Applies the options set by the ``cacheable`` and ``conditional``
+            decorators to the (non-generator) ``result`` of ``call``. """
+        cache_ttl = getattr(callable, "_cache_ttl", None)
+        if isinstance(cache_ttl, (int, long, float)):
+            call.result_headers["ttl"] = cache_ttl
+        is_conditional = getattr(callable, "_conditional", None) is True
+        if is_conditional:
+            result = self.conditional_result(call, result)
+        return result
+
+    def get_memoized(self, name, key):
+        """ Returns ``(result, )`` if there is an unexpired memoized result
+            for ``key`` of method ``name``, otherwise ``None``. """
+        stats = self.memoize_stats.setdefault(name, {"hits": 0, "misses": 0})
+        cache = self._memoized.get(name)
+        entry = cache and cache.get(key)
+        if entry is not None:
+            expires, result = entry
+            if expires is None or expires > time.time():
+                stats["hits"] += 1
+                return (result, )
+            cache.pop(key)
+        stats["misses"] += 1
+        return None
+
+    def set_memoized(self, name, key, result, ttl=None, max_entries=None):
+        cache = self._memoized.get(name)
+        if cache is None:
+            cache = LRUCache(max_entries)
+            self._memoized[name] = cache
+        expires = None if ttl is None else time.time() + ttl
+        cache[key] = (expires, result)
+
+    def invalidate_memoized(self, name=None):
+        """ Forgets the memoized results of method ``name`` (or of all
+            methods, if ``name`` is ``None``). """
+        if name is None:
+            self._memoized.clear()
+        else:
+            self._memoized.pop(name, None)
+
+    def conditional_result(self, call, result):
+        """ Tags ``result`` with an ``etag`` (in ``call.result_headers``) and,
+            if the caller sent the ``etag`` of a result it already has,
+            returns either ``None`` (with the ``nm`` header set, if the result
+            has not been modified) or a list of ``dirt.misc.delta.diff``
+            operations (with the ``delta`` header set to the base ``etag``),
+            if that will be smaller than the full result. """
+        result_etag = etag(result)
+        call.result_headers["etag"] = result_etag
+        peer_etag = call.headers.get("etag")
+        if peer_etag == result_etag:
+            call.result_headers["nm"] = True
+            return None
 
+        self._conditional_results[result_etag] = copy.deepcopy(result)
+        base = peer_etag and self._conditional_results.get(peer_etag)
+        if base is not None:
+            ops = diff(base, result)
+            if ops is not None and len(ops) <= len(result) // 2:
+                call.result_headers["delta"] = peer_etag
+                return ops
         return result
 
     def wrap_generator_result(self, call, result, finished_callback):
@@ -254,6 +758,54 @@ class APIEdge(object):
         finally:
             finished_callback(is_error=got_err)
 
+    HANDLER_LIFECYCLES = ("call", "connection", "singleton")
+
+    @classmethod
+    def handler_lifecycle(cls, lifecycle):
+        """ Decorates an API handler (a class or app method which is listed in
+            ``DirtApp.api_handlers``), telling ``APIEdge`` how long the
+            handlers it creates should be used for:
+
+            - ``"call"`` (default): a new handler is created for each call.
+            - ``"connection"``: a handler is created with the first call from
+              each connection and discarded when the connection is closed.
+            - ``"singleton"``: one handler is created (with ``call=None``)
+              when the edge starts serving, and its methods are used for all
+              calls without any further lookups.
+
+            Handlers which are used for more than one call must not keep a
+            reference to the call they were created with. For example::
+
+                @APIEdge.handler_lifecycle("singleton")
+                class CatalogAPI(object):
+                    def __init__(self, edge, call):
+                        self.db = edge.app.db
+            """
+        if lifecycle not in cls.HANDLER_LIFECYCLES:
+            raise ValueError("invalid handler lifecycle %r (expected one of "
+                             "%r)" %(lifecycle, cls.HANDLER_LIFECYCLES))
+        def handler_lifecycle_helper(f):
+            f._handler_lifecycle = lifecycle
+            return f
+        return handler_lifecycle_helper
+
+    @classmethod
+    def slow_after(cls, seconds):
+        """ Decorates a function, telling ``APIEdge`` to record calls to it
+            in the slow call log (see ``DebugAPI.slow_calls``) if they take
+            longer than ``seconds`` (instead of ``slow_call_threshold``;
+            ``None`` disables recording them)::
+
+                class ReportsAPI(object):
+                    @APIEdge.slow_after(30)
+                    def monthly_report(self, month):
+                        ...
+            """
+        def slow_after_helper(f):
+            f._slow_call_threshold = seconds
+            return f
+        return slow_after_helper
+
     @classmethod
     def no_timeout(cls, f):
         """ Decorates a function function, telling ``APIEdge`` that a timeout
@@ -262,9 +814,75 @@ class APIEdge(object):
         f._timeout = None
         return f
 
+    @classmethod
+    def conditional(cls, f):
+        """ Decorates a function, telling ``APIEdge`` that its results should
+            be tagged with an ``etag`` so that callers which poll it (ex,
+            using ``ClientWrapper``) will only be sent a "not modified" marker
+            or a delta when the result has not changed (much). Intended for
+            cheap, frequently polled methods which return ``dict``s; methods
+            whose results change on every call (ex, ``debug.status``, which
+            includes the uptime and call counts) gain nothing from it. """
+        f._conditional = True
+        return f
+
+    @classmethod
+    def cacheable(cls, ttl):
+        """ Decorates a function, telling ``APIEdge`` that its results may be
+            cached by callers for ``ttl`` seconds (ex, by ``ClientWrapper``,
+            which will serve repeat calls with the same arguments locally).
+            Intended for idempotent methods whose results change rarely::
+
+                class CatalogAPI(object):
+                    @APIEdge.cacheable(ttl=60)
+                    def get_product(self, product_id):
+                        ...
+            """
+        def cacheable_helper(f):
+            f._cache_ttl = ttl
+            return f
+        return cacheable_helper
+
+    @classmethod
+    def cached(cls, ttl=None, max_entries=128):
+        """ Decorates a function, telling ``APIEdge`` to memoize its results:
+            calls with the same arguments are answered from an LRU cache of
+            ``max_entries`` results (per method) for ``ttl`` seconds (or until
+            they are invalidated, if ``ttl`` is ``None``) without running the
+            method or waiting for the call semaphore. Memoized results are
+            shared between callers, so they must not be modified. Concurrent
+            calls which miss the cache are coalesced (see ``coalesced``).
+            Calls whose arguments can't be compared (see
+            ``dirt.rpc.common.call_key``) always run the method.
+
+            Hit and miss counts are available from ``debug.memoize_stats``,
+            and results can be invalidated with ``debug.invalidate_cache``. """
+        def cached_helper(f):
+            f._memoize = {"ttl": ttl, "max_entries": max_entries}
+            return f
+        return cached_helper
+
+    @classmethod
+    def coalesced(cls, f):
+        """ Decorates a function, telling ``APIEdge`` that identical calls
+            (same method and arguments) which arrive while one is already in
+            progress should wait for and share its result instead of running
+            the method again. Only suitable for methods without side effects
+            whose results are not modified by the caller.
+
+            The number of calls which ran and which were shared is available
+            from ``debug.memoize_stats``. """
+        f._coalesce = True
+        return f
+
     def serve_forever(self):
+        self.compile_handlers()
         ServerCls = rpc.get_server_cls(self.settings.bind_url)
-        server = ServerCls(self.settings.bind_url, self.execute)
+        server = ServerCls(
+            self.settings.bind_url, self.execute,
+            connection_closed=self.connection_closed,
+            call_finished=self.record_stages and self.call_finished or None,
+        )
         server.serve_forever()
 
 
@@ -375,6 +993,8 @@ class DirtApp(object):
             log.exception("error encountered while trying to run %r:",
                           self.app_name)
             return 1
+        finally:
+            self.shutdown()
 
     def serve(self):
         log.info("binding to %s..." %(self.settings.bind_url, ))
@@ -428,6 +1048,17 @@ class DirtApp(object):
 
             Subclasses can implement this method without calling super(). """
 
+    def shutdown(self):
+        """ Called when the app exits (normally or because of an error) to
+            clean up; sends any fire-and-forget calls which are still waiting
+            to be batched.
+
+            Subclasses which implement this method should call super(). """
+        try:
+            rpc.flush_batched_calls()
+        except Exception:
+            log.exception("error flushing batched calls:")
+
     def get_api(self, edge, call):
         raise Exception("Subclasses must implement the 'get_api' method.")
 
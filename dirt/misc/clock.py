@@ -0,0 +1,68 @@
+""" A monotonic clock, for measuring durations.
+
+    Unlike ``time.time``, ``monotonic()`` is never adjusted (ex, by NTP), so
+    the difference between two of its values is always the time which passed
+    between them. Its values are only meaningful relative to each other::
+
+        >>> start = monotonic()
+        >>> monotonic() - start >= 0
+        True
+        >>>
+
+    ``time.monotonic`` is used if it's available (Python 3.3+), then the
+    ``monotonic`` package, then ``clock_gettime(CLOCK_MONOTONIC)`` (through
+    ``ctypes``, on Linux), and finally ``time.time``, in which case
+    ``IS_MONOTONIC`` will be ``False``.
+    """
+import sys
+import time
+
+IS_MONOTONIC = True
+
+def _clock_gettime_monotonic():
+    import ctypes
+    import ctypes.util
+
+    class timespec(ctypes.Structure):
+        _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+    CLOCK_MONOTONIC = 1 # from <linux/time.h>
+    for name in ["c", "rt"]:
+        # Note: before glibc 2.17, ``clock_gettime`` is in librt
+        path = ctypes.util.find_library(name)
+        if path is None:
+            continue
+        clock_gettime = getattr(ctypes.CDLL(path, use_errno=True),
+                                "clock_gettime", None)
+        if clock_gettime is not None:
+            break
+    else:
+        return None
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    ts = timespec()
+    ts_ref = ctypes.byref(ts)
+
+    def monotonic():
+        if clock_gettime(CLOCK_MONOTONIC, ts_ref) != 0:
+            raise OSError(ctypes.get_errno(), "clock_gettime failed")
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+
+    return monotonic
+
+try:
+    from time import monotonic
+except ImportError:
+    try:
+        from monotonic import monotonic
+    except ImportError:
+        monotonic = None
+        if sys.platform.startswith("linux"):
+            monotonic = _clock_gettime_monotonic()
+        if monotonic is None:
+            IS_MONOTONIC = False
+            monotonic = time.time
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
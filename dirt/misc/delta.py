@@ -0,0 +1,77 @@
+""" Helpers for versioning values and computing structural differences
+    between them (used by conditional RPC calls). """
+import hashlib
+
+def etag(value):
+    """ Returns a short, cheap version tag for ``value``.
+
+        Equal values will (almost always) have equal tags; two values which
+        happen to produce different tags will simply be treated as different.
+
+        >>> etag({"a": 1}) == etag({"a": 1})
+        True
+        >>> etag({"a": 1}) == etag({"a": 2})
+        False
+        """
+    return hashlib.md5(repr(value)).hexdigest()[:16]
+
+def diff(old, new, _path=None):
+    """ Returns a list of operations which will turn ``old`` into ``new``
+        when applied with ``patch``, or ``None`` if the values can't be
+        structurally compared (currently only ``dict``s can be)::
+
+            >>> diff({"a": 1, "b": 2}, {"a": 1, "b": 3, "c": 4})
+            [['s', ['b'], 3], ['s', ['c'], 4]]
+            >>> diff({"a": {"x": 1}}, {"a": {"y": 2}})
+            [['s', ['a', 'y'], 2], ['d', ['a', 'x']]]
+            >>> diff([1], [2]) is None
+            True
+
+        Operations are lists (rather than tuples) so they survive a round trip
+        through serializers which don't preserve tuples. """
+    if not (isinstance(old, dict) and isinstance(new, dict)):
+        return None
+    path = _path or []
+    ops = []
+    for key in sorted(new):
+        new_val = new[key]
+        if key not in old:
+            ops.append(["s", path + [key], new_val])
+            continue
+        old_val = old[key]
+        if old_val == new_val:
+            continue
+        sub_ops = diff(old_val, new_val, path + [key])
+        if sub_ops is None:
+            ops.append(["s", path + [key], new_val])
+        else:
+            ops.extend(sub_ops)
+    for key in sorted(old):
+        if key not in new:
+            ops.append(["d", path + [key]])
+    return ops
+
+def patch(value, ops):
+    """ Applies ``ops`` (as returned by ``diff``) to ``value`` in place,
+        returning ``value``.
+
+        >>> patch({"a": 1}, [["s", ["b"], 2], ["d", ["a"]]])
+        {'b': 2}
+        """
+    for op in ops:
+        action, path = op[0], op[1]
+        target = value
+        for key in path[:-1]:
+            target = target[key]
+        if action == "s":
+            target[path[-1]] = op[2]
+        elif action == "d":
+            del target[path[-1]]
+        else:
+            raise ValueError("invalid patch operation: %r" %(op, ))
+    return value
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
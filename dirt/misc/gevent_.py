@@ -1,10 +1,12 @@
 import sys
+import time
 import signal
 import logging
 import traceback
 
 import gevent
 from gevent.hub import get_hub
+from gevent.event import AsyncResult
 
 log = logging.getLogger(__name__)
 
@@ -88,6 +90,78 @@ def getany_and_join(greenlets):
     return finished.value
 
 
+class SingleFlight(object):
+    """ Coalesces concurrent calls which have the same key: while one
+        greenlet (the "leader") is running ``func`` for some key, other
+        greenlets which call with the same key wait for and share its result
+        (or exception) instead of running ``func`` themselves.
+
+        ``can_share(result)`` can be used to prevent results which can't be
+        shared (ex, generators) from being given to the waiting greenlets,
+        which will then each run ``func`` themselves. This is also done if
+        the leader is interrupted (ex, by a ``Timeout`` or ``GreenletExit``).
+
+        For example::
+
+            >>> flights = SingleFlight()
+            >>> def get(key):
+            ...     gevent.sleep(0.01)
+            ...     return [key]
+            >>> greenlets = [gevent.spawn(flights.call, "k", get, "k")
+            ...              for _ in range(3)]
+            >>> [g.get() for g in greenlets]
+            [(['k'], False), (['k'], True), (['k'], True)]
+            >>> sorted(flights.stats.items())
+            [('followers', 2), ('leaders', 1)]
+        """
+
+    _not_shared = object()
+
+    def __init__(self, can_share=None):
+        self.can_share = can_share
+        self.stats = {
+            "leaders": 0,
+            "followers": 0,
+        }
+        self._flights = {}
+
+    def __contains__(self, key):
+        return key in self._flights
+
+    def call(self, key, func, *args, **kwargs):
+        """ Returns ``(result, shared)``, where ``shared`` is ``True`` if
+            ``result`` came from another greenlet's call (in which case the
+            caller may want to copy it before modifying it). """
+        flight = self._flights.get(key)
+        while flight is not None:
+            result = flight.get()
+            if result is not self._not_shared:
+                self.stats["followers"] += 1
+                return result, True
+            flight = self._flights.get(key)
+
+        self.stats["leaders"] += 1
+        flight = AsyncResult()
+        self._flights[key] = flight
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            # Note: ``set_exception`` only accepts ``exc_info`` from gevent
+            # 1.1, so the followers only get the exception itself.
+            flight.set_exception(sys.exc_info()[1])
+            raise
+        except BaseException:
+            flight.set(self._not_shared)
+            raise
+        finally:
+            del self._flights[key]
+        if self.can_share is not None and not self.can_share(result):
+            flight.set(self._not_shared)
+        else:
+            flight.set(result)
+        return result, False
+
+
 class BlockingDetector(object):
     """ Use operating system signals to detect blocking threads.
 
@@ -121,6 +195,10 @@ class BlockingDetector(object):
     one log message will be written until the blocking thread yields, at which
     point the alarm will be reset.
 
+    When blocking is detected, ``(time.time(), stack)`` is also stored in the
+    ``blocking_detected`` attribute of the blocking greenlet, so code running
+    in it can find out where it blocked (see ``APIEdge.slow_calls``).
+
     Note: ``BlockingDetector`` overwrites the ``signal.SIGALRM`` handler, and
     does not attempt to save the previous value.
 
@@ -157,8 +235,10 @@ class BlockingDetector(object):
             self.clear_signal()
 
     def alarm_handler(self, signum, frame):
+        stack = "".join(traceback.format_stack(frame))
         log.warning("blocking detected after timeout=%r; stack:\n%s",
-                    self.timeout, "".join(traceback.format_stack(frame)))
+                    self.timeout, stack)
+        gevent.getcurrent().blocking_detected = (time.time(), stack)
         if self.aggressive:
             self.reset_signal()
         if self.raise_exc:
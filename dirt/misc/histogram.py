@@ -0,0 +1,145 @@
+""" Fixed-size, mergeable latency histograms.
+
+    Values are counted in log-linear buckets (as in HdrHistogram): values
+    below ``2 ** (precision + 1)`` each have their own bucket, and above that
+    each power of two is split into ``2 ** precision`` equal buckets, so
+    every value is recorded with a relative error of at most
+    ``2 ** -precision`` (6.25% with the default ``precision`` of 4) using a
+    fixed number of buckets.
+
+    For example::
+
+        >>> h = LatencyHistogram()
+        >>> for ms in range(1, 101):
+        ...     h.record(ms / 1000.0)
+        >>> h.count, h.percentile(50), h.percentile(99), h.max
+        (100, 0.051199, 0.1, 0.1)
+        >>> other = LatencyHistogram.from_dict(h.to_dict())
+        >>> other.merge(h).count
+        200
+        >>>
+    """
+from array import array
+
+
+class LatencyHistogram(object):
+    """ Counts durations (in seconds, recorded with microsecond resolution)
+        of up to ``2 ** max_bits`` microseconds (about 19 hours, by default;
+        longer durations are counted as the maximum) with a relative error of
+        at most ``2 ** -precision``. """
+
+    def __init__(self, precision=4, max_bits=36):
+        self.precision = precision
+        self.max_bits = max_bits
+        self._sub_buckets = 1 << precision
+        self._max_value = (1 << max_bits) - 1
+        self.counts = array("L", [0]) * (self._index(self._max_value) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def _index(self, value):
+        shift = value.bit_length() - self.precision - 1
+        if shift <= 0:
+            return value
+        return shift * self._sub_buckets + (value >> shift)
+
+    def _highest_value(self, index):
+        """ Returns the highest value which is counted in bucket ``index``. """
+        shift = index // self._sub_buckets - 1
+        if shift <= 0:
+            return index
+        mantissa = index - shift * self._sub_buckets
+        return ((mantissa + 1) << shift) - 1
+
+    def record(self, duration):
+        """ Counts a ``duration`` (in seconds). """
+        value = min(max(int(duration * 1000000), 0), self._max_value)
+        self.counts[self._index(value)] += 1
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+
+    def percentile(self, percentile):
+        """ Returns the duration (in seconds) which ``percentile`` percent of
+            the recorded durations are less than or equal to (to within the
+            histogram's precision), or ``None`` if nothing has been recorded.
+            """
+        if not self.count:
+            return None
+        target = max(1, int(self.count * percentile / 100.0 + 0.5))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return min(self._highest_value(index) / 1000000.0, self.max)
+        return self.max
+
+    def summary(self):
+        """ Returns the ``count``, ``mean``, ``p50``, ``p90``, ``p99`` and
+            ``max`` durations, in milliseconds. """
+        if not self.count:
+            return {"count": 0}
+        ms = lambda seconds: round(seconds * 1000, 3)
+        return {
+            "count": self.count,
+            "mean": ms(self.total / self.count),
+            "p50": ms(self.percentile(50)),
+            "p90": ms(self.percentile(90)),
+            "p99": ms(self.percentile(99)),
+            "max": ms(self.max),
+        }
+
+    def merge(self, other):
+        """ Adds the counts from ``other`` (which must have the same
+            ``precision`` and ``max_bits``) to this histogram, and returns
+            this histogram. """
+        if (other.precision, other.max_bits) != (self.precision, self.max_bits):
+            raise ValueError("can't merge histograms with different "
+                             "precisions (%r and %r)" %(self, other))
+        counts = self.counts
+        for index, count in enumerate(other.counts):
+            if count:
+                counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        return self
+
+    def to_dict(self):
+        """ Returns a compact, serializable (ex, with BSON or JSON)
+            representation of this histogram, which can be turned back into a
+            histogram with ``from_dict`` (ex, to merge the histograms from
+            several processes). Only non-empty buckets are included. """
+        return {
+            "precision": self.precision,
+            "max_bits": self.max_bits,
+            "count": self.count,
+            "total": self.total,
+            "max": self.max,
+            "counts": [
+                [index, count] for (index, count) in enumerate(self.counts)
+                if count
+            ],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        histogram = cls(precision=data["precision"], max_bits=data["max_bits"])
+        for index, count in data["counts"]:
+            histogram.counts[index] = count
+        histogram.count = data["count"]
+        histogram.total = data["total"]
+        histogram.max = data["max"]
+        return histogram
+
+    def __repr__(self):
+        return "<%s count=%s precision=%s>" %(
+            type(self).__name__, self.count, self.precision,
+        )
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,67 @@
+from collections import OrderedDict
+
+class LRUCache(object):
+    """ A simple size-bounded mapping which evicts the least recently used
+        item when it grows beyond ``max_size`` items.
+
+        >>> cache = LRUCache(max_size=2)
+        >>> cache["a"] = 1
+        >>> cache["b"] = 2
+        >>> cache.get("a")
+        1
+        >>> cache["c"] = 3
+        >>> sorted(cache.keys())
+        ['a', 'c']
+        >>>
+        """
+
+    _missing = object()
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = OrderedDict()
+
+    def get(self, key, default=None):
+        value = self._items.pop(key, self._missing)
+        if value is self._missing:
+            return default
+        self._items[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self._items.pop(key, None)
+        self._items[key] = value
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def __getitem__(self, key):
+        value = self.get(key, self._missing)
+        if value is self._missing:
+            raise KeyError(key)
+        return value
+
+    def __delitem__(self, key):
+        del self._items[key]
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def pop(self, key, default=None):
+        return self._items.pop(key, default)
+
+    def keys(self):
+        return self._items.keys()
+
+    def clear(self):
+        self._items.clear()
+
+    def __repr__(self):
+        return "<%s %s/%s>" %(type(self).__name__, len(self), self.max_size)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
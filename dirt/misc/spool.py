@@ -0,0 +1,123 @@
+import mmap
+import struct
+import tempfile
+import cPickle
+
+class SpooledList(object):
+    """ An append-only sequence which stores its items serialized, keeping
+        them in memory until their total size exceeds ``max_size`` bytes, after
+        which they are spilled to a temporary file which is read through
+        ``mmap``.
+
+        >>> items = SpooledList(max_size=16)
+        >>> for x in range(5):
+        ...     items.append({"x": x})
+        >>> items.spooled
+        True
+        >>> items[3]
+        {'x': 3}
+        >>> len(items), list(items)[-1]
+        (5, {'x': 4})
+        >>>
+
+        ``dumps`` and ``loads`` can be used to customize serialization
+        (default: ``cPickle`` protocol 2). """
+
+    _length = struct.Struct("<I")
+
+    def __init__(self, max_size, dumps=None, loads=None):
+        self.max_size = max_size
+        self._dumps = dumps or (lambda item: cPickle.dumps(item, 2))
+        self._loads = loads or cPickle.loads
+        self._memory = []
+        self._memory_size = 0
+        self._file = None
+        self._file_size = 0
+        self._offsets = []
+        self._mmap = None
+
+    @property
+    def spooled(self):
+        return self._file is not None
+
+    def append(self, item):
+        data = self._dumps(item)
+        if self._file is None:
+            self._memory.append(data)
+            self._memory_size += len(data)
+            if self._memory_size > self.max_size:
+                self._spill()
+            return
+        self._write(data)
+
+    def extend(self, items):
+        for item in items:
+            self.append(item)
+
+    def _spill(self):
+        self._file = tempfile.TemporaryFile(prefix="dirt-spool-")
+        for data in self._memory:
+            self._write(data)
+        self._memory = []
+        self._memory_size = 0
+
+    def _write(self, data):
+        self._close_mmap()
+        self._file.write(self._length.pack(len(data)))
+        self._file.write(data)
+        self._offsets.append(self._file_size)
+        self._file_size += self._length.size + len(data)
+
+    def _close_mmap(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def _get_mmap(self):
+        if self._mmap is None:
+            self._file.flush()
+            self._mmap = mmap.mmap(self._file.fileno(), self._file_size,
+                                   access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def _get_data(self, idx):
+        if self._file is None:
+            return self._memory[idx]
+        offset = self._offsets[idx]
+        data = self._get_mmap()
+        start = offset + self._length.size
+        length = self._length.unpack(data[offset:start])[0]
+        return data[start:start + length]
+
+    def __len__(self):
+        if self._file is None:
+            return len(self._memory)
+        return len(self._offsets)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in xrange(*idx.indices(len(self)))]
+        return self._loads(self._get_data(idx))
+
+    def __iter__(self):
+        for idx in xrange(len(self)):
+            yield self[idx]
+
+    def close(self):
+        """ Releases the temporary file (if one is being used). """
+        self._close_mmap()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._offsets = []
+            self._file_size = 0
+
+    def __repr__(self):
+        return "<%s len=%s spooled=%r>" %(
+            type(self).__name__, len(self), self.spooled,
+        )
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
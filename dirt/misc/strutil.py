@@ -1,10 +1,46 @@
 import textwrap
+from repr import Repr
 
 def truncate(s, max_len=80):
     if len(s) > max_len:
         return s[:max_len - 3] + "..."
     return s
 
+
+class _BoundedRepr(Repr):
+    """ A ``Repr`` which also limits ``unicode`` and ``bytearray`` values,
+        instead of building their full repr. """
+
+    def repr_unicode(self, x, level):
+        return self.repr_str(x, level)
+
+    repr_bytearray = repr_unicode
+
+
+_bounded_repr = _BoundedRepr()
+_bounded_repr.maxlevel = 4
+_bounded_repr.maxstring = 256
+_bounded_repr.maxother = 256
+_bounded_repr.maxlong = 64
+for _attr in ["maxtuple", "maxlist", "maxarray", "maxdict", "maxset",
+              "maxfrozenset", "maxdeque"]:
+    setattr(_bounded_repr, _attr, 32)
+
+def bounded_repr(obj):
+    """ Returns a repr of ``obj`` which only includes the start and end of
+        long strings, the first few items of large containers and the first
+        few levels of nested containers, so it's cheap to build (and of a
+        bounded size) no matter how large ``obj`` is (the reprs of other
+        types of objects are truncated, but are still built in full)::
+
+            >>> bounded_repr([[[[[1]]]]])
+            '[[[[[...]]]]]'
+            >>> len(bounded_repr(["x" * 100000] * 100000))
+            8261
+            >>>
+        """
+    return _bounded_repr.repr(obj)
+
 def dedent(s):
     """ Similar to ``textwrap.dedent``, but possible to use like this::
 
@@ -0,0 +1,27 @@
+import copy
+
+from nose.tools import assert_equal
+
+from dirt.testing import parameterized
+
+from ..delta import etag, diff, patch
+
+
+class TestDelta(object):
+    @parameterized([
+        ({}, {"a": 1}),
+        ({"a": 1}, {}),
+        ({"a": 1, "b": [1, 2]}, {"a": 1, "b": [1, 3]}),
+        ({"a": {"x": {"y": 1}}}, {"a": {"x": {"y": 2, "z": None}}}),
+        ({"a": {"x": 1}}, {"a": 42}),
+    ])
+    def test_diff_patch_round_trip(self, old, new):
+        ops = diff(old, new)
+        assert_equal(patch(copy.deepcopy(old), ops), new)
+
+    def test_unchanged(self):
+        assert_equal(diff({"a": [1]}, {"a": [1]}), [])
+
+    def test_etag(self):
+        assert_equal(etag({"a": [1]}), etag({"a": [1]}))
+        assert etag({"a": [1]}) != etag({"a": [2]})
@@ -3,7 +3,7 @@ import gevent
 
 from nose.tools import raises, assert_equal
 
-from ..gevent_ import BlockingDetector, AlarmInterrupt, arm_alarm
+from ..gevent_ import BlockingDetector, AlarmInterrupt, SingleFlight, arm_alarm
 
 
 class TestBlockingDetector(object):
@@ -35,3 +35,45 @@ class TestBlockingDetector(object):
     def test_no_alarm_interrupt_on_non_blocking_thread(self):
         gevent.sleep(0.1)
 
+    def test_stack_is_recorded(self):
+        def blocking_greenlet():
+            self.block_and_assert_raised()
+            return gevent.getcurrent().blocking_detected
+        detected_at, stack = gevent.spawn(blocking_greenlet).get()
+        assert "block_and_assert_raised" in stack, stack
+
+
+
+class TestSingleFlight(object):
+    def run_concurrently(self, flights, func, count=3):
+        def call():
+            try:
+                return flights.call("key", func)
+            except Exception as e:
+                return e
+        greenlets = [gevent.spawn(call) for _ in range(count)]
+        return [g.get() for g in greenlets]
+
+    def test_exceptions_are_shared(self):
+        calls = []
+        def func():
+            calls.append(1)
+            gevent.sleep(0.01)
+            raise ValueError("oops")
+        flights = SingleFlight()
+        results = self.run_concurrently(flights, func)
+        assert_equal(len(calls), 1)
+        for result in results:
+            assert isinstance(result, ValueError)
+        assert "key" not in flights
+
+    def test_unshareable_results(self):
+        calls = []
+        def func():
+            calls.append(1)
+            gevent.sleep(0.01)
+            return iter([])
+        flights = SingleFlight(can_share=lambda result: False)
+        results = self.run_concurrently(flights, func)
+        assert_equal(len(calls), 3)
+        assert_equal([shared for (_, shared) in results], [False] * 3)
@@ -0,0 +1,44 @@
+import random
+
+from nose.tools import assert_equal, assert_raises
+
+from ..histogram import LatencyHistogram
+
+
+class TestLatencyHistogram(object):
+    def test_percentiles_within_precision(self):
+        h = LatencyHistogram()
+        values = [random.uniform(0.0001, 10) for _ in range(10000)]
+        for value in values:
+            h.record(value)
+        values.sort()
+        for percentile in [50, 90, 99]:
+            expected = values[int(len(values) * percentile / 100.0) - 1]
+            actual = h.percentile(percentile)
+            assert abs(actual - expected) / expected < 0.07, \
+                (percentile, actual, expected)
+        assert_equal(h.percentile(100), max(values))
+
+    def test_empty(self):
+        h = LatencyHistogram()
+        assert_equal(h.percentile(50), None)
+        assert_equal(h.summary(), {"count": 0})
+
+    def test_out_of_range(self):
+        h = LatencyHistogram(max_bits=20)
+        h.record(-1)
+        h.record(100)
+        assert_equal(h.count, 2)
+        assert_equal(h.max, 100)
+
+    def test_merge(self):
+        a = LatencyHistogram()
+        b = LatencyHistogram()
+        for x in range(100):
+            a.record(x / 1000.0)
+            b.record((x + 100) / 1000.0)
+        merged = LatencyHistogram.from_dict(a.to_dict()).merge(b)
+        assert_equal(merged.count, 200)
+        assert_equal(merged.max, b.max)
+        assert abs(merged.percentile(50) - 0.1) < 0.1 * 0.07
+        assert_raises(ValueError, a.merge, LatencyHistogram(precision=3))
@@ -0,0 +1,23 @@
+from nose.tools import assert_equal
+
+from ..spool import SpooledList
+
+
+class TestSpooledList(object):
+    def test_in_memory(self):
+        items = SpooledList(max_size=1024)
+        items.extend(range(10))
+        assert not items.spooled
+        assert_equal(list(items), range(10))
+
+    def test_spills(self):
+        items = SpooledList(max_size=64)
+        items.extend({"x": x} for x in range(100))
+        assert items.spooled
+        assert_equal(len(items), 100)
+        assert_equal(items[-1], {"x": 99})
+        assert_equal(items[10:12], [{"x": 10}, {"x": 11}])
+        # Appending after reading should still work
+        items.append("end")
+        assert_equal(items[100], "end")
+        items.close()
@@ -1,3 +1,5 @@
+import sys
+
 from .protocol_registry import *
 
 protocol_registry.register({
@@ -6,7 +8,8 @@ protocol_registry.register({
     "mock": __name__ + ".proto_mock",
 })
 
-from .common import ClientWrapper
+from .common import ClientWrapper, ShardedClientWrapper, FileResult
+from .scatter import scatter_gather, ScatterResult, DeadlineExceeded
 
 def connect_simple(url, wrapper_cls=None):
     """ A helper method for doing a "simple" connect, where the client and
@@ -28,3 +31,13 @@ def connect_simple(url, wrapper_cls=None):
     client = client_cls(url)
     wrapper_cls = wrapper_cls or ClientWrapper
     return wrapper_cls(client)
+
+def flush_batched_calls():
+    """ Sends any fire-and-forget calls which have been buffered to be sent in
+        batches (see the ``batch_ignored_calls`` drpc client setting). Should
+        be called before exiting. """
+    # If the drpc client hasn't been imported, no calls can have been
+    # buffered (and importing it would need the optional ``bson`` package).
+    client = sys.modules.get(__name__ + ".proto_drpc.client")
+    if client is not None:
+        client.CallBatcher.flush_all()
@@ -1,7 +1,18 @@
+import os
+import sys
+import copy
+import mmap
+import datetime
 import time
+import random
+import hashlib
 from urlparse import urlparse
 
+from dirt.misc.lru import LRUCache
+from dirt.misc.iter import isiter
+from dirt.misc.delta import patch
 from dirt.misc.strutil import to_str
+from dirt.misc.gevent_ import SingleFlight
 
 def expected(exception):
     """ Mark an exception as being "expected". Expected exceptions will not
@@ -14,7 +25,17 @@ def is_expected(exception):
 
 
 class Call(object):
-    """ Stores the data and options for one RPC call. """
+    """ Stores the data and options for one RPC call.
+
+        Calls are created for every request on both the client and the server,
+        so they use ``__slots__``, and the ``meta`` dict is only created if it
+        is used. """
+
+    __slots__ = [
+        "name", "args", "kwargs", "flags", "peer", "headers",
+        "result_headers", "want_response", "can_retry", "time_received",
+        "time_started", "timestamps", "_meta",
+    ]
 
     default_flags = {
         # Should we wait for a result from the server? If ``False``, ``_call``
@@ -24,50 +45,215 @@ class Call(object):
         "can_retry": True,
     }
 
-    def __init__(self, name, args=None, kwargs=None, flags=None, peer=None):
-        args = args or ()
-        kwargs = kwargs or {}
-        flags = flags or {}
-        for flag in flags:
-            if flag not in self.default_flags:
-                raise ValueError("invalid flag: %r" %(flag, ))
-        self.__dict__.update(self.default_flags)
-        self.__dict__.update(flags)
-        # Note: force all kwarg keys to be strings, because some serializers
-        # (ex, JSON) will result in unicode keys, and Python <= 2.6 will
-        # choke when kwargs contains unicode keys (even if they are 7-bit-safe) 
-        kwargs = dict((to_str(key), val) for (key, val) in kwargs.items())
+    def __init__(self, name, args=None, kwargs=None, flags=None, peer=None,
+                 headers=None):
+        default_flags = self.default_flags
+        self.want_response = default_flags["want_response"]
+        self.can_retry = default_flags["can_retry"]
+        if flags:
+            for flag, value in flags.items():
+                if flag not in self.default_flags:
+                    raise ValueError("invalid flag: %r" %(flag, ))
+                setattr(self, flag, value)
+        else:
+            flags = {}
+        if kwargs:
+            # Note: force all kwarg keys to be strings, because some
+            # serializers (ex, JSON) will result in unicode keys, and Python
+            # <= 2.6 will choke when kwargs contains unicode keys (even if
+            # they are 7-bit-safe)
+            for key in kwargs:
+                if type(key) is not str:
+                    kwargs = dict(
+                        (to_str(key), val) for (key, val) in kwargs.items()
+                    )
+                    break
+        else:
+            kwargs = {}
         self.name = name
-        self.args = args
+        self.args = args or ()
         self.kwargs = kwargs
         self.flags = flags
         self.peer = peer
-        # Some debug-related information about this call
-        self.meta = {
-            # The time the call was first received.
-            "time_received": time.time(),
-            # The time between when the call was received and the time the call
-            # was started.
-            "time_in_queue": None,
-            # The number of items which have been yielded, if this call
-            # returned an iterator.
-            "yielded_items": None,
-        }
+        # Protocol-level options sent along with the call (ex, the ``etag`` of
+        # a previously seen result) and with its result (ex, the ``etag`` of
+        # this result).
+        self.headers = headers or {}
+        self.result_headers = {}
+        # The time the call was first received.
+        self.time_received = time.time()
+        # The time the call was started (ie, left the queue), if it has been.
+        self.time_started = None
+        # If stage timing is enabled (see ``APIEdge.record_stages``), the
+        # ``dirt.misc.clock.monotonic`` time at which each stage of handling
+        # the call finished (see ``CALL_STAGES`` in ``dirt.app``).
+        self.timestamps = None
+        self._meta = None
+
+    @property
+    def meta(self):
+        """ Some debug-related information about this call. """
+        meta = self._meta
+        if meta is None:
+            meta = self._meta = {
+                # The time the call was first received.
+                "time_received": self.time_received,
+                # The time between when the call was received and the time
+                # the call was started.
+                "time_in_queue": None,
+                # The number of items which have been yielded, if this call
+                # returned an iterator.
+                "yielded_items": None,
+                "timestamps": self.timestamps,
+            }
+        if meta["time_in_queue"] is None and self.time_started is not None:
+            meta["time_in_queue"] = self.time_started - self.time_received
+        return meta
 
     def __repr__(self):
         attrs = [
             ", %s=%r" %(attr, getattr(self, attr))
-            for attr in ["args", "kwargs", "flags", "peer"]
+            for attr in ["args", "kwargs", "flags", "peer", "headers"]
             if getattr(self, attr)
         ]
         return "Call(%r%s)" %(self.name, "".join(attrs), )
 
 
+class FileResult(object):
+    """ Can be returned from an API method to send ``length`` bytes of the
+        file at ``path`` (starting at ``offset``) to the caller without
+        reading them into memory. If ``length`` is ``None``, the rest of the
+        file will be sent.
+
+        The drpc protocol streams the file straight from disk to the socket
+        (using ``sendfile`` where possible), and the caller receives a
+        file-like ``FileStream``. For example::
+
+            class ArtefactAPI(object):
+                def get(self, name):
+                    return FileResult(os.path.join(ARTEFACT_DIR, name))
+
+            >>> api.artefacts.get("build.tar.gz").save("/tmp/build.tar.gz")
+        """
+
+    def __init__(self, path, offset=0, length=None):
+        self.path = path
+        self.offset = offset
+        self.length = length
+
+    def open(self):
+        """ Returns ``(file, length)``, where ``length`` is the number of bytes
+            which should be sent (ie, clamped to the size of the file). """
+        file = open(self.path, "rb")
+        try:
+            available = max(os.fstat(file.fileno()).st_size - self.offset, 0)
+        except:
+            file.close()
+            raise
+        length = self.length
+        if length is None or length > available:
+            length = available
+        return file, length
+
+    def __repr__(self):
+        return "FileResult(%r, offset=%r, length=%r)" %(
+            self.path, self.offset, self.length,
+        )
+
+
+class RetryPolicy(object):
+    """ Decides whether and when failed calls should be retried.
+
+        ``attempts`` is the total number of attempts which will be made
+        (including the first). Before retry ``n`` (starting at 1) the caller
+        should wait a random time between zero and ``base_delay * 2 ** (n -
+        1)`` seconds (but at most ``max_delay``; ie, exponential backoff with
+        "full jitter"), so that callers don't retry in lock step.
+
+        Retries are limited by a token bucket: each retry costs one token,
+        and each call adds ``budget_ratio`` tokens (up to ``budget_tokens``),
+        so in the long run at most ``budget_ratio`` extra calls are made for
+        each call, even if the remote is down.
+
+        Clients take their policy from the ``retry_policy`` setting, which
+        can be a ``RetryPolicy`` or a dict of arguments for one. For example::
+
+            class SEARCH:
+                remote_url = "drpc://search:4321"
+                retry_policy = {"attempts": 4, "base_delay": 0.1}
+
+        Counts of retries, and of retries which were prevented by the budget,
+        are kept in ``stats``. """
+
+    def __init__(self, attempts=2, base_delay=0.05, max_delay=2.0,
+                 budget_ratio=0.1, budget_tokens=10):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget_ratio = budget_ratio
+        self.budget_tokens = budget_tokens
+        self.tokens = float(budget_tokens)
+        self.stats = {
+            "retries": 0,
+            "over_budget": 0,
+        }
+
+    @classmethod
+    def from_setting(cls, value):
+        """ Returns a policy for the ``retry_policy`` setting ``value``. """
+        if value is None:
+            return cls()
+        if isinstance(value, dict):
+            return cls(**value)
+        return value
+
+    def record_call(self):
+        """ Should be called once for each call (not for each attempt). """
+        self.tokens = min(self.tokens + self.budget_ratio, self.budget_tokens)
+
+    def should_retry(self, attempt):
+        """ Returns ``True`` if retry number ``attempt`` (starting at 1)
+            should be made, taking a token from the budget if it should. """
+        if attempt >= self.attempts:
+            return False
+        if self.tokens < 1:
+            self.stats["over_budget"] += 1
+            return False
+        self.tokens -= 1
+        self.stats["retries"] += 1
+        return True
+
+    def get_delay(self, attempt):
+        """ Returns the number of seconds to wait before retry ``attempt``. """
+        delay = min(self.base_delay * 2 ** (attempt - 1), self.max_delay)
+        return random.uniform(0, delay)
+
+    def __repr__(self):
+        return "<%s attempts=%r base_delay=%r tokens=%.1f>" %(
+            type(self).__name__, self.attempts, self.base_delay, self.tokens,
+        )
+
+
 class ServerBase(object):
-    def __init__(self, bind_url, execute_call):
+    """ The base class for protocol servers.
+
+        ``execute_call`` is called with each ``Call`` and returns its result,
+        and ``connection_closed`` (if it isn't ``None``, and the protocol has
+        connections) is called with the peer of each connection after it has
+        been closed.
+
+        If ``call_finished`` is not ``None`` (and the protocol supports it),
+        it is called with each call after its result has been sent, and the
+        time at which each stage of handling the call finished is recorded
+        in ``call.timestamps``. """
+
+    def __init__(self, bind_url, execute_call, connection_closed=None,
+                 call_finished=None):
         self.bind_url = bind_url
         self.bind = urlparse(bind_url)
         self.execute_call = execute_call
+        self.connection_closed = connection_closed
+        self.call_finished = call_finished
         self.init()
 
     def init(self):
@@ -78,10 +264,25 @@ class ServerBase(object):
 
 
 class ClientBase(object):
-    def __init__(self, remote_url):
+    """ The base class for protocol clients.
+
+        ``settings`` is the (optional) settings object for the API being
+        called (ex, the ``class PING: ...`` which defines the ``remote_url``),
+        which clients can use to look up per-remote options. The names of the
+        settings looked up with ``get_setting`` are kept in
+        ``settings_read``. """
+
+    def __init__(self, remote_url, settings=None):
         self.remote_url = remote_url
         self.remote = urlparse(remote_url)
+        self.settings = settings
+        self.settings_read = set()
         self.init()
+
+    def get_setting(self, name, default=None):
+        """ Returns the per-remote setting ``name``, or ``default``. """
+        self.settings_read.add(name)
+        return getattr(self.settings, name, default)
     
     def init(self):
         pass
@@ -106,16 +307,184 @@ class ClientBase(object):
         )
 
 
+class _Unkeyable(Exception):
+    pass
+
+_KEY_SCALARS = (
+    bool, int, long, float, type(None),
+    datetime.datetime, datetime.date, datetime.time,
+)
+_KEY_BINARY = (buffer, memoryview, bytearray, mmap.mmap)
+
+# Strings longer than this are included in keys as a hash of their contents
+_KEY_MAX_STR_LEN = 1024
+
+def _key_repr(value):
+    if isinstance(value, basestring):
+        if len(value) <= _KEY_MAX_STR_LEN:
+            return repr(value)
+        data = value if isinstance(value, str) else value.encode("utf-8")
+        return "<%s %s>" %(type(value).__name__, hashlib.md5(data).hexdigest())
+    if isinstance(value, _KEY_SCALARS):
+        return repr(value)
+    value_type = type(value)
+    if value_type is list:
+        return "[%s]" %(", ".join(map(_key_repr, value)), )
+    if value_type is tuple:
+        return "(%s,)" %(", ".join(map(_key_repr, value)), )
+    if value_type is dict:
+        return "{%s}" %(", ".join(sorted(
+            "%s: %s" %(_key_repr(key), _key_repr(item))
+            for (key, item) in value.iteritems()
+        )), )
+    if isinstance(value, _KEY_BINARY):
+        return "<%s %s>" %(value_type.__name__,
+                           hashlib.md5(value).hexdigest())
+    # Note: if ``value`` is an ndarray, NumPy has already been imported.
+    numpy = sys.modules.get("numpy")
+    if numpy is not None and isinstance(value, numpy.ndarray) and \
+            not value.dtype.hasobject:
+        return "<ndarray %s %r %s>" %(
+            value.dtype.str, value.shape,
+            hashlib.md5(numpy.ascontiguousarray(value)).hexdigest(),
+        )
+    raise _Unkeyable(value)
+
+def call_key(args, kwargs):
+    """ Returns a ``str`` which identifies a call's arguments, so calls with
+        equal arguments (and only those) have the same key, for memoizing,
+        caching or coalescing calls. Long strings and binary values
+        (``buffer``, ``memoryview``, ``bytearray``, ``mmap`` and NumPy
+        arrays) are included as a hash of their contents. Returns ``None`` if
+        the arguments include anything else which isn't a string, number,
+        date, ``None``, list, tuple or dict (the repr of an arbitrary object
+        doesn't necessarily identify its value)::
+
+            >>> call_key((1, "a"), {"b": [2.0]})
+            "((1, 'a',), [('b', [2.0],)],)"
+            >>> call_key((object(), ), {}) is None
+            True
+            >>>
+        """
+    try:
+        return _key_repr((args, sorted(kwargs.items())))
+    except _Unkeyable:
+        return None
+
+
+# Binary values which may be backed by received frames (see
+# ``proto_drpc/frames.py``) can't be deep copied (and aren't expected to be
+# modified), so copies of remembered results share them instead.
+_SHARED_RESULT_TYPES = (buffer, memoryview, mmap.mmap)
+
+def _find_shared(value, memo):
+    if isinstance(value, _SHARED_RESULT_TYPES):
+        memo[id(value)] = value
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            _find_shared(item, memo)
+    elif isinstance(value, dict):
+        for item in value.itervalues():
+            _find_shared(item, memo)
+
+def _copy_result(result):
+    """ Returns a deep copy of ``result`` which shares any binary values (see
+        ``_SHARED_RESULT_TYPES``) with the original. """
+    memo = {}
+    _find_shared(result, memo)
+    return copy.deepcopy(result, memo)
+
+
+class _LazyCallKey(object):
+    """ The ``call_key`` of a call's arguments, computed the first time it's
+        needed (most calls never need it, and it can be expensive for large
+        arguments). """
+
+    _unset = object()
+
+    def __init__(self, args, kwargs):
+        self.args = args
+        self.kwargs = kwargs
+        self._key = self._unset
+
+    def get(self):
+        if self._key is self._unset:
+            self._key = call_key(self.args, self.kwargs)
+        return self._key
+
+
 class ClientWrapper(object):
     """ A thin wrapper around a ``Client`` which provides convinience methods
         for "transparent" dotted-access and iPython tab completion.
         
         Calling ``ClientWrapper(client).foo.bar(baz)`` is roughly equivilent to
-        ``client.call(Call("foo.bar", args=(baz, )))``. """
+        ``client.call(Call("foo.bar", args=(baz, )))``.
+
+        Results of conditional calls (methods marked with
+        ``APIEdge.conditional`` on the server) are remembered along with their
+        ``etag``, and later calls with the same arguments send that ``etag`` so
+        the server can reply with "not modified" or a delta, which is used to
+        reconstruct the full result locally. At most ``etag_cache_size``
+        results are remembered for each method.
+
+        Results of cacheable calls (methods marked with ``APIEdge.cacheable``
+        on the server, which send a ``ttl`` along with their result) are kept
+        in a local LRU cache of at most ``response_cache_size`` entries and
+        repeat calls with the same arguments are served from it until the
+        ``ttl`` expires. See ``_cache_info`` and ``_cache_clear``. Calls
+        whose arguments can't be compared safely (see ``call_key``) are
+        neither cached nor sent with an ``etag``.
+
+        If ``coalesce_calls`` is ``True`` (default: the ``coalesce_calls``
+        setting of the remote, or ``False``), concurrent identical calls
+        (same method and arguments) made from different greenlets share one
+        request and its result (results which are iterators, like streamed
+        results, are not shared). Calls whose arguments can't be compared
+        safely (see ``call_key``) are never coalesced.
+
+        The number of calls made through the wrapper, how many of them
+        failed, and the total time spent making them are counted (see
+        ``_call_stats``). """
+
+    etag_cache_size = 128
+    response_cache_size = 1024
+    coalesce_calls = None
 
-    def __init__(self, client, prefix=""):
+    def __init__(self, client, prefix="", _shared=None):
         self._client = client
         self._prefix = prefix
+        if _shared is None:
+            _shared = self._make_shared()
+        self._shared = _shared
+
+    def _make_shared(self):
+        """ Returns the state which is shared between this wrapper and all the
+            wrappers derived from it (ex, ``wrapper.foo.bar``). """
+        coalesce_calls = self.coalesce_calls
+        if coalesce_calls is None:
+            coalesce_calls = self._client.get_setting("coalesce_calls") is True
+        return {
+            # method name -> LRUCache(args key -> (etag, result))
+            "etags": {},
+            # (name, args key) -> (expires, result)
+            "cache": LRUCache(self.response_cache_size),
+            # names of the methods which have returned a ``ttl``
+            "cacheable": set(),
+            "cache_stats": {
+                "hits": 0,
+                "misses": 0,
+            },
+            "call_stats": {
+                "calls": 0,
+                "errors": 0,
+                "seconds": 0.0,
+            },
+            # in-flight calls, if ``coalesce_calls`` is enabled
+            "flights": (
+                SingleFlight(can_share=lambda result: not isiter(result))
+                if coalesce_calls else None
+            ),
+        }
 
     def _disconnect(self):
         self._client.disconnect()
@@ -128,9 +497,112 @@ class ClientWrapper(object):
         """ For tab completion with iPyhton. """
         return []
 
+    def _cache_info(self):
+        """ Returns the hit and miss counts and the current size of the
+            response cache. """
+        info = dict(self._shared["cache_stats"])
+        info["size"] = len(self._shared["cache"])
+        return info
+
+    def _cache_clear(self):
+        """ Removes all results from the response cache. """
+        self._shared["cache"].clear()
+
+    def _call_stats(self):
+        """ Returns the number of calls made through this wrapper (and the
+            wrappers derived from it), the number which raised an exception,
+            and the total number of seconds spent making them. """
+        return dict(self._shared["call_stats"])
+
     def _call(self, name, *args, **kwargs):
-        call = Call(name, args, kwargs)
-        return self._client.call(call)
+        call_stats = self._shared["call_stats"]
+        call_stats["calls"] += 1
+        start = time.time()
+        try:
+            return self._call_cached(name, args, kwargs)
+        except Exception:
+            call_stats["errors"] += 1
+            raise
+        finally:
+            call_stats["seconds"] += time.time() - start
+
+    def _call_cached(self, name, args, kwargs):
+        # The arguments are only keyed once a method has returned a ``ttl``
+        # or an ``etag``, or if calls are coalesced.
+        args_key = _LazyCallKey(args, kwargs)
+        if name in self._shared["cacheable"]:
+            cache_key = args_key.get()
+            response_cache = self._shared["cache"]
+            cached_response = response_cache.get((name, cache_key))
+            if cached_response is not None:
+                expires, result = cached_response
+                if expires > time.time():
+                    self._shared["cache_stats"]["hits"] += 1
+                    return _copy_result(result)
+                response_cache.pop((name, cache_key))
+
+        flights = self._shared["flights"]
+        flight_key = flights is not None and args_key.get()
+        if not flight_key:
+            return self._call_remote(name, args, kwargs, args_key)
+        result, shared = flights.call((name, flight_key), self._call_remote,
+                                      name, args, kwargs, args_key)
+        return _copy_result(result) if shared else result
+
+    def _call_remote(self, name, args, kwargs, args_key):
+        etag_cache = self._shared["etags"].get(name)
+        cached = None
+        headers = None
+        if etag_cache is not None:
+            cached = etag_cache.get(args_key.get())
+            if cached is not None:
+                headers = {"etag": cached[0]}
+        call = Call(name, args, kwargs, headers=headers)
+        result = self._get_client(call).call(call)
+        if "etag" in call.result_headers and args_key.get() is not None:
+            result = self._resolve_conditional(call, result, args_key, cached)
+        ttl = call.result_headers.get("ttl")
+        if ttl and args_key.get() is not None:
+            self._shared["cacheable"].add(name)
+            self._shared["cache_stats"]["misses"] += 1
+            self._shared["cache"][(name, args_key.get())] = (
+                time.time() + ttl, _copy_result(result),
+            )
+        return result
+
+    def _get_client(self, call):
+        """ Returns the client which should be used to make ``call``. """
+        return self._client
+
+    def _resolve_conditional(self, call, result, args_key, cached):
+        """ Turns the result of a conditional call (which may be a "not
+            modified" marker or a delta against ``cached``) into the full
+            result, remembering it for next time. """
+        cache_key = args_key.get()
+        result_headers = call.result_headers
+        etag_cache = self._shared["etags"].get(call.name)
+        if etag_cache is None:
+            etag_cache = LRUCache(self.etag_cache_size)
+            self._shared["etags"][call.name] = etag_cache
+
+        if result_headers.get("nm") or "delta" in result_headers:
+            if cached is None or (
+                "delta" in result_headers and
+                cached[0] != result_headers["delta"]
+            ):
+                # The server is referencing a result we no longer have (or
+                # never had), so ask again for the full result.
+                etag_cache.pop(cache_key)
+                return self._call_remote(call.name, call.args, call.kwargs,
+                                         args_key)
+            value = _copy_result(cached[1])
+            if "delta" in result_headers:
+                patch(value, result)
+            etag_cache[cache_key] = (result_headers["etag"], value)
+            return _copy_result(value)
+
+        etag_cache[cache_key] = (result_headers["etag"], _copy_result(result))
+        return result
 
     def __call__(self, *args, **kwargs):
         assert self._prefix, "can't call before a prefix has been set"
@@ -138,7 +610,8 @@ class ClientWrapper(object):
 
     def __getattr__(self, suffix):
         new_prefix = self._prefix and self._prefix + "." + suffix or suffix
-        bound = self.__class__(client=self._client, prefix=new_prefix)
+        bound = self.__class__(client=self._client, prefix=new_prefix,
+                               _shared=self._shared)
         setattr(self, suffix, bound)
         return bound
 
@@ -146,3 +619,72 @@ class ClientWrapper(object):
         return "<%s client=%r prefix=%r>" %(
             type(self).__name__, self._client, self._prefix,
         )
+
+
+class ShardedClientWrapper(ClientWrapper):
+    """ A ``ClientWrapper`` for apps which are partitioned by key over
+        several processes (shards): each call is sent to the shard which owns
+        its key, chosen by rendezvous (highest random weight) hashing, so when
+        a shard is added or removed only the keys owned by that shard move.
+
+        Configured with the ``shard_urls`` setting (a list of URLs; each
+        shard gets its own client and connection pool), and the
+        ``shard_key`` setting, which is the index of the positional argument
+        (default: ``0``) or the name of the keyword argument which holds the
+        key, or a function of ``(name, args, kwargs)`` which returns it::
+
+            class SESSIONS:
+                shard_urls = ["drpc://10.0.0.1:4321", "drpc://10.0.0.2:4321"]
+                shard_key = "session_id"
+
+            >>> sessions = runner.get_api("sessions")
+            >>> sessions.get(session_id="abc123")
+
+        ``_shards()`` returns a ``ClientWrapper`` for each shard (ex, for
+        calls which aren't keyed, like ``debug.status``, or for use with
+        ``scatter_gather``). """
+
+    def _make_shared(self):
+        shared = super(ShardedClientWrapper, self)._make_shared()
+        client = self._client
+        urls = client.get_setting("shard_urls") or [client.remote_url]
+        shared["shards"] = [
+            (url, client if url == client.remote_url else
+                  type(client)(url, settings=client.settings))
+            for url in urls
+        ]
+        shared["shard_key"] = client.get_setting("shard_key", 0)
+        return shared
+
+    def _get_shard_key(self, call):
+        shard_key = self._shared["shard_key"]
+        if callable(shard_key):
+            return shard_key(call.name, call.args, call.kwargs)
+        if isinstance(shard_key, basestring):
+            if shard_key in call.kwargs:
+                return call.kwargs[shard_key]
+        elif len(call.args) > shard_key:
+            return call.args[shard_key]
+        raise ValueError("%r has no shard key argument %r (hint: use "
+                         "._shards() for calls which aren't keyed)"
+                         %(call, shard_key))
+
+    def _get_client(self, call):
+        return self._get_shard(self._get_shard_key(call))
+
+    def _get_shard(self, key):
+        """ Returns the client for the shard which owns ``key``. """
+        key = to_str(key)
+        def weight(shard):
+            return hashlib.md5(to_str(shard[0]) + "\x00" + key).digest()
+        return max(self._shared["shards"], key=weight)[1]
+
+    def _shards(self):
+        return [
+            ClientWrapper(client, prefix=self._prefix)
+            for (_, client) in self._shared["shards"]
+        ]
+
+    def _disconnect(self):
+        for _, client in self._shared["shards"]:
+            client.disconnect()
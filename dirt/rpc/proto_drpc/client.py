@@ -1,23 +1,202 @@
+import sys
+import time
+import random
 import logging
+import cPickle
+from itertools import cycle
+from collections import deque
 
+import gevent
 from gevent import socket
 from gevent.timeout import Timeout
 
-from dirt.rpc.common import ClientBase
+from dirt.rpc.common import ClientBase, Call
+from dirt.misc.spool import SpooledList
 
-from .connection import ConnectionError, MessageError, ConnectionPool
+from .connection import (
+    ConnectionError, MessageError, ConnectionPool, MessageSocket,
+    RPCConnectionBase,
+)
+from .frames import extract_frames, restore_frames
+from .lazybson import materialize
+from .outbox import Outbox
 
 log = logging.getLogger(__name__)
 
 
 class Client(ClientBase):
+    """ A drpc client.
+
+        Per-remote settings:
+
+        ``spool_threshold`` (default: ``None``, disabled): out-of-band frames
+        (which the remote sends for binary values and NumPy arrays, and for
+        large ``str`` values if its ``frame_threshold`` is set; see
+        ``frames.py``) bigger than this many bytes are received into a
+        temporary file and returned as an ``mmap`` instead of being held in
+        memory, and generator results collected with
+        ``ResultGenerator.collect`` spill to disk once they grow beyond this
+        many bytes. Nothing else is spooled: each message (ex, a result which
+        isn't sent as a frame, or one item of a generator) is still read and
+        decoded in memory, so it's only limited by the maximum message size
+        (16MB, before decompression). Spooled frames are still limited by
+        ``max_frame_size``.
+
+        ``frame_threshold`` (default: ``None``, disabled): ``str`` arguments
+        of at least this many bytes are sent as raw out-of-band frames
+        (which the remote will receive as ``memoryview``s; see ``frames.py``)
+        instead of being serialized into the call. ``max_frame_size``
+        (default: 256MB) limits the size of the frames which will be received
+        with a single response.
+
+        ``lazy_decode`` (default: ``False``): results will be decoded lazily,
+        and documents and arrays will be returned as read-only mapping and
+        sequence proxies which are decoded as they are accessed (see
+        ``lazybson.py``). Useful for large responses when only part of the
+        response will be used.
+
+        ``alternate_urls`` and ``hedge_percentile`` (default: ``None``,
+        disabled): if a call made with the ``can_retry`` flag has not been
+        answered after the ``hedge_percentile``th percentile of recent call
+        latencies, the same call is sent to one of the ``alternate_urls``
+        (round robin). The first answer is used and the other call is
+        cancelled.
+        ``hedge_budget`` (default: ``5``) limits the extra calls to that
+        percentage of all calls. See ``hedge_stats``.
+
+        ``retry_policy`` (default: one retry, with backoff): how calls which
+        fail with a ``ConnectionError`` and were made with the ``can_retry``
+        flag are retried (the policy, and its retry budget, are shared by all
+        the clients of the remote; see ``ConnectionPool``). See
+        ``dirt.rpc.common.RetryPolicy``.
+
+        ``max_in_flight`` and ``max_queued`` (default: ``None``, unlimited):
+        limit the number of concurrent calls to the remote, and the number of
+        calls which will wait for one of them to finish, so a hung remote
+        can't tie up every greenlet. Further calls fail immediately with
+        ``PoolFullError``. See ``ConnectionPool``.
+
+        ``load_backoff_queue`` (default: ``None``, disabled): if the remote
+        recently reported (in the ``load`` header of a response; see
+        ``APIEdge.get_load``) that at least this many calls were queued,
+        calls wait for a random time of up to its average call latency
+        before being sent, backing off before the remote is saturated. The
+        last reported load is available from ``remote_load``.
+
+        ``batch_ignored_calls`` (default: ``False``): calls made with
+        ``want_response=False`` are buffered and sent in batches (a single
+        ``call_batch`` message) of up to ``batch_max_size`` (default: ``100``)
+        calls, at most ``batch_max_delay`` (default: ``0.05``) seconds after
+        the first call in the batch was made. See ``CallBatcher``.
+
+        ``outbox_dir`` (default: ``None``, disabled): calls made with
+        ``want_response=False`` are written to a durable outbox in this
+        directory (in a subdirectory for each remote and process, holding at
+        most ``outbox_max_size`` bytes; default: 64MB) and delivered in the
+        background, so they aren't lost (and don't slow down the caller)
+        while the remote is unavailable. See ``outbox.py``.
+
+        Note that connection pools are shared by all clients of one address,
+        so the first client to connect determines the pool's settings. """
+
+    # The number of latency samples which are kept, and which are needed
+    # before calls will be hedged.
+    hedge_max_samples = 256
+    hedge_min_samples = 20
+    # The maximum number of hedged calls which can be "saved up" by the
+    # budget (ie, the largest burst of hedged calls).
+    hedge_max_tokens = 10
+
+    # Load reports older than this are ignored, and calls are delayed by at
+    # most ``load_max_backoff`` seconds (see ``load_backoff_queue``).
+    load_max_age = 1.0
+    load_max_backoff = 1.0
+
+    # The number of seconds for which the result of a liveness check is used
+    # before it is refreshed (see ``server_is_alive``).
+    liveness_ttl = 5.0
+
     def init(self):
         remote_addr = (self.remote.hostname, self.remote.port)
-        self.pool = ConnectionPool.get_pool(remote_addr)
+        self.spool_threshold = self.get_setting("spool_threshold")
+        self.pool = ConnectionPool.get_pool(
+            remote_addr, spool_threshold=self.spool_threshold,
+            lazy_decode=self.get_setting("lazy_decode", False),
+            frame_threshold=self.get_setting("frame_threshold"),
+            max_frame_size=self.get_setting("max_frame_size"),
+            max_in_flight=self.get_setting("max_in_flight"),
+            max_queued=self.get_setting("max_queued"),
+            retry_policy=self.get_setting("retry_policy"),
+        )
+        self.alternate_urls = list(self.get_setting("alternate_urls") or [])
+        self.hedge_percentile = self.get_setting("hedge_percentile")
+        self.hedge_budget = self.get_setting("hedge_budget", 5)
+        self.hedge_stats = {
+            "hedged": 0,
+            "hedge_wins": 0,
+            "over_budget": 0,
+        }
+        self._latencies = deque(maxlen=self.hedge_max_samples)
+        self._hedge_tokens = 0.0
+        self._alternates = None
+        # Shared by all the clients of the remote, so their retries are
+        # limited by one budget.
+        self.retry_policy = self.pool.retry_policy
+        self.load_backoff_queue = self.get_setting("load_backoff_queue")
+        self.load_backoffs = 0
+        self.batcher = None
+        if self.get_setting("batch_ignored_calls", False) is True:
+            self.batcher = CallBatcher.get_batcher(
+                self.pool,
+                max_size=self.get_setting("batch_max_size", 100),
+                max_delay=self.get_setting("batch_max_delay", 0.05),
+            )
+        self.outbox = None
+        outbox_dir = self.get_setting("outbox_dir")
+        if isinstance(outbox_dir, basestring):
+            self.outbox = Outbox.get_outbox(
+                self.pool, outbox_dir,
+                max_size=self.get_setting("outbox_max_size", 64 * 1024 * 1024),
+            )
 
     def call(self, call):
         """ Calls ``name(*args, **kwargs)``. See ``default_flags`` for values
             of ``custom_flags``. """
+        if not call.want_response:
+            if self.outbox is not None:
+                self.outbox.append(call)
+                return None
+            if self.batcher is not None:
+                self.batcher.add(call)
+                return None
+        if self._can_hedge(call):
+            return self._call_hedged(call)
+        return self._call(call)
+
+    def remote_load(self):
+        """ Returns the load last reported by the remote (a dict of
+            ``active``, ``queued``, ``latency_ms`` and the ``time`` it was
+            reported), or ``None`` if it hasn't reported any. """
+        return self.pool.remote_load
+
+    def _get_load_backoff(self):
+        """ Returns the number of seconds to wait before calling the remote,
+            given its last reported load. """
+        load = self.pool.remote_load
+        if self.load_backoff_queue is None or load is None:
+            return 0
+        if load["queued"] < self.load_backoff_queue:
+            return 0
+        if time.time() - load["time"] > self.load_max_age:
+            return 0
+        max_delay = min(load["latency_ms"] / 1000.0, self.load_max_backoff)
+        return random.uniform(0, max_delay)
+
+    def _call(self, call):
+        backoff = self._get_load_backoff()
+        if backoff:
+            self.load_backoffs += 1
+            gevent.sleep(backoff)
         result = None
         cxn = self.pool.get_connection()
         try:
@@ -32,46 +211,181 @@ class Client(ClientBase):
         assert result, "result somehow managed to stay undefined"
         return result.result
 
-    def _call_with_cxn_with_retry(self, cxn, call):
-        can_retry = call.flags.get("can_retry")
+    def _can_hedge(self, call):
+        return (
+            self.hedge_percentile is not None and
+            bool(self.alternate_urls) and
+            call.want_response and
+            call.flags.get("can_retry") and
+            call.can_retry
+        )
+
+    def _hedge_delay(self):
+        """ Returns the time to wait for a response before hedging, or
+            ``None`` if there aren't enough samples yet. """
+        if len(self._latencies) < self.hedge_min_samples:
+            return None
+        latencies = sorted(self._latencies)
+        idx = int(len(latencies) * self.hedge_percentile / 100.0)
+        return latencies[min(idx, len(latencies) - 1)]
+
+    def _get_alternate(self):
+        if self._alternates is None:
+            alternates = []
+            for url in self.alternate_urls:
+                client = type(self)(url, settings=self.settings)
+                client.alternate_urls = []
+                alternates.append(client)
+            self._alternates = cycle(alternates)
+        return next(self._alternates)
+
+    def _call_hedged(self, call):
+        self._hedge_tokens = min(
+            self._hedge_tokens + self.hedge_budget / 100.0,
+            self.hedge_max_tokens,
+        )
+        start = time.time()
+        delay = self._hedge_delay()
+        if delay is None:
+            result = self._call(call)
+            self._latencies.append(time.time() - start)
+            return result
+
+        hedge_call = None
+        greenlets = [gevent.spawn(self._call_capturing_errors, self, call)]
+        try:
+            greenlets[0].join(timeout=delay)
+            if not greenlets[0].ready():
+                if self._hedge_tokens >= 1:
+                    self._hedge_tokens -= 1
+                    self.hedge_stats["hedged"] += 1
+                    hedge_call = Call(call.name, call.args, call.kwargs,
+                                      call.flags, headers=call.headers)
+                    alternate = self._get_alternate()
+                    greenlets.append(gevent.spawn(self._call_capturing_errors,
+                                                  alternate, hedge_call))
+                else:
+                    self.hedge_stats["over_budget"] += 1
+            winner = self._get_first_successful(greenlets)
+        finally:
+            for greenlet in greenlets:
+                greenlet.kill(block=False)
+
+        self._latencies.append(time.time() - start)
+        for greenlet in greenlets:
+            if greenlet is winner or not isinstance(greenlet.value, tuple):
+                continue
+            # Both calls finished; don't leak the other call's connection.
+            is_ok, value = greenlet.value
+            close = is_ok and getattr(value, "close", None)
+            if close:
+                close()
+        if winner is not greenlets[0]:
+            self.hedge_stats["hedge_wins"] += 1
+            call.result_headers = hedge_call.result_headers
+        return winner.value[1]
+
+    def _call_capturing_errors(self, client, call):
+        """ Returns ``(True, result)`` or ``(False, exc_info)``, so that
+            failed hedged calls don't get logged as failed greenlets. """
         try:
-            return self._call_with_cxn(cxn, call)
-        except ConnectionError:
-            if not (can_retry and call.can_retry):
-                raise
-            return self._call_with_cxn(cxn, call)
+            return True, client._call(call)
+        except Exception:
+            return False, sys.exc_info()
+
+    def _get_first_successful(self, greenlets):
+        """ Returns the first greenlet in ``greenlets`` to finish successfully,
+            or re-raises the error of the last one to fail. """
+        pending = list(greenlets)
+        while True:
+            finished = gevent.wait(pending, count=1)[0]
+            is_ok, value = finished.value
+            if is_ok:
+                return finished
+            pending.remove(finished)
+            if not pending:
+                raise value[0], value[1], value[2]
+
+    def _call_with_cxn_with_retry(self, cxn, call):
+        can_retry = call.flags.get("can_retry") and call.can_retry
+        self.retry_policy.record_call()
+        attempt = 0
+        while True:
+            try:
+                return self._call_with_cxn(cxn, call)
+            except ConnectionError:
+                attempt += 1
+                if not (can_retry and self.retry_policy.should_retry(attempt)):
+                    raise
+            # Note: the connection will reconnect when it is next used.
+            gevent.sleep(self.retry_policy.get_delay(attempt))
 
     def _call_with_cxn(self, cxn, call):
         type = call.want_response and "call" or "call_ignore"
-        message = (type, (call.name, call.args, call.kwargs))
-        cxn.send_message(message)
+        data = (call.name, call.args, call.kwargs)
+        if call.headers:
+            data += (call.headers, )
+        cxn.send_message((type, data))
         if not call.want_response:
             return CallResult(None)
 
-        type, data = cxn.recv_message()
+        type, data, headers = cxn.recv_message_with_headers()
+        call.result_headers = headers
+        if "load" in headers:
+            self.pool.record_remote_load(headers["load"])
+        if "etag" in headers or "ttl" in headers:
+            # Conditional and cacheable results are patched and copied by
+            # ``ClientWrapper``, so they can't be read-only proxies.
+            data = materialize(data)
         if type == "return":
             return CallResult(data)
         if type == "raise":
             raise RemoteException(data)
         if type in ["yield", "stop"]:
             return CallResult(ResultGenerator(cxn, self.pool.release,
-                                              (type, data)),
+                                              (type, data),
+                                              self.spool_threshold),
+                              holds_cxn=True)
+        if type == "file":
+            return CallResult(FileStream(cxn, self.pool.release, data["size"]),
                               holds_cxn=True)
         raise MessageError.bad_type(type)
 
     def server_is_alive(self):
+        """ Returns ``True`` if the remote is alive. Answered from the pool if
+            it has a connected connection, otherwise from the result of the
+            last check (shared by all clients of the remote), which is
+            refreshed in the background once it is older than
+            ``liveness_ttl`` seconds. Only the first check blocks. """
+        if self.pool.has_connected():
+            return True
+        liveness = self.pool.liveness
+        if liveness is None:
+            return self._check_liveness()
+        checked_at, is_alive = liveness
+        if time.time() - checked_at > self.liveness_ttl:
+            refresh = self.pool.liveness_refresh
+            if refresh is None or refresh.ready():
+                self.pool.liveness_refresh = gevent.spawn(self._check_liveness)
+        return is_alive
+
+    def _check_liveness(self):
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         try:
             with Timeout(1.0):
                 s.connect((self.remote.hostname, self.remote.port))
+            is_alive = True
         except (socket.error, Timeout):
-            return False
+            is_alive = False
         finally:
             s.close()
-        return True
+        self.pool.liveness = (time.time(), is_alive)
+        return is_alive
 
 
     def disconnect(self):
+        if self.batcher is not None:
+            self.batcher.flush()
         self.pool.disconnect()
 
 
@@ -82,10 +396,111 @@ class RemoteException(Exception):
     pass
 
 
+class CallBatcher(object):
+    """ Buffers fire-and-forget (``want_response=False``) calls to one remote
+        and sends them as a single ``call_batch`` message once ``max_size``
+        calls are buffered, or ``max_delay`` seconds after the first one was
+        buffered. A batch is also sent early if the next call wouldn't fit in
+        the same message (see ``MessageSocket.MSG_MAX_SIZE``).
+
+        As with unbatched fire-and-forget calls, errors are logged but not
+        raised; calls which couldn't be sent (including calls which are too
+        large to be sent at all) are counted in ``stats["dropped"]``. ``flush_all`` should be called before exiting
+        (``DirtApp`` does this) so that buffered calls aren't lost. """
+
+    active_batchers = {}
+
+    def __init__(self, pool, max_size=100, max_delay=0.05):
+        self.pool = pool
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.stats = {
+            "calls": 0,
+            "batches": 0,
+            "dropped": 0,
+        }
+        self._pending = []
+        # The (approximate) size of the ``call_batch`` message for
+        # ``_pending``
+        self._pending_size = 0
+        self._timer = None
+
+    @classmethod
+    def get_batcher(cls, pool, **kwargs):
+        """ Returns the batcher for ``pool``, creating it with ``kwargs`` if
+            necessary (so, as with pools, the first caller's options win). """
+        if pool not in cls.active_batchers:
+            cls.active_batchers[pool] = cls(pool, **kwargs)
+        return cls.active_batchers[pool]
+
+    @classmethod
+    def flush_all(cls):
+        for batcher in cls.active_batchers.values():
+            batcher.flush()
+
+    def add(self, call):
+        pending_call = (call.name, call.args, call.kwargs)
+        self.stats["calls"] += 1
+        try:
+            size = RPCConnectionBase.message_size(
+                ("call_batch", [pending_call]),
+                self.pool.connection_kwargs.get("frame_threshold"),
+            )
+        except Exception:
+            self._dropped([pending_call])
+            return
+        if size >= MessageSocket.MSG_MAX_SIZE:
+            self.stats["dropped"] += 1
+            log.error("%r: dropping %r: too large to send (%s bytes)",
+                      self, call, size)
+            return
+        if self._pending_size + size >= MessageSocket.MSG_MAX_SIZE:
+            self.flush()
+        self._pending.append(pending_call)
+        self._pending_size += size
+        if len(self._pending) >= self.max_size:
+            self.flush()
+        elif self._timer is None:
+            self._timer = gevent.spawn_later(self.max_delay, self.flush)
+
+    def flush(self):
+        """ Sends all buffered calls. """
+        timer, self._timer = self._timer, None
+        if timer is not None and timer is not gevent.getcurrent():
+            timer.kill(block=False)
+        calls, self._pending = self._pending, []
+        self._pending_size = 0
+        if not calls:
+            return
+        try:
+            cxn = self.pool.get_connection()
+        except Exception:
+            self._dropped(calls)
+            return
+        try:
+            cxn.send_message(("call_batch", calls))
+            self.stats["batches"] += 1
+        except Exception:
+            cxn.disconnect()
+            self._dropped(calls)
+        finally:
+            self.pool.release(cxn)
+
+    def _dropped(self, calls):
+        self.stats["dropped"] += len(calls)
+        log.exception("%r: dropping %s batched calls:", self, len(calls))
+
+    def __repr__(self):
+        return "<%s pool=%r pending=%s>" %(
+            type(self).__name__, self.pool, len(self._pending),
+        )
+
+
 class ResultGenerator(object):
-    def __init__(self, cxn, release_cxn, first_message):
+    def __init__(self, cxn, release_cxn, first_message, spool_threshold=None):
         self.cxn = cxn
         self.release_cxn = release_cxn
+        self.spool_threshold = spool_threshold
         self._first_call = [True, first_message]
 
     def __del__(self):
@@ -101,6 +516,18 @@ class ResultGenerator(object):
         self.cxn.disconnect()
         self.release_cxn(self.cxn)
 
+    def collect(self):
+        """ Returns all the remaining items. If a ``spool_threshold`` has been
+            set, they are returned in a ``SpooledList`` which will spill to
+            disk once the items grow beyond that many bytes; otherwise they
+            are returned in a ``list``. """
+        if self.spool_threshold is None:
+            return list(self)
+        result = SpooledList(self.spool_threshold,
+                             dumps=_spool_dumps, loads=_spool_loads)
+        result.extend(self)
+        return result
+
     def next(self):
         try:
             return self._next()
@@ -126,6 +553,102 @@ class ResultGenerator(object):
         raise MessageError.bad_type(type)
 
 
+class FileStream(object):
+    """ A read-only file-like object over the raw bytes of a ``FileResult``
+        being streamed from the server.
+
+        The connection is held until all ``size`` bytes have been read (or
+        ``save`` has been called); closing the stream early will disconnect
+        it. """
+
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, cxn, release_cxn, size):
+        self.cxn = cxn
+        self.release_cxn = release_cxn
+        self.size = size
+        self.remaining = size
+        self.closed = False
+        if size == 0:
+            self._release()
+
+    def __del__(self):
+        try:
+            self.close()
+        except:
+            pass
+
+    def _release(self, disconnect=False):
+        if self.closed:
+            return
+        self.closed = True
+        if disconnect:
+            self.cxn.disconnect()
+        self.release_cxn(self.cxn)
+
+    def _check_error(self, f, *args):
+        try:
+            return f(*args)
+        except:
+            self._release(disconnect=True)
+            raise
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        if size == 0:
+            return ""
+        data = self._check_error(self.cxn.msg_socket.recv_raw, size)
+        self.remaining -= size
+        if self.remaining == 0:
+            self._release()
+        return data
+
+    def __iter__(self):
+        while self.remaining:
+            yield self.read(self.CHUNK_SIZE)
+
+    def save(self, path_or_file):
+        """ Writes the rest of the stream to ``path_or_file`` (either a path or
+            a file-like object), returning the number of bytes written. """
+        if isinstance(path_or_file, basestring):
+            with open(path_or_file, "wb") as f:
+                return self.save(f)
+        written = 0
+        buf = bytearray(min(self.CHUNK_SIZE, self.remaining))
+        view = memoryview(buf)
+        while self.remaining:
+            chunk = view[:min(len(buf), self.remaining)]
+            self._check_error(self.cxn.msg_socket.recv_raw_into, chunk)
+            path_or_file.write(chunk)
+            self.remaining -= len(chunk)
+            written += len(chunk)
+        self._release()
+        return written
+
+    def close(self):
+        self._release(disconnect=self.remaining > 0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _spool_dumps(item):
+    # Binary frames (ex, ``memoryview``s) can't be pickled, so they are copied
+    # into ``str``s.
+    item, frames = extract_frames(item, None)
+    frames = [str(buffer(frame)) if not isinstance(frame, memoryview)
+              else frame.tobytes() for frame in frames]
+    return cPickle.dumps((item, frames), 2)
+
+def _spool_loads(data):
+    item, frames = cPickle.loads(data)
+    return restore_frames(item, frames)
+
+
 class CallResult(object):
     def __init__(self, result, holds_cxn=False):
         self.holds_cxn = holds_cxn
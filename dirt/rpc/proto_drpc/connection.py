@@ -1,6 +1,10 @@
+import os
 import sys
 import cgi
+import mmap
 import time
+import errno
+import tempfile
 import urllib
 import logging
 import functools
@@ -8,12 +12,26 @@ from itertools import chain
 
 import bson
 from gevent import socket
+from gevent.lock import BoundedSemaphore
 
-from dirt.rpc.common import expected
+from dirt.rpc.common import expected, RetryPolicy
+from dirt.misc.clock import monotonic
 from dirt.misc.strutil import truncate
 
+from .frames import extract_frames, restore_frames, frame_size
+from .lazybson import LazyDocument, materialize
+
 log = logging.getLogger(__name__)
 
+# ``os.sendfile`` is only available on Python 3; the ``pysendfile`` package
+# provides the same function for Python 2.
+sendfile = getattr(os, "sendfile", None)
+if sendfile is None:
+    try:
+        from sendfile import sendfile
+    except ImportError:
+        sendfile = None
+
 full_message_log = logging.getLogger(__name__ + ".full_message_log")
 full_message_log.propagate = False
 full_message_log.setLevel(logging.ERROR)
@@ -83,6 +101,13 @@ class EmptyRead(SocketError):
         ConnectionError.__init__(self, "empty read")
 
 
+@expected
+class PoolFullError(ConnectionError):
+    """ Raised by ``ConnectionPool.get_connection`` when the pool has
+        ``max_in_flight`` calls in progress and ``max_queued`` calls already
+        waiting for one of them to finish. """
+
+
 class MessageError(Exception):
     @classmethod
     def bad_type(cls, type):
@@ -138,7 +163,24 @@ class MessageSocket(object):
     MAGIC_ZLIB = "Z"
     MAGIC_NONE = "N"
 
-    def __init__(self, address, get_socket, version_info, use_zlib=False):
+    # Frames larger than this many bytes will be received into a temporary
+    # file and returned as an ``mmap`` instead of being held in memory (see
+    # ``recv_frame``). ``None`` disables spooling.
+    spool_threshold = None
+
+    # Frames larger than this many bytes (or messages followed by frames
+    # totalling more than this many bytes) are rejected with a
+    # ``MessageError``, so a peer can't make us allocate (or spool) an
+    # arbitrary amount of memory. ``None`` disables the limit.
+    max_frame_size = 256 * 1024 * 1024
+
+    # If true, ``header_time`` is set to the ``monotonic`` time at which the
+    # header of the last message was received.
+    record_timing = False
+    header_time = None
+
+    def __init__(self, address, get_socket, version_info, use_zlib=False,
+                 spool_threshold=None, max_frame_size=None):
         self.id = self._next_id()
         self.address = address
         self.version_info = dict(version_info)
@@ -147,6 +189,10 @@ class MessageSocket(object):
         self._socket = None
         self._get_socket = get_socket
         self.use_zlib = use_zlib
+        if spool_threshold is not None:
+            self.spool_threshold = spool_threshold
+        if max_frame_size is not None:
+            self.max_frame_size = max_frame_size
 
         # 'self.log.prefix' is expected to be set by code using this
         self.log = LogWrapper(log, "MessageSocket")
@@ -295,6 +341,8 @@ class MessageSocket(object):
 
     def _recv_one_message(self):
         header = self._socket_recv(self.MSG_HEADER_SIZE)
+        if self.record_timing:
+            self.header_time = monotonic()
         size_str, magic, type = header[:6], header[6], header[7]
         try:
             size = int(size_str, 16)
@@ -325,6 +373,126 @@ class MessageSocket(object):
         header = self.MSG_HEADER_FORMAT.format(size=size, magic=magic, type=type)
         self._socket_send(header + message)
 
+    @handle_error
+    def send_frames(self, frames):
+        """ Sends each of ``frames`` (``str``s or objects supporting the buffer
+            interface) as raw bytes. The peer is expected to know the size of
+            each frame (see ``recv_frame``). """
+        full_message_log.info("send frames %r", map(frame_size, frames))
+        for frame in frames:
+            self._socket_send(frame)
+
+    @handle_error
+    def recv_frames(self, sizes):
+        """ Receives the frames (see ``recv_frame``) following a message,
+            given their ``sizes`` (as sent by the peer), after checking that
+            they are no larger than ``max_frame_size`` in total. """
+        if not isinstance(sizes, list) or not all(
+                isinstance(size, (int, long)) and size >= 0 for size in sizes):
+            raise MessageError.invalid(sizes, "bad frame sizes")
+        self._check_frame_size(sum(sizes))
+        return map(self.recv_frame, sizes)
+
+    def _check_frame_size(self, size):
+        if self.max_frame_size is not None and size > self.max_frame_size:
+            raise MessageError.invalid(
+                "<%s bytes of frames>" %(size, ),
+                "larger than max_frame_size (%s)" %(self.max_frame_size, ),
+            )
+
+    @handle_error
+    def recv_frame(self, size):
+        """ Receives a ``size`` byte frame sent by ``send_frames``, returning a
+            ``memoryview`` over the buffer it was read into, or, if ``size`` is
+            larger than ``spool_threshold``, a read-only ``mmap`` of the
+            temporary file it was written to. Raises ``MessageError`` if
+            ``size`` is larger than ``max_frame_size``. """
+        full_message_log.info("recv frame %r", size)
+        self._check_frame_size(size)
+        if self.spool_threshold is not None and size > self.spool_threshold:
+            return self._recv_spooled(size)
+        view = memoryview(bytearray(size))
+        self._socket_recv_into(view)
+        return view
+
+    SPOOL_CHUNK_SIZE = 64 * 1024
+
+    def _recv_spooled(self, size):
+        # Note: the file is unlinked as soon as it's created, so the disk
+        # space will be released when the ``mmap`` is closed (or collected).
+        with tempfile.TemporaryFile(prefix="dirt-spool-") as f:
+            view = memoryview(bytearray(min(size, self.SPOOL_CHUNK_SIZE)))
+            remaining = size
+            while remaining:
+                chunk = view[:min(remaining, len(view))]
+                self._socket_recv_into(chunk)
+                f.write(chunk)
+                remaining -= len(chunk)
+            f.flush()
+            return mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+
+    @handle_error
+    def recv_raw(self, size):
+        """ Receives exactly ``size`` raw bytes (ex, sent by ``send_file``). """
+        return self._socket_recv(size)
+
+    @handle_error
+    def recv_raw_into(self, view):
+        """ Receives exactly ``len(view)`` raw bytes into ``view``. """
+        self._socket_recv_into(view)
+
+    def _socket_recv_into(self, view):
+        if self._socket is None:
+            self.connect()
+        size = len(view)
+        read = 0
+        while read < size:
+            count = self._socket.recv_into(view[read:], size - read)
+            if count == 0:
+                self.log.debug("empty read")
+                raise EmptyRead()
+            read += count
+
+    SEND_FILE_CHUNK_SIZE = 64 * 1024
+
+    @handle_error
+    def send_file(self, file, offset, count):
+        """ Sends ``count`` bytes of ``file``, starting at ``offset``, as raw
+            bytes. ``sendfile`` is used if it's available, so the data never
+            passes through Python. """
+        full_message_log.info("send file %r offset=%r count=%r",
+                              file, offset, count)
+        if self._socket is None:
+            self.connect()
+        if sendfile is None:
+            return self._send_file_fallback(file, offset, count)
+
+        sock_fd = self._socket.fileno()
+        file_fd = file.fileno()
+        while count > 0:
+            try:
+                sent = sendfile(sock_fd, file_fd, offset, count)
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+                socket.wait_write(sock_fd, timeout=self._socket.gettimeout())
+                continue
+            if sent == 0:
+                raise ConnectionError("file %r ended %s bytes early"
+                                      %(file, count))
+            offset += sent
+            count -= sent
+
+    def _send_file_fallback(self, file, offset, count):
+        file.seek(offset)
+        while count > 0:
+            data = file.read(min(count, self.SEND_FILE_CHUNK_SIZE))
+            if not data:
+                raise ConnectionError("file %r ended %s bytes early"
+                                      %(file, count))
+            self._socket.sendall(data)
+            count -= len(data)
+
     def __repr__(self):
         state = self._socket and "connected" or "not connected"
         return "<%s %s %s to %s>" %(
@@ -344,32 +512,128 @@ def delegate(field_name, target_name):
 
 
 class RPCConnectionBase(object):
-    """ Uses a ``MessageSocket`` to send and receive RPC messages. """
-
-    VERSION = "2"
+    """ Uses a ``MessageSocket`` to send and receive RPC messages.
+
+        ``buffer``, ``bytearray`` and ``memoryview`` values (and, if a
+        ``frame_threshold`` is set, ``str`` values of at least that many
+        bytes) are sent as raw frames after the message instead of being
+        serialized into it, and will be received as ``memoryview``s (see
+        ``frames.py``). ``frame_threshold`` defaults to ``None``, so ``str``
+        values are received as ``str``s unless the sender opts in. Frames
+        larger than ``max_frame_size`` are rejected (see ``MessageSocket``).
+
+        If ``lazy_decode`` is true, the data of received messages will be
+        decoded lazily, and documents and arrays will be returned as
+        read-only ``LazyDocument`` and ``LazyArray`` proxies (see
+        ``lazybson.py``).
+
+        Once ``enable_timing`` has been called, ``recv_timestamps`` holds the
+        ``monotonic`` times at which the last message was ``received`` (its
+        header arrived), ``read`` and ``decoded``, and ``send_message``
+        returns the times at which the message was ``serialized`` and
+        ``sent``. """
+
+    # Peers must report exactly the same version during the handshake (see
+    # ``MessageSocket``), so clients and servers have to be upgraded
+    # together: version 3 (which adds the optional headers element to
+    # messages) refuses connections to and from version 2 peers with a
+    # ``VERSION_MISMATCH`` ``ConnectionError`` before any call is sent.
+    VERSION = "3"
     serializer = bson
+    frame_threshold = None
+
+    lazy_decode = False
 
-    def __init__(self, address, use_zlib=None):
+    def __init__(self, address, use_zlib=None, spool_threshold=None,
+                 lazy_decode=None, frame_threshold=None, max_frame_size=None):
+        if lazy_decode is not None:
+            self.lazy_decode = lazy_decode
+        if frame_threshold is not None:
+            self.frame_threshold = frame_threshold
         if use_zlib is None:
             use_zlib = address[0] not in ["127.0.0.1", "localhost"]
         self.msg_socket = MessageSocket(address, self._get_socket, {
             "rpc": self.VERSION,
-        }, use_zlib=use_zlib)
+        }, use_zlib=use_zlib, spool_threshold=spool_threshold,
+        max_frame_size=max_frame_size)
         self.msg_socket.on_connect = self._on_connect
         self.msg_socket.on_disconnect = self._on_disconnect
         self._last_txrx_time = 0
+        self.record_timing = False
+        self.recv_timestamps = None
 
-    def _dumps(self, message):
+    def enable_timing(self):
+        """ Starts recording when messages are received and sent. """
+        self.record_timing = True
+        self.msg_socket.record_timing = True
+
+    def _dumps(self, message, frame_sizes=None):
         # Because BSON will only serialize objects at the top level, wrap
         # the message in an object.
-        return self.serializer.dumps({"m": message})
+        envelope = {"m": message}
+        if frame_sizes:
+            envelope["f"] = frame_sizes
+        return self.serializer.dumps(envelope)
+
+    @classmethod
+    def message_size(cls, message, frame_threshold=None):
+        """ Returns the size of ``message`` once it has been serialized (not
+            counting the frames its binary values are sent in), for checking
+            it against ``MessageSocket.MSG_MAX_SIZE`` before it is sent. """
+        message, frames = extract_frames(message, frame_threshold)
+        envelope = {"m": message}
+        if frames:
+            envelope["f"] = map(frame_size, frames)
+        return len(cls.serializer.dumps(envelope))
 
     def _loads(self, message):
-        return self.serializer.loads(message)["m"]
+        return self._loads_envelope(message)[0]
+
+    def _loads_envelope(self, message):
+        """ Returns ``(message, frame_sizes)``. """
+        envelope = self.serializer.loads(message)
+        return envelope["m"], envelope.get("f")
+
+    def _recv_lazy(self, message):
+        """ Returns ``(message, frame_sizes)``, where the data of ``message``
+            will be decoded lazily. Frames will be resolved as they are
+            accessed, so they do not need to be restored. """
+        frames = []
+        envelope = LazyDocument(message, frames=frames)
+        frame_sizes = materialize(envelope.get("f"))
+        if frame_sizes:
+            frames.extend(self.msg_socket.recv_frames(frame_sizes))
+        message = envelope["m"]
+        # The type and headers are small, so decode them right away
+        message = (message[0], ) + tuple(message[1:2]) + tuple(
+            materialize(headers) for headers in message[2:3]
+        )
+        return message
 
     def recv_message(self):
         """ Returns a (rpc_command, data) message tuple. """
-        message = self._loads(self.msg_socket.recv_message())
+        return self.recv_message_with_headers()[:2]
+
+    def recv_message_with_headers(self):
+        """ Returns a (rpc_command, data, headers) message tuple, where
+            ``headers`` is a (possibly empty) dict of protocol-level options
+            sent along with the message. """
+        data = self.msg_socket.recv_message()
+        if self.record_timing:
+            time_read = monotonic()
+        if self.lazy_decode:
+            message = self._recv_lazy(data)
+        else:
+            message, frame_sizes = self._loads_envelope(data)
+            if frame_sizes:
+                frames = self.msg_socket.recv_frames(frame_sizes)
+                message = restore_frames(message, frames)
+        if self.record_timing:
+            self.recv_timestamps = {
+                "received": self.msg_socket.header_time,
+                "read": time_read,
+                "decoded": monotonic(),
+            }
         if self.log.isEnabledFor(logging.DEBUG):
             last_activity = self._last_txrx_time
             self.log.debug("recv since_last=%0.04f %s",
@@ -378,20 +642,37 @@ class RPCConnectionBase(object):
         self._last_txrx_time = time.time()
         if len(message) == 1:
             message = (message[0], None)
-        if len(message) > 2:
+        if len(message) > 3:
             raise MessageError.invalid(message, "too big")
-        return (message[0], message[1])
+        headers = len(message) == 3 and message[2] or {}
+        return (message[0], message[1], headers)
 
     def send_message(self, message):
+        """ Sends a ``(rpc_command, data)`` or ``(rpc_command, data,
+            headers)`` message tuple. If timing is enabled, returns a dict of
+            the times at which the message was ``serialized`` and ``sent``.
+            """
         if self.log.isEnabledFor(logging.DEBUG):
             last_activity = self._last_txrx_time
             self.log.debug("send since_last=%0.04f %s",
                            last_activity and time.time() - last_activity,
                            truncate(repr(message), max_len=256))
         self._last_txrx_time = time.time()
-        if len(message) > 2:
+        if len(message) > 3:
             raise MessageError.invalid(message, "too big")
-        self.msg_socket.send_message(self._dumps(message))
+        message, frames = extract_frames(message, self.frame_threshold)
+        frame_sizes = frames and map(frame_size, frames) or None
+        data = self._dumps(message, frame_sizes)
+        if self.record_timing:
+            time_serialized = monotonic()
+        self.msg_socket.send_message(data)
+        if frames:
+            self.msg_socket.send_frames(frames)
+        if self.record_timing:
+            return {
+                "serialized": time_serialized,
+                "sent": monotonic(),
+            }
 
     def _get_socket(self):
         raise Exception("_get_socket should be implemented by subclasses")
@@ -417,9 +698,13 @@ class ClientConnection(RPCConnectionBase):
     """ Wraps a client-side socket, re-establishing a connection to the server
         as necessary (eg, if the connection is disconnected due to an error). """
 
-    def __init__(self, address, socket_timeout=None):
+    def __init__(self, address, socket_timeout=None, spool_threshold=None,
+                 lazy_decode=None, frame_threshold=None, max_frame_size=None):
         self.socket_timeout = socket_timeout
-        super(ClientConnection, self).__init__(address)
+        super(ClientConnection, self).__init__(
+            address, spool_threshold=spool_threshold, lazy_decode=lazy_decode,
+            frame_threshold=frame_threshold, max_frame_size=max_frame_size,
+        )
         self.log.prefix = "%s-%s to %s:%s: " %(
             self.__class__.__name__, self.id, address[0], address[1]
         )
@@ -462,13 +747,35 @@ class ConnectionPool(object):
         I expect this behaviour will be OK, as we should never *need* that many
         connections, so if that limit is ever hit it means we're leaking
         connections... So explicitly erroring will just hasten the inevitable.
+
+        ``max_in_flight`` (default: ``None``, unlimited) limits the number of
+        connections which can be in use at once, so that a remote which has
+        stopped responding can only tie up that many greenlets. Up to
+        ``max_queued`` (default: ``None``, unlimited) further callers wait for
+        a connection to be released, and any others fail immediately with
+        ``PoolFullError``.
+
+        ``retry_policy`` (a ``RetryPolicy``, or a dict of arguments for one;
+        default: ``RetryPolicy()``) is used by all the clients of the pool,
+        so they share one retry budget for the remote.
+
+        Any extra ``connection_options`` (ex, ``spool_threshold``) are passed
+        to each connection.
+
+        Pools are shared by all the clients in a process (see ``get_pool``),
+        but not with a forked child, which gets new pools (and connections)
+        the first time it asks for one.
         """
 
     active_pools = {}
+    # The pid of the process which created ``active_pools``
+    active_pools_pid = os.getpid()
     _instance_count = 0
 
     def __init__(self, address, connection_class=ClientConnection,
-                 max_connections=None, keep_connections=None):
+                 max_connections=None, keep_connections=None,
+                 max_in_flight=None, max_queued=None, retry_policy=None,
+                 **connection_options):
         num = type(self)._instance_count
         type(self)._instance_count += 1
         self.log = logging.getLogger(__name__ + ".ConnectionPool-%02d" %(num, ))
@@ -476,13 +783,35 @@ class ConnectionPool(object):
         self.connection_kwargs = {
             "address": address,
         }
+        self.connection_kwargs.update(connection_options)
         self.max_connections = max_connections or 32
         self._created_connections = 0
         self._available_connections = []
         self._in_use_connections = set()
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self._in_flight = None
+        if max_in_flight is not None:
+            self._in_flight = BoundedSemaphore(max_in_flight)
+        self._queued = 0
+        self._total_queued = 0
+        self._total_rejected = 0
+        self.retry_policy = RetryPolicy.from_setting(retry_policy)
+        # The last load reported by the remote (see ``APIEdge.get_load``)
+        self.remote_load = None
+        # ``(time checked, is_alive)`` of the last liveness check (see
+        # ``Client.server_is_alive``), and the greenlet refreshing it.
+        self.liveness = None
+        self.liveness_refresh = None
 
     @classmethod
     def get_pool(cls, address, **kwargs):
+        if ConnectionPool.active_pools_pid != os.getpid():
+            # Connections inherited from the parent process can't be shared
+            # with it, so forget them (without closing them, which would
+            # affect the parent too).
+            cls.active_pools.clear()
+            ConnectionPool.active_pools_pid = os.getpid()
         if address not in cls.active_pools:
             cls.active_pools[address] = cls(address, **kwargs)
         return cls.active_pools[address]
@@ -492,11 +821,35 @@ class ConnectionPool(object):
                        len(self._in_use_connections),
                        len(self._available_connections))
 
+    def _acquire_in_flight(self):
+        if self._in_flight is None:
+            return
+        if self._in_flight.locked():
+            if self.max_queued is not None and self._queued >= self.max_queued:
+                self._total_rejected += 1
+                raise PoolFullError("too many calls in flight (%s) and queued "
+                                    "(%s)" %(self.max_in_flight, self._queued),
+                                    peer=self.connection_kwargs["address"])
+            self._queued += 1
+            self._total_queued += 1
+            try:
+                self._in_flight.acquire()
+            finally:
+                self._queued -= 1
+            return
+        self._in_flight.acquire()
+
     def get_connection(self):
+        self._acquire_in_flight()
         try:
             connection = self._available_connections.pop()
         except IndexError:
-            connection = self._make_connection()
+            try:
+                connection = self._make_connection()
+            except:
+                if self._in_flight is not None:
+                    self._in_flight.release()
+                raise
         self._in_use_connections.add(connection)
         self._log_change("allocating", connection)
         return connection
@@ -512,9 +865,30 @@ class ConnectionPool(object):
         self._created_connections += 1
         return self.connection_class(**self.connection_kwargs)
 
+    def has_connected(self):
+        """ Returns ``True`` if any of this pool's connections are currently
+            connected to the remote. """
+        return any(
+            connection.connected() for connection in
+            chain(self._available_connections, self._in_use_connections)
+        )
+
+    def record_remote_load(self, load):
+        """ Records the ``[active, queued, latency_ms]`` load reported by the
+            remote in the ``load`` header of a response. """
+        active, queued, latency_ms = load
+        self.remote_load = {
+            "active": active,
+            "queued": queued,
+            "latency_ms": latency_ms,
+            "time": time.time(),
+        }
+
     def release(self, connection):
         self._in_use_connections.remove(connection)
         self._available_connections.append(connection)
+        if self._in_flight is not None:
+            self._in_flight.release()
         self._log_change("releasing", connection)
 
     def disconnect(self):
@@ -537,6 +911,12 @@ class ConnectionPool(object):
             "num_inactive": len(self._available_connections),
             "num_created": self._created_connections,
             "num_max": self.max_connections,
+            "max_in_flight": self.max_in_flight,
+            "max_queued": self.max_queued,
+            "num_queued": self._queued,
+            "total_queued": self._total_queued,
+            "total_rejected": self._total_rejected,
+            "remote_load": self.remote_load,
         }
 
     def __repr__(self):
@@ -0,0 +1,173 @@
+""" Support for sending large binary values "out of band".
+
+    Instead of being serialized into the message, large binary values (``str``
+    values of at least ``threshold`` bytes, and all ``buffer``, ``bytearray``
+    and ``memoryview`` values) are replaced with a reference and sent as raw
+    frames following the message. On the receiving side each frame is read
+    directly into its own buffer and the references are replaced with
+    ``memoryview``s over those buffers, so the data is never copied by the
+    serializer.
+
+    For example::
+
+        >>> message, frames = extract_frames(("return", ["x" * 10]), 8)
+        >>> message
+        ('return', [{'__dirt_frame__': 0}])
+        >>> frames
+        ['xxxxxxxxxx']
+        >>> restore_frames(message, frames)
+        ('return', ['xxxxxxxxxx'])
+        >>>
+
+    If NumPy is available, ``ndarray``s are sent as their dtype, shape and
+    order (``"C"`` or ``"F"``; non-contiguous arrays are copied into C order
+    first) along with a frame containing their raw data, and rebuilt on the
+    receiving side as arrays over the received buffer (without any
+    per-element conversion). If the receiving side doesn't have NumPy, it
+    will get a dict of ``dtype``, ``shape``, ``order`` and ``data`` (a
+    ``memoryview``) instead.
+    """
+import mmap
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+FRAME_KEY = "__dirt_frame__"
+NDARRAY_KEY = "__dirt_ndarray__"
+
+FRAME_TYPES = (buffer, bytearray, memoryview, mmap.mmap)
+
+def extract_frames(obj, threshold):
+    """ Returns ``(obj, frames)``, where large binary values in ``obj`` have
+        been replaced by references to items in the ``frames`` list.
+
+        Containers are only copied if they contain a value which has been
+        replaced. """
+    frames = []
+    return _extract(obj, threshold, frames), frames
+
+def _extract(obj, threshold, frames):
+    if isinstance(obj, str):
+        if threshold is None or len(obj) < threshold:
+            return obj
+        return _add_frame(obj, frames)
+
+    if isinstance(obj, FRAME_TYPES):
+        return _add_frame(obj, frames)
+
+    if numpy is not None and isinstance(obj, numpy.ndarray):
+        return _extract_ndarray(obj, threshold, frames)
+
+    if isinstance(obj, (list, tuple)):
+        new_items = None
+        for idx, item in enumerate(obj):
+            new_item = _extract(item, threshold, frames)
+            if new_item is not item:
+                if new_items is None:
+                    new_items = list(obj)
+                new_items[idx] = new_item
+        if new_items is None:
+            return obj
+        return type(obj)(new_items)
+
+    if isinstance(obj, dict):
+        new_obj = None
+        for key, item in obj.iteritems():
+            new_item = _extract(item, threshold, frames)
+            if new_item is not item:
+                if new_obj is None:
+                    new_obj = dict(obj)
+                new_obj[key] = new_item
+        return obj if new_obj is None else new_obj
+
+    return obj
+
+def _add_frame(value, frames):
+    frames.append(value)
+    return {FRAME_KEY: len(frames) - 1}
+
+def _extract_ndarray(array, threshold, frames):
+    if array.dtype.hasobject or array.dtype.fields is not None:
+        # Object and structured arrays can't be described by a simple dtype
+        # string, so fall back to sending them as (nested) lists.
+        return _extract(array.tolist(), threshold, frames)
+    flags = array.flags
+    if flags.c_contiguous:
+        order = "C"
+    elif flags.f_contiguous:
+        order = "F"
+    else:
+        array = numpy.ascontiguousarray(array)
+        order = "C"
+    # Note: ``buffer`` needs a C-contiguous array, and the transpose of an
+    # F-contiguous array is C-contiguous (with the same memory layout).
+    data = array if order == "C" else array.T
+    return {NDARRAY_KEY: {
+        "dtype": array.dtype.str,
+        "shape": list(array.shape),
+        "order": order,
+        "data": _add_frame(buffer(data), frames),
+    }}
+
+def _restore_ndarray(desc):
+    if numpy is None:
+        return desc
+    # The descriptor comes from the peer, so check that it describes exactly
+    # the data in the frame before building an array over it.
+    dtype = numpy.dtype(str(desc["dtype"]))
+    shape = tuple(desc["shape"])
+    order = desc["order"]
+    data = desc["data"]
+    if order not in ("C", "F"):
+        raise ValueError("invalid ndarray order: %r" %(order, ))
+    if any(dim < 0 for dim in shape):
+        raise ValueError("invalid ndarray shape: %r" %(shape, ))
+    size = dtype.itemsize * reduce(lambda a, b: a * b, shape, 1)
+    if size != frame_size(data):
+        raise ValueError("ndarray of shape %r and dtype %r needs %s bytes, "
+                         "but its frame has %s" %(shape, dtype.str, size,
+                                                  frame_size(data)))
+    if isinstance(data, memoryview):
+        # Note: ``numpy.frombuffer`` can't read from a ``memoryview`` on
+        # Python 2, but ``asarray`` can, and neither copies the data.
+        flat = numpy.asarray(data).view(dtype)
+    else:
+        flat = numpy.frombuffer(data, dtype=dtype)
+    return flat.reshape(shape, order=order)
+
+def restore_frames(obj, frames):
+    """ Replaces the frame references in ``obj`` with the corresponding item
+        from ``frames``. Lists and dicts are updated in place. """
+    if isinstance(obj, dict):
+        if len(obj) == 1 and FRAME_KEY in obj:
+            return frames[obj[FRAME_KEY]]
+        for key, item in obj.iteritems():
+            if isinstance(item, (list, tuple, dict)):
+                obj[key] = restore_frames(item, frames)
+        if len(obj) == 1 and NDARRAY_KEY in obj:
+            return _restore_ndarray(obj[NDARRAY_KEY])
+        return obj
+
+    if isinstance(obj, list):
+        for idx, item in enumerate(obj):
+            if isinstance(item, (list, tuple, dict)):
+                obj[idx] = restore_frames(item, frames)
+        return obj
+
+    if isinstance(obj, tuple):
+        return tuple(restore_frames(list(obj), frames))
+
+    return obj
+
+def frame_size(frame):
+    """ Returns the size, in bytes, of ``frame``. """
+    if isinstance(frame, memoryview):
+        return frame.itemsize * reduce(lambda a, b: a * b, frame.shape, 1)
+    return len(frame)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
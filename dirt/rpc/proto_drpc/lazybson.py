@@ -0,0 +1,198 @@
+""" A lazy BSON decoder.
+
+    ``LazyDocument`` and ``LazyArray`` are read-only mapping and sequence
+    proxies over an encoded BSON document. Only the element names and offsets
+    of a document are read when it is first accessed; values are decoded
+    when (and if) they are accessed, and sub-documents and arrays are
+    returned as further lazy proxies. This makes reading a few fields of a
+    large response much cheaper than decoding all of it.
+
+    For example::
+
+        >>> doc = LazyDocument(bson.dumps({"a": {"b": [1, 2, 3]}, "c": u"x"}))
+        >>> doc["a"]["b"][1]
+        2
+        >>> materialize(doc) == {"a": {"b": [1, 2, 3]}, "c": u"x"}
+        True
+        >>>
+    """
+import struct
+from collections import Mapping, Sequence
+
+import bson
+from bson import codec
+
+from .frames import FRAME_KEY, NDARRAY_KEY, restore_frames
+
+_int32 = struct.Struct("<i")
+
+# Sizes of fixed-width values, by BSON element type
+_FIXED_SIZES = {
+    0x01: 8,  # double
+    0x07: 12, # ObjectId
+    0x08: 1,  # boolean
+    0x09: 8,  # UTC datetime
+    0x0A: 0,  # null
+    0x10: 4,  # int32
+    0x11: 8,  # timestamp
+    0x12: 8,  # int64
+}
+
+def _value_size(data, element_type, pos):
+    size = _FIXED_SIZES.get(element_type)
+    if size is not None:
+        return size
+    if element_type in (0x03, 0x04):
+        return _int32.unpack_from(data, pos)[0]
+    if element_type == 0x02:
+        return 4 + _int32.unpack_from(data, pos)[0]
+    if element_type == 0x05:
+        return 5 + _int32.unpack_from(data, pos)[0]
+    raise ValueError("unsupported BSON element type: 0x%02x" %(element_type, ))
+
+def _scan(data, offset):
+    """ Yields ``(name, element_type, element_offset, value_offset)`` for each
+        element of the document at ``offset``. """
+    end = offset + _int32.unpack_from(data, offset)[0] - 1
+    pos = offset + 4
+    while pos < end:
+        element_type = ord(data[pos])
+        name_end = data.index("\x00", pos + 1)
+        value_pos = name_end + 1
+        yield data[pos + 1:name_end], element_type, pos, value_pos
+        pos = value_pos + _value_size(data, element_type, value_pos)
+
+def _decode(data, element_type, element_pos, value_pos, frames):
+    if element_type == 0x03:
+        doc = LazyDocument(data, value_pos, frames)
+        if frames is not None and len(doc) == 1 and (
+            FRAME_KEY in doc or NDARRAY_KEY in doc
+        ):
+            return restore_frames(doc.to_python(), frames)
+        return doc
+    if element_type == 0x04:
+        return LazyArray(data, value_pos, frames)
+    return codec.decode_element(data, element_pos)[2]
+
+
+class LazyDocument(Mapping):
+    """ A read-only mapping over the BSON document at ``offset`` in ``data``.
+
+        ``frames`` is the list of out-of-band frames which were sent along with
+        the message (see ``frames.py``); references to them are resolved on
+        access. """
+
+    def __init__(self, data, offset=0, frames=None):
+        self._data = data
+        self._offset = offset
+        self._frames = frames
+        self._index = None
+        self._cache = {}
+
+    def _get_index(self):
+        if self._index is None:
+            self._keys = []
+            self._index = {}
+            for name, element_type, element_pos, value_pos in \
+                    _scan(self._data, self._offset):
+                name = name.decode("utf-8")
+                self._keys.append(name)
+                self._index[name] = (element_type, element_pos, value_pos)
+        return self._index
+
+    def __getitem__(self, key):
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+        element = self._get_index()[key]
+        value = _decode(self._data, element[0], element[1], element[2],
+                        self._frames)
+        self._cache[key] = value
+        return value
+
+    def __iter__(self):
+        self._get_index()
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._get_index())
+
+    def __contains__(self, key):
+        return key in self._get_index()
+
+    def __deepcopy__(self, memo):
+        # Read-only, so copies (ex, of cached results) can share it
+        return self
+
+    def to_python(self):
+        """ Returns a ``dict`` of this (fully decoded) document. """
+        return dict((key, materialize(self[key])) for key in self)
+
+    def __repr__(self):
+        size = _int32.unpack_from(self._data, self._offset)[0]
+        return "<%s %s bytes>" %(type(self).__name__, size)
+
+
+class LazyArray(Sequence):
+    """ A read-only sequence over the BSON array at ``offset`` in ``data``. """
+
+    def __init__(self, data, offset=0, frames=None):
+        self._data = data
+        self._offset = offset
+        self._frames = frames
+        self._index = None
+        self._cache = {}
+
+    def _get_index(self):
+        if self._index is None:
+            self._index = [
+                (element_type, element_pos, value_pos)
+                for _, element_type, element_pos, value_pos
+                in _scan(self._data, self._offset)
+            ]
+        return self._index
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in xrange(*idx.indices(len(self)))]
+        index = self._get_index()
+        if idx < 0:
+            idx += len(index)
+        try:
+            return self._cache[idx]
+        except KeyError:
+            pass
+        element = index[idx]
+        value = _decode(self._data, element[0], element[1], element[2],
+                        self._frames)
+        self._cache[idx] = value
+        return value
+
+    def __len__(self):
+        return len(self._get_index())
+
+    def __deepcopy__(self, memo):
+        # Read-only, so copies (ex, of cached results) can share it
+        return self
+
+    def to_python(self):
+        """ Returns a ``list`` of this (fully decoded) array. """
+        return [materialize(item) for item in self]
+
+    def __repr__(self):
+        size = _int32.unpack_from(self._data, self._offset)[0]
+        return "<%s %s bytes>" %(type(self).__name__, size)
+
+
+def materialize(value):
+    """ Returns ``value`` with any lazy proxies fully decoded into ``dict``s
+        and ``list``s. """
+    if isinstance(value, (LazyDocument, LazyArray)):
+        return value.to_python()
+    return value
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
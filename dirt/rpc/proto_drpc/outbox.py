@@ -0,0 +1,345 @@
+""" A durable, disk-backed outbox for fire-and-forget calls.
+
+    Calls are appended to segment files in a local directory, and a background
+    greenlet delivers them to the remote in batches (using ``call_batch_ack``
+    messages, which the server acknowledges once the calls have been handled),
+    backing off while the remote is unavailable. Segments are deleted once all
+    of their calls have been acknowledged.
+
+    Calls are delivered at least once: if the process exits after a batch was
+    handled by the remote but before the acknowledgement was recorded, that
+    batch will be delivered again when the outbox is next opened.
+
+    Calls which can never be delivered (because they can't be decoded, or
+    can't be serialized into a message) are moved to the ``dead-letter`` file
+    in the outbox's directory (in the same format as the segments) instead
+    of blocking the calls queued behind them.
+
+    Each outbox holds an exclusive lock (``flock``) on its directory while it
+    is open, so two processes never append to (or deliver) the same
+    segments; see ``Outbox.get_outbox``.
+    """
+import os
+import errno
+import fcntl
+import struct
+import logging
+import cPickle
+import itertools
+
+import gevent
+from gevent.event import Event
+
+from dirt.rpc.common import RetryPolicy
+
+from .connection import MessageSocket, RPCConnectionBase
+
+log = logging.getLogger(__name__)
+
+
+class Outbox(object):
+    """ Appends fire-and-forget calls to segment files in ``path`` and
+        delivers them to the remote of ``pool``.
+
+        ``segment_size`` is the size (in bytes) after which a new segment is
+        started, and ``max_size`` the total size of unacknowledged calls after
+        which new calls are dropped (and counted in ``stats["dropped"]``)
+        instead of being written. ``batch_size`` is the maximum number of
+        calls delivered in one message.
+
+        Outboxes are shared by all the clients of one remote in a process
+        (see ``get_outbox``). An ``IOError`` (with ``errno.EWOULDBLOCK``) is
+        raised if another outbox (in this or another process) has ``path``
+        open. """
+
+    active_outboxes = {}
+    # The pid of the process which created ``active_outboxes``
+    active_outboxes_pid = os.getpid()
+
+    _length = struct.Struct("<I")
+
+    def __init__(self, pool, path, segment_size=1024 * 1024,
+                 max_size=64 * 1024 * 1024, batch_size=100):
+        self.pool = pool
+        self.path = path
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.batch_size = batch_size
+        # The key of this outbox in ``active_outboxes``, if it's there
+        self._active_key = None
+        self.backoff = RetryPolicy(base_delay=0.1, max_delay=30)
+        self.stats = {
+            "appended": 0,
+            "delivered": 0,
+            "dropped": 0,
+            "dead": 0,
+            "failures": 0,
+        }
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self._lock = open(os.path.join(path, "lock"), "a")
+        try:
+            fcntl.flock(self._lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except:
+            self._lock.close()
+            raise
+        self._segments = sorted(
+            int(name.split(".")[0]) for name in os.listdir(path)
+            if name.endswith(".seg")
+        )
+        # Always start a new segment for writing, in case the last one ended
+        # with a partially written record.
+        self._next_segment = (self._segments and self._segments[-1] or 0) + 1
+        self._writer = None
+        self._writer_segment = None
+        self._reader = None
+        self._reader_segment = None
+        self._read_offset = self._read_ack_offset()
+        self._size = sum(
+            os.path.getsize(self._segment_path(segment))
+            for segment in self._segments
+        ) - self._read_offset
+        self._wakeup = Event()
+        self._delivery = gevent.spawn(self._deliver_forever)
+
+    @classmethod
+    def get_outbox(cls, pool, path, **kwargs):
+        """ Returns the outbox for the remote of ``pool`` in ``path``, creating
+            it with ``kwargs`` if necessary. Each remote's calls are kept in a
+            subdirectory of ``path`` named after its address, so one ``path``
+            can be used by the clients of many remotes.
+
+            Each process (ex, each of several workers, or a child after a
+            fork) opens its own outbox in a numbered subdirectory of the
+            remote's directory: the first one which isn't locked by another
+            process. Calls left behind by a process which has exited are
+            delivered by the next process to open its subdirectory. """
+        if Outbox.active_outboxes_pid != os.getpid():
+            # Outboxes inherited from the parent process belong to it (and
+            # their delivery greenlets were copied by the fork), so stop
+            # their delivery in this process and forget them (without
+            # closing their files, which would release the parent's locks).
+            for outbox in cls.active_outboxes.values():
+                outbox._delivery.kill(block=False)
+            cls.active_outboxes.clear()
+            Outbox.active_outboxes_pid = os.getpid()
+        remote_path = os.path.join(
+            os.path.abspath(path),
+            "%s_%s" %tuple(pool.connection_kwargs["address"]),
+        )
+        if remote_path in cls.active_outboxes:
+            return cls.active_outboxes[remote_path]
+        for slot in itertools.count():
+            try:
+                outbox = cls(pool, os.path.join(remote_path, str(slot)),
+                             **kwargs)
+                break
+            except IOError as e:
+                if e.errno != errno.EWOULDBLOCK:
+                    raise
+        outbox._active_key = remote_path
+        cls.active_outboxes[remote_path] = outbox
+        return outbox
+
+    def _segment_path(self, segment):
+        return os.path.join(self.path, "%010d.seg" %(segment, ))
+
+    def _ack_path(self):
+        return os.path.join(self.path, "ack")
+
+    def _dead_letter_path(self):
+        return os.path.join(self.path, "dead-letter")
+
+    def _read_ack_offset(self):
+        """ Returns the acknowledged offset into the oldest segment. """
+        try:
+            with open(self._ack_path()) as f:
+                segment, offset = map(int, f.read().split())
+        except (IOError, ValueError):
+            return 0
+        if not self._segments or segment != self._segments[0]:
+            return 0
+        return offset
+
+    def _write_ack_offset(self, segment, offset):
+        tmp_path = self._ack_path() + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write("%s %s\n" %(segment, offset))
+        os.rename(tmp_path, self._ack_path())
+
+    def append(self, call):
+        """ Appends ``call`` to the outbox, to be delivered later. """
+        data = cPickle.dumps((call.name, call.args, call.kwargs), 2)
+        record_size = self._length.size + len(data)
+        if self._size + record_size > self.max_size:
+            self.stats["dropped"] += 1
+            log.warning("%r is full; dropping %r", self, call)
+            return
+        if self._writer is None or self._writer.tell() >= self.segment_size:
+            self._start_segment()
+        self._writer.write(self._length.pack(len(data)) + data)
+        self._writer.flush()
+        self._size += record_size
+        self.stats["appended"] += 1
+        self._wakeup.set()
+
+    def _start_segment(self):
+        if self._writer is not None:
+            self._writer.close()
+        segment = self._next_segment
+        self._next_segment += 1
+        self._writer = open(self._segment_path(segment), "ab")
+        self._writer_segment = segment
+        self._segments.append(segment)
+
+    def _read_batch(self):
+        """ Returns ``(segment, end_offset, calls)`` for the next batch of
+            unacknowledged calls (which will fit in one message), deleting
+            segments which have been fully delivered and dead lettering calls
+            which can't be delivered. Returns ``None`` if there are no calls
+            to deliver. """
+        while self._segments:
+            segment = self._segments[0]
+            if self._reader_segment != segment:
+                if self._reader is not None:
+                    self._reader.close()
+                self._reader = open(self._segment_path(segment), "rb")
+                self._reader_segment = segment
+            self._reader.seek(self._read_offset)
+            calls = []
+            offset = self._read_offset
+            message_size = 0
+            while len(calls) < self.batch_size:
+                header = self._reader.read(self._length.size)
+                if len(header) < self._length.size:
+                    break
+                size = self._length.unpack(header)[0]
+                data = self._reader.read(size)
+                if len(data) < size:
+                    break
+                try:
+                    call = cPickle.loads(data)
+                    call_size = self._message_size(call)
+                except Exception as e:
+                    if calls:
+                        # Deliver the calls before it first, so it's only
+                        # dead lettered once (even if their delivery fails).
+                        break
+                    self._dead_letter(data, e)
+                    offset += self._length.size + size
+                    self._acknowledge(segment, offset)
+                    continue
+                message_size += call_size
+                if calls and message_size >= MessageSocket.MSG_MAX_SIZE:
+                    break
+                calls.append(call)
+                offset += self._length.size + size
+            if calls:
+                return segment, offset, calls
+            if segment == self._writer_segment:
+                return None
+            # Everything in this segment has been delivered (anything after
+            # ``offset`` is a partial record left by a crash).
+            self._remove_segment(segment)
+        return None
+
+    def _message_size(self, call):
+        """ Returns the (approximate) size of ``call`` once it has been
+            serialized into a message, raising an exception if it can't be
+            serialized or is too large to be sent. """
+        size = RPCConnectionBase.message_size(
+            ("call_batch_ack", [call]),
+            self.pool.connection_kwargs.get("frame_threshold"),
+        )
+        if size >= MessageSocket.MSG_MAX_SIZE:
+            raise ValueError("too large to send (%s bytes)" %(size, ))
+        return size
+
+    def _dead_letter(self, data, error):
+        """ Moves a record which can never be delivered to the dead letter
+            file, so it doesn't hold up the records behind it. """
+        self.stats["dead"] += 1
+        log.error("%r: can't deliver record (%r); moving it to %r",
+                  self, error, self._dead_letter_path())
+        with open(self._dead_letter_path(), "ab") as f:
+            f.write(self._length.pack(len(data)) + data)
+
+    def _remove_segment(self, segment):
+        self._reader.close()
+        self._reader = self._reader_segment = None
+        self._size -= os.path.getsize(self._segment_path(segment)) - \
+                self._read_offset
+        os.unlink(self._segment_path(segment))
+        self._segments.pop(0)
+        self._read_offset = 0
+        self._write_ack_offset(self._segments and self._segments[0] or 0, 0)
+
+    def _send_batch(self, calls):
+        cxn = self.pool.get_connection()
+        try:
+            cxn.send_message(("call_batch_ack", calls))
+            type, data = cxn.recv_message()
+            if type != "return" or data != len(calls):
+                raise ValueError("unexpected acknowledgement: %r"
+                                 %((type, data), ))
+        except:
+            cxn.disconnect()
+            raise
+        finally:
+            self.pool.release(cxn)
+
+    def deliver(self):
+        """ Delivers one batch of calls, returning the number of calls
+            delivered (``0`` if there were none to deliver). """
+        batch = self._read_batch()
+        if batch is None:
+            return 0
+        segment, offset, calls = batch
+        self._send_batch(calls)
+        self._acknowledge(segment, offset)
+        self.stats["delivered"] += len(calls)
+        return len(calls)
+
+    def _acknowledge(self, segment, offset):
+        """ Records that the calls before ``offset`` in ``segment`` have been
+            delivered. """
+        self._size -= offset - self._read_offset
+        self._read_offset = offset
+        self._write_ack_offset(segment, offset)
+
+    def _deliver_forever(self):
+        failures = 0
+        while True:
+            try:
+                delivered = self.deliver()
+                failures = 0
+            except Exception as e:
+                failures += 1
+                self.stats["failures"] += 1
+                delay = self.backoff.get_delay(min(failures, 16))
+                log.warning("%r: delivery failed (%r); retrying in %0.2fs",
+                            self, e, delay)
+                gevent.sleep(delay)
+                continue
+            if not delivered:
+                self._wakeup.clear()
+                self._wakeup.wait()
+
+    def close(self):
+        """ Stops delivering calls and closes the segment files. Calls which
+            haven't been delivered will be delivered when the outbox is next
+            opened. """
+        self._delivery.kill()
+        for f in [self._writer, self._reader]:
+            if f is not None:
+                f.close()
+        self._writer = self._reader = None
+        self._writer_segment = self._reader_segment = None
+        self._lock.close()
+        if self.active_outboxes.get(self._active_key) is self:
+            self.active_outboxes.pop(self._active_key)
+
+    def __repr__(self):
+        return "<%s %r pending_bytes=%s>" %(
+            type(self).__name__, self.path, self._size,
+        )
@@ -2,7 +2,7 @@ import logging
 
 from gevent.server import StreamServer
 
-from dirt.rpc.common import Call, is_expected, ServerBase
+from dirt.rpc.common import Call, FileResult, is_expected, ServerBase
 from dirt.misc.iter import isiter
 
 from .connection import (
@@ -23,7 +23,8 @@ class Server(ServerBase):
         log_prefix = "connection from %s:%s: " %address
         log.debug(log_prefix + "accepting")
 
-        handler = ConnectionHandler(self.execute_call)
+        handler = ConnectionHandler(self.execute_call,
+                                    call_finished=self.call_finished)
         try:
             handler.accept(socket, address)
         except Exception, e:
@@ -31,6 +32,9 @@ class Server(ServerBase):
                 log.info(log_prefix + "ignoring expected exception %r", e)
             else:
                 log.exception(log_prefix + "unexpected exception:")
+        finally:
+            if self.connection_closed is not None:
+                self.connection_closed(address)
 
 
 class ConnectionHandler(object):
@@ -41,16 +45,23 @@ class ConnectionHandler(object):
         resulting function will be called and the result will returned.
 
         Note that one socket may receive multiple calls, and be used by
-        multiple threads. """
+        multiple threads.
+
+        If ``call_finished`` is not ``None``, it is called with each call
+        once its result has been sent, and the time each stage of handling
+        the call finished is recorded in ``call.timestamps``. """
 
-    def __init__(self, execute_call):
+    def __init__(self, execute_call, call_finished=None):
         self.execute_call = execute_call
+        self.call_finished = call_finished
 
     def accept(self, socket, address):
         """ Accepts a socket, wraps it in a ``ServerConnection``, which is
             passed to ``handle_connection``. """
         self.client = address
         self.cxn = ServerConnection(socket, address)
+        if self.call_finished is not None:
+            self.cxn.enable_timing()
         self.log = self.cxn.log
         try:
             self.handle_connection()
@@ -75,37 +86,99 @@ class ConnectionHandler(object):
 
         type, data = self.cxn.recv_message()
 
+        if type in ("call_batch", "call_batch_ack"):
+            # ``call_batch_ack`` batches (sent by ``Outbox``) are acknowledged
+            # with the number of calls once they have all been handled.
+            for call_data in data:
+                self._handle_batched_call(self._make_call(type, call_data))
+            if type == "call_batch_ack":
+                self.cxn.send_message(("return", len(data)))
+            return False
+
         if type.startswith("call"):
-            if len(data) != 3:
-                message = (type, data)
-                raise MessageError.invalid(message, "incorrect number of args")
-            flags = {
-                "want_response": type == "call",
-            }
-            call = Call(data[0], data[1], data[2], flags, self.client)
-            self._handle_call(call)
+            self._handle_call(self._make_call(type, data))
             return False
 
         raise MessageError.bad_type(type)
 
+    def _make_call(self, type, data):
+        if len(data) not in (3, 4):
+            message = (type, data)
+            raise MessageError.invalid(message, "incorrect number of args")
+        flags = {
+            "want_response": type == "call",
+        }
+        headers = len(data) == 4 and data[3] or None
+        call = Call(data[0], data[1], data[2], flags, self.client,
+                    headers=headers)
+        if self.call_finished is not None:
+            call.timestamps = dict(self.cxn.recv_timestamps)
+        return call
+
+    def _handle_batched_call(self, call):
+        """ Handles one of the (fire-and-forget) calls from a ``call_batch``
+            message. Errors are logged so they don't prevent the rest of the
+            batch from being handled. """
+        try:
+            self._handle_call(call)
+        except ConnectionError:
+            raise
+        except Exception, e:
+            if is_expected(e):
+                self.log.debug("batched call %r raised: %r", call, e)
+            else:
+                self.log.exception("batched call %r raised:", call)
+
     def _handle_call(self, call):
         """ Handles one ``call`` message. """
+        sent = None
         try:
             result = self.execute_call(call)
             if not call.want_response:
                 return
             if isiter(result):
+                # The result headers are sent with the first message
+                headers = call.result_headers
                 for to_yield in result:
-                    self.cxn.send_message(("yield", to_yield))
-                self.cxn.send_message(("stop", ))
+                    self._send_result("yield", to_yield, headers)
+                    headers = None
+                sent = self._send_result("stop", None, headers)
+            elif isinstance(result, FileResult):
+                self._send_file(result)
             else:
-                self.cxn.send_message(("return", result))
+                sent = self._send_result("return", result,
+                                         call.result_headers)
         except ConnectionError:
             raise
         except Exception, e:
             if call.want_response:
-                self.cxn.send_message(("raise", self._serialize_exception(e)))
+                sent = self._send_result("raise",
+                                         self._serialize_exception(e),
+                                         call.result_headers)
             raise
+        finally:
+            if self.call_finished is not None:
+                if sent is not None:
+                    call.timestamps.update(sent)
+                self.call_finished(call)
+
+    def _send_result(self, type, data, headers):
+        if headers:
+            return self.cxn.send_message((type, data, headers))
+        elif type == "stop":
+            return self.cxn.send_message((type, ))
+        else:
+            return self.cxn.send_message((type, data))
+
+    def _send_file(self, file_result):
+        """ Sends a ``("file", {"size": size})`` message followed by ``size``
+            raw bytes from the file. """
+        file, size = file_result.open()
+        try:
+            self.cxn.send_message(("file", {"size": size}))
+            self.cxn.msg_socket.send_file(file, file_result.offset, size)
+        finally:
+            file.close()
 
     def _serialize_exception(self, exception):
         # Note: this is really simple for now, but it could easily be made
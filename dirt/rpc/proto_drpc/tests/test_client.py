@@ -1,9 +1,14 @@
+import time
 
-from nose.tools import assert_equal
-from mock import Mock
+import gevent
+from nose.tools import assert_equal, assert_raises
+from mock import Mock, patch
 
-from dirt.rpc.common import Call
-from ..client import ResultGenerator, RemoteException, Client
+from dirt.rpc.common import Call, RetryPolicy
+from ..client import (
+    ResultGenerator, RemoteException, Client, FileStream, CallBatcher,
+)
+from ..connection import ConnectionError, MessageSocket
 
 class ClientTestBase(object):
     def setup(self):
@@ -14,11 +19,14 @@ class ClientTestBase(object):
         self.release_called = True
         assert_equal(cxn, self.cxn)
         self.cxn.recv_message.side_effect = Exception("cxn released")
+        self.cxn.recv_message_with_headers.side_effect = \
+                Exception("cxn released")
 
     def set_messages(self, messages):
-        messages = [ (m[0], m[1:] and m[1] or None)
+        messages = [ (m[0], m[1:] and m[1] or None, m[2:] and m[2] or {})
                      for m in reversed(messages) ]
-        self.cxn.recv_message.side_effect = messages.pop
+        self.cxn.recv_message.side_effect = lambda: messages.pop()[:2]
+        self.cxn.recv_message_with_headers.side_effect = messages.pop
 
 
 class TestResultGenerator(ClientTestBase):
@@ -73,6 +81,37 @@ class TestResultGenerator(ClientTestBase):
         assert self.release_called
 
 
+class TestFileStream(ClientTestBase):
+    def get_stream(self, data):
+        self.cxn = Mock()
+        remaining = [data]
+        def recv_raw(size):
+            result, remaining[0] = remaining[0][:size], remaining[0][size:]
+            return result
+        self.cxn.msg_socket.recv_raw.side_effect = recv_raw
+        return FileStream(self.cxn, self._release, len(data))
+
+    def test_read(self):
+        stream = self.get_stream("hello, world")
+        assert_equal(stream.read(5), "hello")
+        assert not self.release_called
+        assert_equal(stream.read(), ", world")
+        assert_equal(stream.read(), "")
+        assert not self.cxn.disconnect.called
+        assert self.release_called
+
+    def test_close_early(self):
+        stream = self.get_stream("hello, world")
+        stream.read(5)
+        stream.close()
+        assert self.cxn.disconnect.called
+        assert self.release_called
+
+    def test_empty(self):
+        self.get_stream("")
+        assert self.release_called
+
+
 class TestClient(ClientTestBase):
     def setup(self):
         super(TestClient, self).setup()
@@ -91,6 +130,20 @@ class TestClient(ClientTestBase):
         assert not self.cxn.disconnect.called
         assert self.release_called
 
+    def test_call_headers(self):
+        self.set_messages([("return", None, {"etag": "e1", "nm": True})])
+        call = Call("foo", headers={"etag": "e1"})
+        self.client.call(call)
+        assert_equal(self.cxn.send_message.call_args_list,
+                     [((("call", ("foo", (), {}, {"etag": "e1"})),), {})])
+        assert_equal(call.result_headers, {"etag": "e1", "nm": True})
+
+    def test_returns_file(self):
+        self.set_messages([("file", {"size": 0})])
+        result = self.client.call(Call("foo"))
+        assert_equal(result.read(), "")
+        assert self.release_called
+
     def test_returns_stop(self):
         self.set_messages([("stop",)])
         result = self.client.call(Call("foo"))
@@ -125,8 +178,167 @@ class TestClient(ClientTestBase):
         assert not self.cxn.disconnect.called
         assert self.release_called
     
+    def test_retry(self):
+        self.client.retry_policy = RetryPolicy(attempts=3, base_delay=0)
+        self.cxn.send_message.side_effect = [
+            ConnectionError("oops"), ConnectionError("oops"), None,
+        ]
+        self.set_messages([("return", 42)])
+        result = self.client.call(Call("foo", flags={"can_retry": True}))
+        assert_equal(result, 42)
+        assert_equal(self.client.retry_policy.stats["retries"], 2)
+
+    def test_no_retry(self):
+        self.cxn.send_message.side_effect = ConnectionError("oops")
+        assert_raises(ConnectionError, self.client.call, Call("foo"))
+        assert_equal(self.cxn.send_message.call_count, 1)
+
+    def test_shared_retry_policy(self):
+        class settings:
+            retry_policy = {"attempts": 4}
+        first = Client("drpc://retry_server:1234", settings=settings)
+        second = Client("drpc://retry_server:1234", settings=settings)
+        assert first.retry_policy is second.retry_policy
+        assert_equal(first.retry_policy.attempts, 4)
+
+    def test_load(self):
+        self.set_messages([("return", 42, {"load": [3, 2, 100]})])
+        self.client.call(Call("foo"))
+        self.client.pool.record_remote_load.assert_called_with([3, 2, 100])
+
+    def test_load_backoff(self):
+        self.client.load_backoff_queue = 2
+        self.client.pool.remote_load = {
+            "active": 3, "queued": 2, "latency_ms": 100, "time": time.time(),
+        }
+        with patch("random.uniform", return_value=0.01) as uniform:
+            self.set_messages([("return", 42)])
+            self.client.call(Call("foo"))
+        uniform.assert_called_with(0, 0.1)
+        assert_equal(self.client.load_backoffs, 1)
+
+    def test_server_is_alive(self):
+        self.client.pool.has_connected.return_value = True
+        assert self.client.server_is_alive()
+
+        self.client.pool.has_connected.return_value = False
+        self.client.pool.liveness = (time.time(), False)
+        self.client._check_liveness = Mock(return_value=True)
+        assert not self.client.server_is_alive()
+        assert not self.client._check_liveness.called
+
+        self.client.pool.liveness = (time.time() - 60, False)
+        self.client.pool.liveness_refresh = None
+        assert not self.client.server_is_alive()
+        self.client.pool.liveness_refresh.join()
+        assert self.client._check_liveness.called
+
     def test_repr(self):
         assert_equal(
             repr(self.client),
             "dirt.rpc.proto_drpc.client.Client(remote_url='dirtrpc://mock_server:1234')",
         )
+
+
+class TestCallBatcher(object):
+    def setup(self):
+        self.pool = Mock(connection_kwargs={})
+        self.cxn = self.pool.get_connection()
+        self.batcher = CallBatcher(self.pool, max_size=3, max_delay=0.01)
+
+    def sent_batches(self):
+        return [
+            args[0][1] for (args, _) in self.cxn.send_message.call_args_list
+        ]
+
+    def test_max_size(self):
+        for x in range(4):
+            self.batcher.add(Call("foo", (x, )))
+        assert_equal(self.sent_batches(), [
+            [("foo", (0, ), {}), ("foo", (1, ), {}), ("foo", (2, ), {})],
+        ])
+        gevent.sleep(0.02)
+        assert_equal(self.sent_batches()[1:], [[("foo", (3, ), {})]])
+        assert_equal(self.pool.release.call_count, 2)
+
+    def test_max_message_size(self):
+        # Each small call is counted as 92 bytes
+        with patch.object(MessageSocket, "MSG_MAX_SIZE", 200):
+            self.batcher.add(Call("foo", ("x" * 10, )))
+            self.batcher.add(Call("foo", ("y" * 10, )))
+            self.batcher.add(Call("foo", ("z" * 200, )))
+            self.batcher.add(Call("foo", ("z" * 10, )))
+            self.batcher.flush()
+        assert_equal(self.sent_batches(), [
+            [("foo", ("x" * 10, ), {}), ("foo", ("y" * 10, ), {})],
+            [("foo", ("z" * 10, ), {})],
+        ])
+        assert_equal(self.batcher.stats["dropped"], 1)
+
+    def test_dropped(self):
+        self.cxn.send_message.side_effect = ConnectionError("oops")
+        self.batcher.add(Call("foo"))
+        self.batcher.flush()
+        assert_equal(self.batcher.stats["dropped"], 1)
+        assert self.cxn.disconnect.called
+
+    def test_client(self):
+        client = Client("drpc://mock_server:1234")
+        client.batcher = self.batcher
+        assert_equal(client.call(Call("foo", flags={"want_response": False})),
+                     None)
+        self.batcher.flush()
+        assert_equal(self.sent_batches(), [[("foo", (), {})]])
+
+
+class TestHedgedCalls(object):
+    def setup(self):
+        class settings:
+            alternate_urls = ["drpc://alternate:1234"]
+            hedge_percentile = 90
+            hedge_budget = 100
+        self.client = Client("drpc://primary:1234", settings=settings)
+        self.client._latencies.extend([0.01] * 20)
+        self.alternate = Client("drpc://alternate:1234")
+        self.alternate._call = lambda call: "alternate"
+        self.client._get_alternate = lambda: self.alternate
+
+    def slow_call(self, call):
+        gevent.sleep(0.2)
+        return "primary"
+
+    def test_fast_primary(self):
+        self.client._call = lambda call: "primary"
+        assert_equal(self.client.call(Call("foo")), "primary")
+        assert_equal(self.client.hedge_stats["hedged"], 0)
+
+    def retryable_call(self):
+        return Call("foo", flags={"can_retry": True})
+
+    def test_slow_primary(self):
+        self.client._call = self.slow_call
+        assert_equal(self.client.call(self.retryable_call()), "alternate")
+        assert_equal(self.client.hedge_stats["hedged"], 1)
+        assert_equal(self.client.hedge_stats["hedge_wins"], 1)
+
+    def test_failed_alternate(self):
+        self.client._call = self.slow_call
+        self.alternate._call = Mock(side_effect=RemoteException("oops"))
+        assert_equal(self.client.call(self.retryable_call()), "primary")
+
+    def test_over_budget(self):
+        self.client.hedge_budget = 0
+        self.client._call = self.slow_call
+        assert_equal(self.client.call(self.retryable_call()), "primary")
+        assert_equal(self.client.hedge_stats["over_budget"], 1)
+
+    def test_cannot_retry(self):
+        self.client._call = self.slow_call
+        call = Call("foo", flags={"can_retry": False})
+        assert_equal(self.client.call(call), "primary")
+        assert_equal(self.client.hedge_stats["hedged"], 0)
+
+    def test_no_retry_flag(self):
+        self.client._call = self.slow_call
+        assert_equal(self.client.call(Call("foo")), "primary")
+        assert_equal(self.client.hedge_stats["hedged"], 0)
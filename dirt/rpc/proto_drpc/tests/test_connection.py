@@ -1,18 +1,22 @@
+import mmap
+
 import gevent
 from gevent.event import AsyncResult
 from gevent.queue import Queue
 from gevent import socket
-from nose.tools import assert_equal
+from nose.tools import assert_equal, assert_raises
 
 from mock import Mock
 
 from ..connection import (
     ServerConnection, ClientConnection, ConnectionError, MessageSocket,
-    ConnectionPool,
+    ConnectionPool, PoolFullError, MessageError,
 )
 from dirt.testing import assert_contains, parameterized
 
 
+type_of = type
+
 class TestConnection(object):
     def setup(self):
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -61,6 +65,99 @@ class TestConnection(object):
         assert_equal(server_messages.get(timeout=1), ("hello", "server"))
         assert_equal(client.recv_message(), ("hello", "client"))
 
+    def test_timing(self):
+        server_messages = Queue()
+        def server_thread():
+            socket, addr = self.server_socket.accept()
+            server = ServerConnection(socket, addr)
+            server.enable_timing()
+            message = server.recv_message()
+            server_messages.put((message, server.recv_timestamps))
+            server_messages.put(server.send_message(("hello", "client")))
+            socket.close()
+        self.spawn(server_thread)
+
+        client = self.client_cxn
+        assert_equal(client.send_message(("hello", "server")), None)
+        message, recv_timestamps = server_messages.get(timeout=1)
+        assert_equal(message, ("hello", "server"))
+        assert (
+            recv_timestamps["received"] <= recv_timestamps["read"] <=
+            recv_timestamps["decoded"]
+        ), recv_timestamps
+        send_timestamps = server_messages.get(timeout=1)
+        assert send_timestamps["serialized"] <= send_timestamps["sent"]
+
+    def test_frames(self):
+        blob = "x" * 2048
+        server_messages = Queue()
+        def server_thread():
+            socket, addr = self.server_socket.accept()
+            server = ServerConnection(socket, addr)
+            server.frame_threshold = 1024
+            server_messages.put(server.recv_message())
+            server.send_message(("blob", {"data": blob}))
+            socket.close()
+        self.spawn(server_thread)
+
+        client = ClientConnection(self.bind_address, frame_threshold=1024)
+        client.send_message(("hello", ["small", blob, bytearray("abc")]))
+        type, data = server_messages.get(timeout=1)
+        assert_equal(data[0], "small")
+        assert_equal(map(type_of, data[1:]), [memoryview, memoryview])
+        assert_equal(data[1].tobytes(), blob)
+        assert_equal(data[2].tobytes(), "abc")
+
+        type, data = client.recv_message()
+        assert_equal(data["data"].tobytes(), blob)
+
+    def test_frames_opt_in(self):
+        # Without a ``frame_threshold``, large ``str`` values are sent (and
+        # received) as ``str``s.
+        blob = "x" * (64 * 1024)
+        server_messages = Queue()
+        def server_thread():
+            socket, addr = self.server_socket.accept()
+            server = ServerConnection(socket, addr)
+            server_messages.put(server.recv_message())
+            socket.close()
+        self.spawn(server_thread)
+
+        self.client_cxn.send_message(("hello", blob))
+        assert_equal(server_messages.get(timeout=1), ("hello", blob))
+
+    @parameterized([
+        ("one large frame", ["x" * 2048]),
+        ("many small frames", ["x" * 512] * 4),
+    ])
+    def test_max_frame_size(self, name, blobs):
+        def server_thread():
+            socket, addr = self.server_socket.accept()
+            server = ServerConnection(socket, addr)
+            server.frame_threshold = 1
+            server.send_message(("blobs", blobs))
+            socket.close()
+        self.spawn(server_thread)
+
+        client = ClientConnection(self.bind_address, max_frame_size=1024)
+        assert_raises(MessageError, client.recv_message)
+        assert not client.connected()
+
+    def test_spooled_frames(self):
+        blob = "x" * 2048
+        def server_thread():
+            socket, addr = self.server_socket.accept()
+            server = ServerConnection(socket, addr)
+            server.frame_threshold = 1024
+            server.send_message(("blob", blob))
+            socket.close()
+        self.spawn(server_thread)
+
+        client = ClientConnection(self.bind_address, spool_threshold=1024)
+        type, data = client.recv_message()
+        assert_equal(type_of(data), mmap.mmap)
+        assert_equal(data[:], blob)
+
     def test_client_disconnect(self):
         def server_thread():
             for num in xrange(2):
@@ -211,3 +308,27 @@ class TestConnectionPool(object):
     def test_repr(self):
         pool = ConnectionPool(("1.2.3.4", 5678))
         assert_equal(repr(pool), "<ConnectionPool '1.2.3.4:5678' active=0 available=0 created=0 max=32>")
+
+    def test_max_in_flight(self):
+        pool = ConnectionPool(("1.2.3.4", 5678), connection_class=Mock,
+                              max_in_flight=1, max_queued=1)
+        first = pool.get_connection()
+        waiter = gevent.spawn(pool.get_connection)
+        gevent.sleep(0)
+        assert_raises(PoolFullError, pool.get_connection)
+        assert not waiter.ready()
+        pool.release(first)
+        assert_equal(waiter.get(timeout=1), first)
+        summary = pool.summarize()
+        assert_equal((summary["total_queued"], summary["total_rejected"]),
+                     (1, 1))
+
+    def test_has_connected(self):
+        pool = ConnectionPool(("1.2.3.4", 5678), connection_class=Mock)
+        assert not pool.has_connected()
+        cxn = pool.get_connection()
+        cxn.connected.return_value = False
+        assert not pool.has_connected()
+        cxn.connected.return_value = True
+        pool.release(cxn)
+        assert pool.has_connected()
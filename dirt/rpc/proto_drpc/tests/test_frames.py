@@ -0,0 +1,73 @@
+from nose.tools import assert_equal, assert_raises
+from nose.plugins.skip import SkipTest
+
+from dirt.testing import parameterized
+
+from ..frames import extract_frames, restore_frames, FRAME_KEY, NDARRAY_KEY
+
+
+class TestFrames(object):
+    def test_round_trip(self):
+        blob = "x" * 10
+        message = ("call", ("foo", (blob, "y"), {"a": [bytearray("z")]}))
+        encoded, frames = extract_frames(message, 10)
+        assert_equal(encoded, (
+            "call", ("foo", ({FRAME_KEY: 0}, "y"), {"a": [{FRAME_KEY: 1}]}),
+        ))
+        assert_equal(frames, [blob, bytearray("z")])
+        assert_equal(restore_frames(encoded, frames), message)
+
+    def test_unchanged_containers_not_copied(self):
+        message = ("return", {"a": ["small"]})
+        encoded, frames = extract_frames(message, 10)
+        assert encoded is message
+        assert_equal(frames, [])
+
+    def test_threshold_none(self):
+        encoded, frames = extract_frames(["x" * 100], None)
+        assert_equal(frames, [])
+
+
+class TestNDArrayFrames(object):
+    def setup(self):
+        try:
+            import numpy
+        except ImportError:
+            raise SkipTest("numpy not installed")
+        self.numpy = numpy
+
+    def round_trip(self, value):
+        encoded, frames = extract_frames(value, None)
+        # The receiving side will get each frame as a ``memoryview``
+        frames = [memoryview(bytearray(frame)) for frame in frames]
+        return restore_frames(encoded, frames)
+
+    @parameterized([
+        ("c", lambda np: np.arange(12, dtype="<f8").reshape(3, 4)),
+        ("fortran", lambda np: np.asfortranarray(np.arange(6).reshape(2, 3))),
+        ("non-contiguous", lambda np: np.arange(20, dtype="i4")[::3]),
+        ("empty", lambda np: np.zeros((0, 3), dtype="f4")),
+        ("bool", lambda np: np.array([True, False])),
+    ])
+    def test_round_trip(self, name, make_array):
+        array = make_array(self.numpy)
+        result = self.round_trip({"a": array})["a"]
+        assert_equal(result.dtype, array.dtype)
+        assert_equal(result.shape, array.shape)
+        assert (result == array).all()
+
+    def test_object_array(self):
+        array = self.numpy.array([1, "a"], dtype=object)
+        assert_equal(self.round_trip(array), [1, "a"])
+
+    @parameterized([
+        ("too long", {"shape": [4, 4]}),
+        ("too short", {"shape": [1]}),
+        ("negative", {"shape": [-1]}),
+        ("bad order", {"order": "K"}),
+    ])
+    def test_invalid_descriptor(self, name, changes):
+        encoded, frames = extract_frames(self.numpy.arange(4, dtype="i4"), None)
+        encoded[NDARRAY_KEY].update(changes)
+        frames = [memoryview(bytearray(frame)) for frame in frames]
+        assert_raises(ValueError, restore_frames, encoded, frames)
@@ -0,0 +1,50 @@
+import copy
+import datetime
+
+import bson
+import pytz
+from nose.tools import assert_equal, assert_raises
+
+from ..frames import extract_frames
+from ..lazybson import LazyDocument, LazyArray, materialize
+
+
+class TestLazyDocument(object):
+    value = {
+        "float": 1.5,
+        "unicode": u"\u1234",
+        "str": "\xff",
+        "doc": {"nested": {"list": [1, {"a": None}]}},
+        "bool": True,
+        "none": None,
+        "int": 42,
+        "long": 2 ** 40,
+        "date": datetime.datetime(2012, 1, 2, 3, 4, 5, tzinfo=pytz.utc),
+    }
+
+    def test_materialize(self):
+        doc = LazyDocument(bson.dumps(self.value))
+        assert_equal(materialize(doc), self.value)
+
+    def test_access(self):
+        doc = LazyDocument(bson.dumps(self.value))
+        assert_equal(sorted(doc.keys()), sorted(self.value.keys()))
+        nested = doc["doc"]["nested"]
+        assert isinstance(nested, LazyDocument)
+        assert isinstance(nested["list"], LazyArray)
+        assert_equal(nested["list"][-1]["a"], None)
+        assert_equal(nested["list"][:1], [1])
+        assert "float" in doc
+        assert_raises(KeyError, lambda: doc["missing"])
+        assert_raises(IndexError, lambda: nested["list"][2])
+
+    def test_frames(self):
+        message, frames = extract_frames({"blob": bytearray("abc")}, None)
+        doc = LazyDocument(bson.dumps(message), frames=frames)
+        assert_equal(doc["blob"], bytearray("abc"))
+
+    def test_deepcopy(self):
+        message, frames = extract_frames({"blob": bytearray("abc")}, None)
+        doc = LazyDocument(bson.dumps({"doc": message}), frames=frames)
+        copied = copy.deepcopy({"doc": doc["doc"]})
+        assert copied["doc"] is doc["doc"]
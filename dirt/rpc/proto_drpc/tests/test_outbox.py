@@ -0,0 +1,135 @@
+import os
+import errno
+import shutil
+import tempfile
+
+import gevent
+from mock import Mock
+from nose.tools import assert_equal
+
+from dirt.rpc.common import Call
+
+from ..outbox import Outbox
+
+
+class TestOutbox(object):
+    def setup(self):
+        self.path = tempfile.mkdtemp(prefix="dirt-test-outbox-")
+        self.pool = Mock(connection_kwargs={"address": ("127.0.0.1", 1234)})
+        self.cxn = self.pool.get_connection()
+        self.delivered = []
+        self.available = True
+        def send_message(message):
+            if not self.available:
+                raise IOError("remote unavailable")
+            self.delivered.extend(message[1])
+            self.cxn.recv_message.return_value = ("return", len(message[1]))
+        self.cxn.send_message.side_effect = send_message
+        self.outboxes = []
+
+    def teardown(self):
+        for outbox in self.outboxes:
+            outbox.close()
+        shutil.rmtree(self.path)
+
+    def open_outbox(self, **kwargs):
+        outbox = Outbox(self.pool, self.path, **kwargs)
+        outbox.backoff.base_delay = 0.001
+        self.outboxes.append(outbox)
+        return outbox
+
+    def segments(self):
+        return sorted(n for n in os.listdir(self.path) if n.endswith(".seg"))
+
+    def test_delivery(self):
+        outbox = self.open_outbox(segment_size=30, batch_size=2)
+        for x in range(5):
+            outbox.append(Call("foo", (x, )))
+        gevent.sleep(0.01)
+        assert_equal(self.delivered, [("foo", (x, ), {}) for x in range(5)])
+        assert_equal(len(self.segments()), 1)
+        assert_equal(outbox.stats["delivered"], 5)
+
+    def test_unavailable_remote(self):
+        self.available = False
+        outbox = self.open_outbox()
+        outbox.append(Call("foo"))
+        gevent.sleep(0.01)
+        assert_equal(self.delivered, [])
+        assert outbox.stats["failures"] > 0
+        self.available = True
+        gevent.sleep(0.1)
+        assert_equal(self.delivered, [("foo", (), {})])
+
+    def test_recovery(self):
+        self.available = False
+        outbox = self.open_outbox()
+        for x in range(3):
+            outbox.append(Call("foo", (x, )))
+        outbox.close()
+        self.available = True
+        self.open_outbox()
+        gevent.sleep(0.01)
+        assert_equal(self.delivered, [("foo", (x, ), {}) for x in range(3)])
+        assert_equal(len(self.segments()), 0)
+
+    def test_max_size(self):
+        self.available = False
+        outbox = self.open_outbox(max_size=50)
+        for x in range(5):
+            outbox.append(Call("foo", (x, )))
+        assert_equal(outbox.stats["dropped"], 3)
+
+    def test_get_outbox(self):
+        other_pool = Mock(connection_kwargs={"address": ("127.0.0.1", 4321)})
+        outbox = Outbox.get_outbox(self.pool, self.path)
+        other = Outbox.get_outbox(other_pool, self.path)
+        self.outboxes.extend([outbox, other])
+        assert outbox is not other
+        assert outbox is Outbox.get_outbox(self.pool, self.path)
+        assert_equal(other.pool, other_pool)
+        assert_equal(sorted(os.listdir(self.path)),
+                     ["127.0.0.1_1234", "127.0.0.1_4321"])
+        assert_equal(outbox.path,
+                     os.path.join(self.path, "127.0.0.1_1234", "0"))
+
+    def test_locked(self):
+        self.open_outbox()
+        try:
+            Outbox(self.pool, self.path)
+            raise AssertionError("IOError not raised")
+        except IOError as e:
+            assert_equal(e.errno, errno.EWOULDBLOCK)
+
+    def test_get_outbox_skips_locked(self):
+        # ex, the outbox of another process
+        locked_path = os.path.join(self.path, "127.0.0.1_1234", "0")
+        locked = Outbox(self.pool, locked_path)
+        self.outboxes.append(locked)
+        outbox = Outbox.get_outbox(self.pool, self.path)
+        self.outboxes.append(outbox)
+        assert_equal(outbox.path,
+                     os.path.join(self.path, "127.0.0.1_1234", "1"))
+
+    def test_get_outbox_after_fork(self):
+        parent = Outbox.get_outbox(self.pool, self.path)
+        self.outboxes.append(parent)
+        Outbox.active_outboxes_pid = -1
+        child = Outbox.get_outbox(self.pool, self.path)
+        self.outboxes.append(child)
+        assert child is not parent
+        assert_equal(os.path.basename(child.path), "1")
+        gevent.sleep(0)
+        assert parent._delivery.dead
+
+    def test_dead_letter(self):
+        outbox = self.open_outbox()
+        outbox.append(Call("foo", (1, )))
+        # Can be pickled (into the outbox), but is too big for BSON
+        outbox.append(Call("foo", (2 ** 70, )))
+        outbox.append(Call("foo", (2, )))
+        gevent.sleep(0.01)
+        assert_equal(self.delivered, [("foo", (1, ), {}), ("foo", (2, ), {})])
+        assert_equal(outbox.stats["dead"], 1)
+        assert os.path.exists(os.path.join(self.path, "dead-letter"))
+
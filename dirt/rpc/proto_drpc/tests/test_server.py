@@ -1,7 +1,10 @@
-from nose.tools import assert_equal
+import tempfile
+
+from nose.tools import assert_equal, assert_raises
 from mock import Mock
 
 from dirt.app import APIEdge
+from dirt.rpc.common import FileResult
 from dirt.testing import parameterized
 
 from ..server import ConnectionHandler
@@ -24,9 +27,11 @@ class TestConnectionHandler(object):
         self.api = Mock()
         self.cxn = Mock()
         self.edge = APIEdge(MockApp(self.api), None)
+        self.edge.report_load = False
         self.handler = ConnectionHandler(self.edge.execute)
         self.handler.client = ("mock_peer", 1234)
         self.handler.cxn = self.cxn
+        self.handler.log = self.cxn.log
 
     def set_next_message(self, type, data):
         self.cxn.recv_message.return_value = (type, data)
@@ -59,6 +64,59 @@ class TestConnectionHandler(object):
                   in self.cxn.send_message.call_args_list]
         assert_equal(actual, expected)
 
+    def test_call_batch(self):
+        self.api.bar.side_effect = Exception("ohai")
+        self.set_next_message("call_batch", [
+            ("foo", [1], {}), ("bar", [], {}), ("foo", [2], {"x": 3}),
+        ])
+        self.handler._handle_one_message()
+        assert_equal(self.api.foo.call_args_list,
+                     [((1, ), {}), ((2, ), {"x": 3})])
+        assert_equal(self.cxn.send_message.call_count, 0)
+
+    def test_call_reports_load(self):
+        self.edge.report_load = True
+        self.set_next_message("call", ("foo", [], {}))
+        self.handler._handle_one_message()
+        ((type, _, headers), ), _ = self.cxn.send_message.call_args
+        assert_equal((type, headers), ("return", {"load": [0, 0, 0]}))
+
+    def test_call_stage_timing(self):
+        self.handler.call_finished = self.edge.call_finished
+        self.cxn.recv_timestamps = {"received": 1, "read": 2, "decoded": 3}
+        def send_message(message):
+            return {"serialized": 4, "sent": 6}
+        self.cxn.send_message.side_effect = send_message
+        self.set_next_message("call", ("foo", [], {}))
+        self.handler._handle_one_message()
+        stages = self.edge.stage_timings["foo"]
+        assert_equal(sorted(stages), [
+            "decode", "handler", "queue", "read", "send", "serialize",
+        ])
+        assert_equal(stages["read"], [1, 1.0, 1.0])
+        assert_equal(stages["send"], [1, 2.0, 2.0])
+
+    def test_call_stage_timing_unknown_method(self):
+        self.handler.call_finished = self.edge.call_finished
+        self.cxn.recv_timestamps = {"received": 1, "read": 2, "decoded": 3}
+        self.cxn.send_message.return_value = {"serialized": 4, "sent": 6}
+        del self.api.bogus
+        self.set_next_message("call", ("bogus", [], {}))
+        assert_raises(ValueError, self.handler._handle_one_message)
+        assert_equal(self.edge.stage_timings, {})
+
+    def test_call_returns_file(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write("hello, world")
+            f.flush()
+            self.api.foo.return_value = FileResult(f.name, 7, 100)
+            self.set_next_message("call", ("foo", [], {}))
+            self.handler._handle_one_message()
+        assert_equal(self.cxn.send_message.call_args,
+                     ((("file", {"size": 5}),), {}))
+        (_, offset, size), _ = self.cxn.msg_socket.send_file.call_args
+        assert_equal((offset, size), (7, 5))
+
     def _run_exception_test(self, call):
         self.api.foo.side_effect = Exception("ohai")
         self.set_next_message(call, ("foo", [], {}))
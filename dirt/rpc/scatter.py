@@ -0,0 +1,125 @@
+""" Helpers for making the same call to many remotes (ex, to each shard or
+    replica of a service) at once, and combining the results.
+
+    For example::
+
+        shards = dict((name, runner.get_api(name)) for name in SHARD_NAMES)
+        result = scatter_gather(shards, "search.query", args=(q, ), timeout=2)
+        if result.errors:
+            log.warning("partial search results: %r", result.errors)
+        hits = sum(result.results.values(), [])
+
+    And, when each shard streams its results in sorted order::
+
+        result = scatter_gather(shards, "search.stream", args=(q, ))
+        for hit in result.merge_sorted(key=lambda hit: hit["score"]):
+            ...
+    """
+import sys
+import heapq
+
+import gevent
+
+from .common import expected
+
+
+@expected
+class DeadlineExceeded(Exception):
+    """ Recorded as the error of each remote which hadn't responded before
+        the ``scatter_gather`` deadline. """
+
+
+class ScatterResult(object):
+    """ The result of a ``scatter_gather`` call.
+
+        ``results`` maps the key of each remote which responded to its
+        result, and ``errors`` maps the key of each remote which failed (or
+        didn't respond in time) to the exception. """
+
+    def __init__(self):
+        self.results = {}
+        self.errors = {}
+
+    @property
+    def complete(self):
+        """ ``True`` if every remote responded successfully. """
+        return not self.errors
+
+    def merge_sorted(self, key=None):
+        """ Yields the items from each (sorted) result in ``results`` in
+            sorted order (ie, a k-way merge), without reading more than one
+            item from each result at a time. Intended for generator results.
+
+            If a result fails while it is being read, the error is recorded
+            in ``errors`` and the items from the other results are still
+            yielded. """
+        heap = []
+        for name, result in self.results.items():
+            self._push_next(heap, name, iter(result), key)
+        while heap:
+            _, _, item, name, items = heapq.heappop(heap)
+            yield item
+            self._push_next(heap, name, items, key)
+
+    def _push_next(self, heap, name, items, key):
+        try:
+            item = next(items)
+        except StopIteration:
+            return
+        except Exception as e:
+            self.errors[name] = e
+            self.results.pop(name, None)
+            return
+        # ``id(items)`` breaks ties, so the items are never compared
+        sort_key = item if key is None else key(item)
+        heapq.heappush(heap, (sort_key, id(items), item, name, items))
+
+    def __repr__(self):
+        return "<%s results=%r errors=%r>" %(
+            type(self).__name__, sorted(self.results), self.errors,
+        )
+
+
+def scatter_gather(remotes, name, args=None, kwargs=None, timeout=None):
+    """ Calls method ``name`` with ``args`` and ``kwargs`` on each of
+        ``remotes`` (a dict of ``ClientWrapper``s, or a list, in which case
+        the keys of the result will be list indexes) concurrently, and
+        returns a ``ScatterResult``.
+
+        If ``timeout`` is not ``None``, calls which haven't finished after
+        ``timeout`` seconds are cancelled and recorded as ``DeadlineExceeded``
+        errors, so the partial results can be used. """
+    if not isinstance(remotes, dict):
+        remotes = dict(enumerate(remotes))
+    args = args or ()
+    kwargs = kwargs or {}
+
+    def call_remote(remote):
+        try:
+            return True, remote._call(name, *args, **kwargs)
+        except Exception:
+            return False, sys.exc_info()[1]
+
+    greenlets = dict(
+        (key, gevent.spawn(call_remote, remote))
+        for (key, remote) in remotes.items()
+    )
+    try:
+        gevent.joinall(greenlets.values(), timeout=timeout)
+    finally:
+        for greenlet in greenlets.values():
+            greenlet.kill(block=False)
+
+    result = ScatterResult()
+    for key, greenlet in greenlets.items():
+        if not isinstance(greenlet.value, tuple):
+            result.errors[key] = DeadlineExceeded(
+                "no response from %r after %ss" %(key, timeout)
+            )
+            continue
+        is_ok, value = greenlet.value
+        if is_ok:
+            result.results[key] = value
+        else:
+            result.errors[key] = value
+    return result
@@ -1,7 +1,14 @@
-from mock import Mock
-from nose.tools import assert_equal
+import mmap
 
-from ..common import ClientWrapper, Call
+import gevent
+from mock import Mock, patch
+from nose.tools import assert_equal, assert_raises
+
+from dirt.misc.gevent_ import SingleFlight
+
+from ..common import (
+    ClientBase, ClientWrapper, ShardedClientWrapper, Call, RetryPolicy,
+)
 
 class TestClientWrapper(object):
     def test_calling(self):
@@ -12,6 +19,145 @@ class TestClientWrapper(object):
         assert_equal((call.name, call.args, call.kwargs),
                      ("foo", (1, ), {"bar": 2}))
 
+    def test_conditional_calls(self):
+        responses = [
+            ({"etag": "e1"}, {"a": 1, "b": 2}),
+            ({"etag": "e1", "nm": True}, None),
+            ({"etag": "e2", "delta": "e1"}, [["s", ["b"], 3]]),
+        ]
+        sent_headers = []
+        def call(call):
+            sent_headers.append(call.headers)
+            call.result_headers, result = responses.pop(0)
+            return result
+        sc = ClientWrapper(client=Mock(call=call))
+
+        assert_equal(sc.status(), {"a": 1, "b": 2})
+        assert_equal(sc.status(), {"a": 1, "b": 2})
+        assert_equal(sc.status(), {"a": 1, "b": 3})
+        assert_equal(sent_headers, [{}, {"etag": "e1"}, {"etag": "e1"}])
+
+    def test_conditional_calls_with_frames(self):
+        # Large binary values are received as ``memoryview``s over the
+        # frames they were sent in, which can't be deep copied.
+        blob = memoryview(bytearray("x" * 2048))
+        responses = [
+            ({"etag": "e1"}, {"blob": blob, "n": 1}),
+            ({"etag": "e1", "nm": True}, None),
+            ({"etag": "e2", "delta": "e1"}, [["s", ["n"], 2]]),
+        ]
+        def call(call):
+            call.result_headers, result = responses.pop(0)
+            return result
+        sc = ClientWrapper(client=Mock(call=call))
+
+        assert_equal(sc.status(), {"blob": blob, "n": 1})
+        result = sc.status()
+        assert_equal(result, {"blob": blob, "n": 1})
+        assert result["blob"] is blob
+        assert_equal(sc.status(), {"blob": blob, "n": 2})
+
+    def test_cached_calls(self):
+        calls = []
+        def call(call):
+            calls.append(call.args)
+            call.result_headers = {"ttl": 10}
+            return {"args": list(call.args)}
+        sc = ClientWrapper(client=Mock(call=call))
+
+        with patch("time.time", return_value=100):
+            assert_equal(sc.get(1), {"args": [1]})
+            result = sc.get(1)
+            assert_equal(result, {"args": [1]})
+            result["args"].append(2)
+            assert_equal(sc.get(1), {"args": [1]})
+            assert_equal(sc.get(2), {"args": [2]})
+        with patch("time.time", return_value=111):
+            assert_equal(sc.get(1), {"args": [1]})
+
+        assert_equal(calls, [(1, ), (2, ), (1, )])
+        assert_equal(sc._cache_info(), {"hits": 2, "misses": 3, "size": 2})
+        sc._cache_clear()
+        assert_equal(sc._cache_info()["size"], 0)
+
+    def test_cached_binary_args(self):
+        calls = []
+        def call(call):
+            calls.append(call.args[0].tobytes())
+            call.result_headers = {"ttl": 10}
+            return call.args[0].tobytes()
+        sc = ClientWrapper(client=Mock(call=call))
+        with patch("time.time", return_value=100):
+            for data in ["aaaa", "bbbb", "aaaa"]:
+                assert_equal(sc.get(memoryview(bytearray(data))), data)
+        assert_equal(calls, ["aaaa", "bbbb"])
+
+    def test_uncached_calls_are_not_keyed(self):
+        sc = ClientWrapper(client=Mock())
+        with patch("dirt.rpc.common.call_key") as call_key:
+            sc.foo("x" * 1024 * 1024)
+            sc.foo("x" * 1024 * 1024)
+        assert_equal(call_key.call_count, 0)
+
+    def test_cached_calls_with_frames(self):
+        # Results larger than the ``frame_threshold`` are received as
+        # ``memoryview``s (or, if spooled, ``mmap``s), which can't be deep
+        # copied, so they are shared by the cached copies.
+        blob = memoryview(bytearray("x" * 2048))
+        spooled = mmap.mmap(-1, 2048)
+        def call(call):
+            call.result_headers = {"ttl": 10}
+            return {"blob": blob, "spooled": [spooled]}
+        sc = ClientWrapper(client=Mock(call=call))
+
+        with patch("time.time", return_value=100):
+            assert_equal(sc.get(), {"blob": blob, "spooled": [spooled]})
+            result = sc.get()
+        assert_equal(sc._cache_info()["hits"], 1)
+        assert result["blob"] is blob
+        assert result["spooled"][0] is spooled
+
+    def test_coalesced_calls(self):
+        calls = []
+        def call(call):
+            calls.append(call.args)
+            gevent.sleep(0.01)
+            return {"args": list(call.args)}
+        sc = ClientWrapper(client=Mock(call=call))
+        sc._shared["flights"] = SingleFlight()
+        greenlets = [gevent.spawn(sc.get, x) for x in [1, 1, 2, 1]]
+        results = [g.get() for g in greenlets]
+        assert_equal(results, [{"args": [1]}] * 2 + [{"args": [2]}] +
+                              [{"args": [1]}])
+        assert results[0] is not results[1]
+        assert_equal(calls, [(1, ), (2, )])
+
+    def test_coalesced_binary_args(self):
+        calls = []
+        def call(call):
+            calls.append(call.args[0].tobytes())
+            gevent.sleep(0.01)
+            return call.args[0].tobytes()
+        sc = ClientWrapper(client=Mock(call=call))
+        sc._shared["flights"] = SingleFlight()
+        greenlets = [
+            gevent.spawn(sc.get, memoryview(bytearray(data)))
+            for data in ["aaaa", "bbbb", "aaaa"]
+        ]
+        assert_equal([g.get() for g in greenlets], ["aaaa", "bbbb", "aaaa"])
+        assert_equal(calls, ["aaaa", "bbbb"])
+
+    def test_call_stats(self):
+        def call(call):
+            if call.args:
+                raise ValueError(call.args)
+        sc = ClientWrapper(client=Mock(call=call))
+        sc.foo()
+        sc.foo.bar()
+        assert_raises(ValueError, sc.foo, 1)
+        stats = sc._call_stats()
+        assert_equal((stats["calls"], stats["errors"]), (3, 1))
+
     def test_repr(self):
         c = Mock()
         sc = ClientWrapper(client=c)
@@ -28,3 +174,91 @@ class TestCall(object):
             repr(c),
             "Call('foo', kwargs={'stuff': 42})",
         )
+
+    def test_flags_and_kwargs(self):
+        c = Call("foo", kwargs={u"stuff": 42}, flags={"can_retry": False})
+        assert_equal((c.want_response, c.can_retry), (True, False))
+        assert_equal(type(c.kwargs.keys()[0]), str)
+        assert_raises(ValueError, Call, "foo", flags={"bad": True})
+
+    def test_lazy_meta(self):
+        c = Call("foo")
+        assert_equal(c._meta, None)
+        c.meta["time_in_queue"] = 1
+        assert_equal(c.meta["time_received"], c.time_received)
+        assert_equal(c.meta["time_in_queue"], 1)
+
+    def test_meta_time_in_queue(self):
+        c = Call("foo")
+        c.time_started = c.time_received + 2
+        assert_equal(c._meta, None)
+        assert_equal(c.meta["time_in_queue"], 2)
+
+    def test_default_flags(self):
+        class NoRetryCall(Call):
+            __slots__ = []
+            default_flags = dict(Call.default_flags, can_retry=False)
+        c = NoRetryCall("foo")
+        assert_equal((c.want_response, c.can_retry), (True, False))
+
+
+class TestRetryPolicy(object):
+    def test_attempts(self):
+        policy = RetryPolicy(attempts=3)
+        assert_equal([policy.should_retry(n) for n in [1, 2, 3]],
+                     [True, True, False])
+
+    def test_budget(self):
+        policy = RetryPolicy(attempts=10, budget_ratio=0.5, budget_tokens=2)
+        assert_equal([policy.should_retry(1) for _ in range(3)],
+                     [True, True, False])
+        policy.record_call()
+        policy.record_call()
+        assert policy.should_retry(1)
+        assert_equal(policy.stats, {"retries": 3, "over_budget": 1})
+
+    def test_delay(self):
+        policy = RetryPolicy(base_delay=1, max_delay=3)
+        with patch("random.uniform", lambda low, high: (low, high)):
+            assert_equal([policy.get_delay(n) for n in [1, 2, 3]],
+                         [(0, 1), (0, 2), (0, 3)])
+
+    def test_from_setting(self):
+        assert_equal(RetryPolicy.from_setting({"attempts": 5}).attempts, 5)
+        policy = RetryPolicy()
+        assert RetryPolicy.from_setting(policy) is policy
+
+
+class TestShardedClientWrapper(object):
+    def make_wrapper(self, urls, shard_key=0):
+        class settings:
+            shard_urls = urls
+        settings.shard_key = shard_key
+        class MockClient(ClientBase):
+            def call(self, call):
+                return self.remote_url
+        return ShardedClientWrapper(MockClient(urls[0], settings=settings))
+
+    def test_routing(self):
+        urls = ["mock://shard-%s" %(i, ) for i in range(4)]
+        sc = self.make_wrapper(urls)
+        owners = [sc.get(key) for key in range(200)]
+        assert_equal(set(owners), set(urls))
+        assert_equal(owners, [sc.foo.get(key, 42) for key in range(200)])
+
+    def test_shard_key_kwarg(self):
+        sc = self.make_wrapper(["mock://a", "mock://b"], shard_key="key")
+        assert_equal(sc.get(1, key="k"), sc.get(2, key="k"))
+        assert_raises(ValueError, sc.get, 1)
+        assert_equal([s.ping() for s in sc._shards()], ["mock://a", "mock://b"])
+
+    def test_rebalancing(self):
+        urls = ["mock://shard-%s" %(i, ) for i in range(4)]
+        before = self.make_wrapper(urls)
+        after = self.make_wrapper(urls + ["mock://shard-new"])
+        moved = [
+            (before.get(key), after.get(key)) for key in range(1000)
+            if before.get(key) != after.get(key)
+        ]
+        assert_equal(set(new for (_, new) in moved), set(["mock://shard-new"]))
+        assert 100 < len(moved) < 300, len(moved)
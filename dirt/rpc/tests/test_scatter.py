@@ -0,0 +1,57 @@
+import gevent
+from mock import Mock
+from nose.tools import assert_equal
+
+from ..scatter import scatter_gather, DeadlineExceeded
+
+
+def remote(result=None, delay=0, error=None):
+    def call(name, *args, **kwargs):
+        gevent.sleep(delay)
+        if error is not None:
+            raise error
+        return result(*args) if callable(result) else result
+    return Mock(_call=call)
+
+
+def failing_stream(items):
+    for item in items:
+        yield item
+    raise ValueError("stream failed")
+
+
+class TestScatterGather(object):
+    def test_results_and_errors(self):
+        error = ValueError("oops")
+        result = scatter_gather({
+            "a": remote(lambda x: x + 1),
+            "b": remote(error=error),
+            "c": remote(42, delay=1),
+        }, "foo", args=(1, ), timeout=0.05)
+        assert_equal(result.results, {"a": 2})
+        assert_equal(sorted(result.errors), ["b", "c"])
+        assert result.errors["b"] is error
+        assert isinstance(result.errors["c"], DeadlineExceeded)
+        assert not result.complete
+
+    def test_list_of_remotes(self):
+        result = scatter_gather([remote(1), remote(2)], "foo")
+        assert_equal(result.results, {0: 1, 1: 2})
+        assert result.complete
+
+    def test_merge_sorted(self):
+        result = scatter_gather([
+            remote(iter([1, 4, 7])),
+            remote(iter([2, 3, 9])),
+            remote(failing_stream([0, 5])),
+        ], "foo")
+        assert_equal(list(result.merge_sorted()), [0, 1, 2, 3, 4, 5, 7, 9])
+        assert_equal(result.errors.keys(), [2])
+
+    def test_merge_sorted_key(self):
+        result = scatter_gather([
+            remote(iter([{"x": 3}, {"x": 1}])),
+            remote(iter([{"x": 2}])),
+        ], "foo")
+        merged = result.merge_sorted(key=lambda item: -item["x"])
+        assert_equal([item["x"] for item in merged], [3, 2, 1])
@@ -10,7 +10,7 @@ from setproctitle import setproctitle
 
 from dirt import rpc
 from dirt.misc.gevent_ import fork
-from dirt.rpc.common import ClientWrapper
+from dirt.rpc.common import ClientWrapper, ShardedClientWrapper
 from dirt.reloader import run_with_reloader
 from dirt.misc.imp_ import instance_or_import
 from dirt.misc.gevent_ import BlockingDetector
@@ -30,6 +30,86 @@ class SettingsWrapper(object):
         raise AttributeError("Cannot find {0!r} in settings chain".format(name))
 
 
+class APIRegistry(object):
+    """ Keeps the client and wrapper created by ``DirtRunner.get_api`` for
+        each API so they can be shared by every caller in the process, instead
+        of being created (and the wrapper's attribute cache being rebuilt)
+        each time ``get_api`` is called.
+
+        An entry is replaced when it is requested with a different settings
+        object, or when one of the settings its client read (see
+        ``ClientBase.settings_read``) has been changed, and all the entries
+        are forgotten in a child process after a fork, so the child doesn't
+        share the parent's clients. """
+
+    _missing = object()
+
+    def __init__(self):
+        self._pid = os.getpid()
+        self._entries = {}
+
+    def _settings_values(self, settings, client):
+        names = getattr(client, "settings_read", None)
+        if not isinstance(names, set):
+            return ()
+        return tuple(
+            (name, getattr(settings, name, self._missing))
+            for name in sorted(names)
+        )
+
+    def _settings_changed(self, entry, settings):
+        if entry["settings"] is not settings:
+            return True
+        for name, value in entry["settings_values"]:
+            if getattr(settings, name, self._missing) != value:
+                return True
+        return False
+
+    def get(self, key, settings, factory):
+        """ Returns the ``(client, wrapper)`` for ``key``, calling
+            ``factory()`` to create them if they haven't been created in this
+            process yet, or if ``settings`` has changed since they were. """
+        if self._pid != os.getpid():
+            self._entries.clear()
+            self._pid = os.getpid()
+        entry = self._entries.get(key)
+        if entry is not None and not self._settings_changed(entry, settings):
+            entry["hits"] += 1
+            return entry["client"], entry["wrapper"]
+        if entry is not None:
+            log.info("settings for %r changed; creating a new client", key)
+        client, wrapper = factory()
+        self._entries[key] = {
+            "settings": settings,
+            "settings_values": self._settings_values(settings, client),
+            "client": client,
+            "wrapper": wrapper,
+            "created": (entry or {}).get("created", 0) + 1,
+            "hits": (entry or {}).get("hits", 0),
+        }
+        return client, wrapper
+
+    def clear(self):
+        """ Forgets all the clients and wrappers. """
+        self._entries.clear()
+
+    def stats(self):
+        """ Returns ``{key: stats}``, where ``stats`` has the number of times
+            the client for ``key`` was ``created`` and reused (``hits``), and
+            the call stats of its wrapper (see ``ClientWrapper._call_stats``).
+            """
+        result = {}
+        for key, entry in self._entries.items():
+            stats = {
+                "created": entry["created"],
+                "hits": entry["hits"],
+            }
+            if isinstance(entry["wrapper"], ClientWrapper):
+                stats.update(entry["wrapper"]._call_stats())
+            result[key] = stats
+        return result
+
+
 class DirtRunner(object):
     def __init__(self, settings):
         self.settings = settings
@@ -288,6 +368,10 @@ class DirtRunner(object):
     # the names of those apis.
     _get_api_force_no_mock = set()
 
+    # The clients and wrappers returned by ``get_api``, which are shared by
+    # all the runners in the process.
+    api_registry = APIRegistry()
+
     def get_api(self, settings_dict, api_name, mock_cls=None, use_bind=False):
         api_settings = settings_dict.get(api_name.upper())
         if not api_settings:
@@ -298,13 +382,26 @@ class DirtRunner(object):
             allow_mock = not ("NO_MOCK_" + api_name.upper()) in os.environ
 
         remote_url = getattr(api_settings, "remote_url", None)
+        shard_urls = getattr(api_settings, "shard_urls", None)
+        if remote_url is None and shard_urls:
+            remote_url = shard_urls[0]
         if remote_url is None and use_bind:
             remote_url = api_settings.bind_url
         if not remote_url:
             raise Exception("No 'remote_url' specified for %r" %(api_name, ))
 
-        ClientCls = rpc.get_client_cls(remote_url)
-        client = ClientCls(remote_url)
+        def make_client():
+            ClientCls = rpc.get_client_cls(remote_url)
+            client = ClientCls(remote_url, settings=api_settings)
+            default_wrapper = (
+                ShardedClientWrapper if shard_urls else ClientWrapper
+            )
+            WrapperClass = client.get_setting("rpc_wrapper", default_wrapper)
+            return client, WrapperClass(client)
+
+        client, wrapper = self.api_registry.get(
+            (api_name, remote_url), api_settings, make_client,
+        )
         should_check_mock = (
             allow_mock and
             api_name not in self._get_api_force_no_mock
@@ -317,8 +414,7 @@ class DirtRunner(object):
                             remote_url, mock_cls, api_name)
                 return mock_cls()
 
-        WrapperClass = getattr(api_settings, "rpc_wrapper", ClientWrapper)
-        return WrapperClass(client)
+        return wrapper
 
     def get_api_factory(self):
         def get_api_factory_helper(*args):
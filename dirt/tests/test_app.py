@@ -1,7 +1,9 @@
+import hashlib
 import os
+import time
 import logging
 
-from mock import Mock
+from mock import Mock, patch
 from nose.tools import assert_equal, assert_raises
 import gevent
 from gevent.event import Event
@@ -206,6 +208,151 @@ class TestAPIEdge(XXXTestBase):
         in_second_method.wait()
         self.assert_edge_clean(edge)
 
+    def test_conditional(self):
+        edge = APIEdge(MockApp(), self.get_settings())
+        edge.report_load = False
+        status = {"a": 1, "b": 2, "c": 3}
+        edge.app.api.status = edge.conditional(lambda: dict(status))
+
+        call = Call("status")
+        assert_equal(edge.execute(call), status)
+        first_etag = call.result_headers["etag"]
+
+        call = Call("status", headers={"etag": first_etag})
+        assert_equal(edge.execute(call), None)
+        assert_equal(call.result_headers, {"etag": first_etag, "nm": True})
+
+        status["b"] = 42
+        call = Call("status", headers={"etag": first_etag})
+        assert_equal(edge.execute(call), [["s", ["b"], 42]])
+        assert_equal(call.result_headers["delta"], first_etag)
+        assert call.result_headers["etag"] != first_etag
+
+    def test_cacheable(self):
+        edge = APIEdge(MockApp(), self.get_settings())
+        edge.app.api.get = edge.cacheable(ttl=30)(lambda: 42)
+        call = Call("get")
+        assert_equal(edge.execute(call), 42)
+        assert_equal(call.result_headers["ttl"], 30)
+
+    def test_load(self):
+        edge = APIEdge(MockApp(), self.get_settings())
+        edge.latency_average_weight = 1
+        def get():
+            assert_equal(edge.get_load()[:2], [1, 0])
+            return 42
+        edge.app.api.get = get
+        with patch("time.time", side_effect=[100, 100, 100.25, 100.25]):
+            call = Call("get")
+            edge.execute(call)
+        assert_equal(call.result_headers["load"], [0, 0, 250])
+
+    def test_coalesced(self):
+        edge = APIEdge(MockApp(), self.get_settings())
+        calls = []
+        def get(x):
+            calls.append(x)
+            gevent.sleep(0.01)
+            return [x]
+        edge.app.api.get = edge.coalesced(get)
+        greenlets = [
+            gevent.spawn(edge.execute, Call("get", (x, ))) for x in [1, 1, 2]
+        ]
+        assert_equal([g.get() for g in greenlets], [[1], [1], [2]])
+        assert_equal(calls, [1, 2])
+        self.assert_edge_clean(edge)
+
+    def test_cached(self):
+        edge = APIEdge(MockApp(), self.get_settings())
+        calls = []
+        def get(x):
+            calls.append(x)
+            return [x]
+        edge.app.api.get = edge.cached(ttl=10, max_entries=2)(get)
+
+        with patch("time.time", return_value=100):
+            for x in [1, 1, 2, 3, 1]:
+                assert_equal(edge.execute(Call("get", (x, ))), [x])
+            edge._call_semaphore = Mock(locked=lambda: False)
+            edge.execute(Call("get", (1, )))
+            assert not edge._call_semaphore.acquire.called
+        with patch("time.time", return_value=111):
+            edge.execute(Call("get", (1, )))
+        assert_equal(calls, [1, 2, 3, 1, 1])
+        assert_equal(edge.memoize_stats["get"], {"hits": 2, "misses": 5})
+        # Memo hits are counted like any other call
+        assert_equal(edge.call_stats["completed"], 7)
+        assert_equal(edge.call_stats["memo_hits"], 2)
+        assert_equal(edge.latency_histograms["get"]["execute"].count, 7)
+
+        edge.invalidate_memoized("get")
+        edge.execute(Call("get", (1, )))
+        assert_equal(calls[-1], 1)
+        assert_equal(len(calls), 6)
+
+    def test_cached_binary_args(self):
+        # Arguments sent as frames arrive as ``memoryview``s, whose repr
+        # doesn't include their contents.
+        edge = APIEdge(MockApp(), self.get_settings())
+        calls = []
+        def digest(blob):
+            calls.append(blob.tobytes())
+            return hashlib.md5(blob).hexdigest()
+        edge.app.api.digest = edge.cached(ttl=10)(digest)
+        for data in ["aaaa", "bbbb", "aaaa"]:
+            blob = memoryview(bytearray(data))
+            result = edge.execute(Call("digest", (blob, )))
+            assert_equal(result, hashlib.md5(data).hexdigest())
+        assert_equal(calls, ["aaaa", "bbbb"])
+
+        # Arguments which can't be compared aren't memoized
+        edge.app.api.describe = edge.cached(ttl=10)(lambda obj: len(calls))
+        edge.execute(Call("describe", (object(), )))
+        edge.execute(Call("describe", (object(), )))
+        assert_equal(edge.memoize_stats.get("describe"), None)
+
+    def test_singleton_handlers(self):
+        created = []
+        @APIEdge.handler_lifecycle("singleton")
+        class SingletonAPI(object):
+            def __init__(self, edge, call):
+                created.append(call)
+            def foo(self):
+                return "foo"
+        app = MockApp()
+        app.api_handlers = dict(app.api_handlers, single=SingletonAPI)
+        edge = APIEdge(app, self.get_settings())
+        edge.compile_handlers()
+        assert_equal(created, [None])
+        assert "single.foo" in edge._dispatch
+        for _ in range(3):
+            assert_equal(edge.execute(Call("single.foo")), "foo")
+        assert_equal(created, [None])
+        edge.reset_handlers()
+        assert_equal(edge.execute(Call("single.foo")), "foo")
+        assert_equal(created, [None, None])
+
+    def test_connection_handlers(self):
+        created = []
+        @APIEdge.handler_lifecycle("connection")
+        class ConnectionAPI(object):
+            def __init__(self, edge, call):
+                created.append(call.peer)
+            def foo(self):
+                return "foo"
+        app = MockApp()
+        app.api_handlers = dict(app.api_handlers, cxn=ConnectionAPI)
+        edge = APIEdge(app, self.get_settings())
+        for peer in ["a", "a", "b", "a"]:
+            edge.execute(Call("cxn.foo", peer=peer))
+        assert_equal(created, ["a", "b"])
+        edge.connection_closed("a")
+        edge.execute(Call("cxn.foo", peer="a"))
+        assert_equal(created, ["a", "b", "a"])
+
+    def test_invalid_handler_lifecycle(self):
+        assert_raises(ValueError, APIEdge.handler_lifecycle, "forever")
+
 
 class TestDebugAPI(XXXTestBase):
     def test_normal_call(self):
@@ -214,6 +361,9 @@ class TestDebugAPI(XXXTestBase):
         call = Call("debug.status", (), {}, {})
         result = edge.execute(call)
         assert_contains(result, "uptime")
+        # The ``meta`` dict is only created when it is read
+        assert_equal(call._meta, None)
+        assert call.time_started >= call.time_received
 
     def test_error_call(self):
         app = DirtApp("test_normal_call", self.get_settings(), [])
@@ -227,6 +377,81 @@ class TestDebugAPI(XXXTestBase):
                 raise
 
 
+    def test_active_calls(self):
+        app = DirtApp("test_active_calls", self.get_settings(), [])
+        edge = APIEdge(app, app.settings)
+        release = Event()
+        app.get_api = lambda edge, call: Mock(wait=lambda: release.wait())
+        greenlets = [
+            gevent.spawn(edge.execute, Call("wait", peer=("1.2.3.4", x)))
+            for x in range(5)
+        ]
+        gevent.sleep(0)
+
+        # Note: the debug calls are also active while they run
+        status = edge.execute(Call("debug.status"))
+        assert_equal(status["api_calls"]["active"], 6)
+        first = edge.execute(Call("debug.active_calls", kwargs={"limit": 3}))
+        assert_equal(first["total"], 6)
+        assert_equal([c["peer"] for c in first["calls"]],
+                     ["1.2.3.4:0", "1.2.3.4:1", "1.2.3.4:2"])
+        second = edge.execute(Call("debug.active_calls", kwargs={
+            "after": first["next"], "limit": 3,
+        }))
+        assert_equal([c["peer"] for c in second["calls"]],
+                     ["1.2.3.4:3", "1.2.3.4:4", None])
+        assert_equal(second["next"], None)
+
+        release.set()
+        gevent.joinall(greenlets)
+        assert_equal(edge.active_calls, {})
+        assert_equal(edge.call_stats["completed"], 8)
+
+
+    def test_latency(self):
+        app = DirtApp("test_latency", self.get_settings(), [])
+        edge = APIEdge(app, app.settings)
+        app.get_api = lambda edge, call: Mock(foo=lambda: gevent.sleep(0.01))
+        for _ in range(3):
+            edge.execute(Call("foo"))
+        latency = edge.execute(Call("debug.status"))["latency"]["foo"]
+        assert_equal(latency["execute"]["count"], 3)
+        assert latency["execute"]["p50"] >= 10, latency
+        assert latency["queue"]["max"] < 10, latency
+        histograms = edge.execute(Call("debug.latency_histograms", ("foo", )))
+        assert_equal(histograms["foo"]["execute"]["count"], 3)
+
+
+    def test_slow_calls(self):
+        app = DirtApp("test_slow_calls", self.get_settings(), [])
+        edge = APIEdge(app, app.settings)
+        edge.slow_call_threshold = 0.01
+        def slow(x):
+            gevent.sleep(0.02)
+            gevent.getcurrent().blocking_detected = (time.time(), "stack")
+        def fast(x):
+            return x
+        api = Mock(slow=slow, fast=fast,
+                   slow_ok=APIEdge.slow_after(1)(lambda: gevent.sleep(0.02)))
+        app.get_api = lambda edge, call: api
+        edge.execute(Call("fast", (1, )))
+        edge.execute(Call("slow_ok"))
+        edge.execute(Call("slow", ("x" * 1000, ), peer=("1.2.3.4", 5)))
+        slow_calls = edge.execute(Call("debug.slow_calls"))
+        assert_equal([c["name"] for c in slow_calls], ["slow"])
+        entry = slow_calls[0]
+        assert_equal(entry["peer"], "1.2.3.4:5")
+        assert_equal(len(entry["args"]), edge.slow_call_args_len)
+        assert_equal(entry["stack"], "stack")
+        assert entry["duration_ms"] >= 20, entry
+
+        edge.slow_call_args_len = None
+        edge.execute(Call("slow", ("x" * 10000000, )))
+        entry = edge.execute(Call("debug.slow_calls"))[0]
+        assert_equal(entry["args"], None)
+        assert_equal(len(entry["args_hash"]), 12)
+
+
 class TestPIDFILE(object):
     def setup(self):
         self.filename = "/tmp/%s-test-pidfile" %(__name__, )
@@ -1,7 +1,8 @@
 from mock import Mock
 from nose.tools import eq_, raises
 
-from ..runner import DirtRunner
+from ..runner import DirtRunner, APIRegistry
+from ..rpc.common import ClientBase
 
 
 class TestDirtRunner(object):
@@ -81,3 +82,75 @@ class TestDirtRunner(object):
         res = self.runner.fork_and_run_many(run_argv, app_argvs)
         eq_(res["app_pid"], "foo")
         eq_(res["script_pid"], "./bar")
+
+
+class TestAPIRegistry(object):
+    def setup(self):
+        self.registry = APIRegistry()
+        self.created = []
+
+    def factory(self):
+        self.created.append(Mock())
+        return self.created[-1], Mock()
+
+    def test_instances_are_shared(self):
+        class FOO:
+            remote_url = "drpc://localhost:1234"
+        first = self.registry.get("foo", FOO, self.factory)
+        eq_(self.registry.get("foo", FOO, self.factory), first)
+        eq_(len(self.created), 1)
+        eq_(self.registry.stats(), {"foo": {"created": 1, "hits": 1}})
+
+    def client_factory(self, settings):
+        def factory():
+            client = ClientBase("drpc://localhost:1234", settings=settings)
+            client.get_setting("timeout")
+            self.created.append(client)
+            return client, Mock()
+        return factory
+
+    def test_settings_change_invalidates(self):
+        class BASE:
+            timeout = 1
+        class FOO(BASE):
+            remote_url = "drpc://localhost:1234"
+        factory = self.client_factory(FOO)
+        first = self.registry.get("foo", FOO, factory)
+        BASE.timeout = 2
+        second = self.registry.get("foo", FOO, factory)
+        assert second is not first
+        eq_(self.registry.get("foo", FOO, factory), second)
+        eq_(self.registry.stats()["foo"], {"created": 2, "hits": 1})
+
+    def test_unread_settings_are_ignored(self):
+        class FOO:
+            remote_url = "drpc://localhost:1234"
+        factory = self.client_factory(FOO)
+        first = self.registry.get("foo", FOO, factory)
+        FOO.unused = 1
+        eq_(self.registry.get("foo", FOO, factory), first)
+
+    def test_new_settings_object_invalidates(self):
+        class FOO:
+            pass
+        class BAR:
+            pass
+        first = self.registry.get("foo", FOO, self.factory)
+        assert self.registry.get("foo", BAR, self.factory) is not first
+
+    def test_fork_invalidates(self):
+        class FOO:
+            pass
+        first = self.registry.get("foo", FOO, self.factory)
+        self.registry._pid = -1
+        assert self.registry.get("foo", FOO, self.factory) is not first
+
+    def test_get_api_shares_wrappers(self):
+        class FOO:
+            remote_url = "drpc://localhost:1234"
+        runner = DirtRunner(Mock())
+        runner.api_registry = self.registry
+        api = runner.get_api({"FOO": FOO}, "foo")
+        assert runner.get_api({"FOO": FOO}, "foo") is api
+        stats = self.registry.stats()[("foo", FOO.remote_url)]
+        eq_((stats["created"], stats["hits"], stats["calls"]), (1, 1, 0))